@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#  Copyright (C) 2024. Suto-Commune
+#  _
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#  _
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#  _
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+@File       : bench_engine.py
+
+@Author     : hsn
+
+@Date       : 2024/10/19 下午7:30
+
+Benchmark the engine over the recorded corpus in benchmarks/corpus, the responses are served by a mock
+transport (`utils.replay.ReplayTransport`) so no network is used. See benchmarks/README.md for the corpus.
+usage:
+    python benchmarks/bench_engine.py [--min-time 1] [--filter search]
+    python benchmarks/bench_engine.py --save new.json --compare old.json
+    python benchmarks/bench_engine.py --against HEAD~1  # Run the same corpus on another commit.
+--against needs a commit which has `utils.replay`, the older ones can't replay the corpus.
+"""
+import argparse
+import gc
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable
+
+REPO = Path(__file__).resolve().parent.parent
+# The package of this tree, or of the worktree of another commit, see `run_against`.
+sys.path.insert(0, os.environ.get("BENCH_PACKAGE_ROOT") or str(REPO))
+
+from suto_legado_parser.book_soure_parser import Parser, url_process
+from suto_legado_parser.rule.compile import rule_compile
+from suto_legado_parser.rule.parser import split_rule
+from suto_legado_parser.utils.replay import ReplayTransport
+
+CORPUS = Path(__file__).resolve().parent / "corpus"
+
+
+def load_manifest() -> dict:
+    return json.loads((CORPUS / "manifest.json").read_text(encoding="utf-8"))
+
+
+def load_sources() -> list[dict]:
+    return [json.loads(p.read_text(encoding="utf-8")) for p in sorted((CORPUS / "sources").glob("*.json"))]
+
+
+def make_parser(source: dict) -> Parser:
+    return Parser(source, transport=ReplayTransport(CORPUS))
+
+
+def scenarios() -> dict[str, Callable[[], object]]:
+    query = load_manifest()["query"]
+    rt = {}
+    for source in load_sources():
+        name = source["bookSourceUrl"].split("//", 1)[-1]
+        rules = [r for block in ("ruleSearch", "ruleBookInfo") for r in source.get(block, {}).values() if r]
+        rt[f"split_rule:{name}"] = lambda rules=rules: [list(split_rule(r)) for r in rules]
+
+        parser = make_parser(source)
+        var = {"_book_source": source, "key": query, "page": 1}
+        rt[f"search_url:{name}"] = lambda parser=parser, var=var: url_process(parser.search_template.render(var))
+        try:
+            first = next(iter(parser.search(query)))
+        except Exception as e:  # e.g. the search url needs a JS runtime which is not installed.
+            rt[f"search:{name}"] = e
+            continue
+
+        search_page = parser.client.get(source["searchUrl"].replace("{{key}}", query).replace("{{page}}", "1")).text
+        books = json.loads(rule_compile(source["ruleSearch"]["bookList"], {"result": search_page},
+                                        allow_str_rule=False))
+        fields = {k: v for k, v in source["ruleSearch"].items() if k != "bookList" and v}
+        rt[f"rule_compile:{name}"] = lambda fields=fields, book=books[0]: [
+            rule_compile(r, {"result": book}) for r in fields.values()]
+        rt[f"search:{name}"] = lambda parser=parser: list(parser.search(query))
+        rt[f"get_detail:{name}"] = lambda parser=parser, first=first: parser.get_detail(first)
+    return rt
+
+
+def measure(func: Callable[[], object], min_time: float) -> dict:
+    func()  # Warm up the caches.
+
+    runs, start = 0, time.perf_counter()
+    while (elapsed := time.perf_counter() - start) < min_time or runs < 3:
+        func()
+        runs += 1
+
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    gc.collect()
+    return {"ops_per_sec": runs / elapsed, "us_per_op": elapsed / runs * 1e6,
+            "peak_kib": peak / 1024, "retained_blocks": sys.getallocatedblocks() - blocks}
+
+
+def run(min_time: float, name_filter: str) -> dict:
+    results = {}
+    for name, func in scenarios().items():
+        if name_filter not in name:
+            continue
+        if isinstance(func, Exception):
+            results[name] = {"skipped": f"{type(func).__name__}: {func}"}
+        else:
+            results[name] = measure(func, min_time)
+    return results
+
+
+def run_against(rev: str, args) -> dict:
+    """
+    Run this script, with this corpus, against the package of another commit.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        tree = os.path.join(tmp, "tree")
+        subprocess.run(["git", "worktree", "add", "--detach", tree, rev], cwd=REPO, check=True, capture_output=True)
+        try:
+            if not os.path.exists(os.path.join(tree, "suto_legado_parser", "utils", "replay.py")):
+                raise SystemExit(f"{rev} has no suto_legado_parser.utils.replay, it can't replay the corpus")
+            out = os.path.join(tmp, "results.json")
+            subprocess.run([sys.executable, __file__, "--min-time", str(args.min_time), "--filter", args.filter,
+                            "--save", out, "--quiet"],
+                           env={**os.environ, "BENCH_PACKAGE_ROOT": tree}, check=True)
+            return json.loads(Path(out).read_text())
+        finally:
+            subprocess.run(["git", "worktree", "remove", "--force", tree], cwd=REPO, check=True)
+
+
+def print_results(results: dict, base: dict | None = None):
+    print(f"{'scenario':<40} {'ops/s':>10} {'us/op':>10} {'peak KiB':>10} {'blocks':>8}" + ("  vs base" if base else ""))
+    for name, r in results.items():
+        if "skipped" in r:
+            print(f"{name:<40} skipped: {r['skipped']}")
+            continue
+        line = f"{name:<40} {r['ops_per_sec']:>10.1f} {r['us_per_op']:>10.1f} {r['peak_kib']:>10.1f} " \
+               f"{r['retained_blocks']:>8}"
+        if base and "ops_per_sec" in base.get(name, {}):
+            line += f"  {r['ops_per_sec'] / base[name]['ops_per_sec'] - 1:+.1%}"
+        print(line)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--min-time", type=float, default=1.0, help="Seconds to run each scenario.")
+    arg_parser.add_argument("--filter", default="", help="Only run the scenarios whose name contains it.")
+    arg_parser.add_argument("--save", help="Save the results as json.")
+    arg_parser.add_argument("--compare", help="Compare with the results saved by --save.")
+    arg_parser.add_argument("--against", help="Compare with a git revision, e.g. HEAD~1. It must have utils.replay.")
+    arg_parser.add_argument("--quiet", action="store_true")
+    args = arg_parser.parse_args()
+
+    base = None
+    if args.compare:
+        base = json.loads(Path(args.compare).read_text())
+    elif args.against:
+        base = run_against(args.against, args)
+
+    results = run(args.min_time, args.filter)
+    if args.save:
+        Path(args.save).write_text(json.dumps(results, indent=2))
+    if not args.quiet:
+        print_results(results, base)
+
+
+if __name__ == "__main__":
+    main()
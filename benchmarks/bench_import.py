@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#  Copyright (C) 2024. Suto-Commune
+#  _
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#  _
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#  _
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+@File       : bench_import.py
+
+@Author     : hsn
+
+@Date       : 2024/10/19 下午3:20
+
+Measure the import time of the package and fail if a heavy backend is imported eagerly.
+usage:
+    python benchmarks/bench_import.py [--repeat 5] [--budget-ms 400]
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+MODULES = [
+    "suto_legado_parser.rule.rules",
+    "suto_legado_parser.rule.compile",
+    "suto_legado_parser.book_soure_parser",
+]
+
+# These backends must only be imported by the first rule which uses them.
+LAZY_BACKENDS = ["STPyV8", "bs4", "lxml", "jsonpath_ng"]
+
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"elapsed": elapsed, "modules": [m for m in {backends!r} if m in sys.modules]}}))
+"""
+
+
+def measure(module: str) -> dict:
+    # A fresh interpreter per run, otherwise the second import is free.
+    out = subprocess.run([sys.executable, "-c", _PROBE.format(module=module, backends=LAZY_BACKENDS)],
+                         check=True, capture_output=True, text=True).stdout
+    return json.loads(out)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--repeat", type=int, default=5)
+    arg_parser.add_argument("--budget-ms", type=float, default=400.0,
+                            help="Fail if the median import time of a module exceeds this budget.")
+    args = arg_parser.parse_args()
+
+    failed = False
+    for module in MODULES:
+        runs = [measure(module) for _ in range(args.repeat)]
+        median_ms = statistics.median(run["elapsed"] for run in runs) * 1000
+        leaked = sorted({m for run in runs for m in run["modules"]})
+        print(f"{module:<40} {median_ms:8.1f} ms  eager backends: {', '.join(leaked) or '-'}")
+        if leaked or median_ms > args.budget_ms:
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#  Copyright (C) 2024. Suto-Commune
+#  _
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#  _
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#  _
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+@File       : bench_metrics.py
+
+@Author     : hsn
+
+@Date       : 2024/10/19 下午6:50
+
+Measure the overhead of the metrics instrumentation on `rule_compile`, without a sink and with the
+in-process histogram sink.
+usage:
+    python benchmarks/bench_metrics.py [--number 20000]
+"""
+import argparse
+import timeit
+
+from suto_legado_parser.rule.compile import rule_compile
+from suto_legado_parser.utils import metrics
+
+RULE = "$.data.name##\\s+"
+DOCUMENT = '{"data": {"name": " name ", "author": "author"}}'
+
+
+def run(func, number: int) -> float:
+    return min(timeit.repeat(lambda: func(RULE, {"result": DOCUMENT}), number=number, repeat=5)) / number
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--number", type=int, default=20000)
+    args = arg_parser.parse_args()
+
+    metrics.set_sink(None)
+    bare = run(rule_compile.__wrapped__, args.number)  # Only the outer wrapper is skipped.
+    off = run(rule_compile, args.number)
+    metrics.set_sink(metrics.HistogramSink())
+    on = run(rule_compile, args.number)
+    metrics.set_sink(None)
+
+    print(f"unwrapped      {bare * 1e6:8.2f} us/op")
+    print(f"no sink        {off * 1e6:8.2f} us/op  ({(off - bare) / bare:+.1%})")
+    print(f"histogram sink {on * 1e6:8.2f} us/op  ({(on - bare) / bare:+.1%})")
+
+
+if __name__ == "__main__":
+    main()
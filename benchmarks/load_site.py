@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#  Copyright (C) 2024. Suto-Commune
+#  _
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#  _
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#  _
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+@File       : load_site.py
+
+@Author     : hsn
+
+@Date       : 2024/10/19 下午9:40
+
+Run searches (and optionally details) against the synthetic site of site_server.py and report the
+throughput and the latency percentiles.
+usage:
+    PYTHONPATH=. python benchmarks/load_site.py --layout html --requests 2000 --concurrency 200 --latency 0.05
+    PYTHONPATH=. python benchmarks/load_site.py --mode asyncio --detail
+"""
+import argparse
+import asyncio
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from site_server import Site, add_config_arguments, config_from_args, make_source  # noqa: E402
+from suto_legado_parser.book_soure_parser import Parser  # noqa: E402
+
+
+def start_site(config) -> Site:
+    """
+    Run the site in its own event loop in a daemon thread.
+    """
+    site = Site(config)
+    loop = asyncio.new_event_loop()
+    ready = threading.Event()
+
+    def run():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(site.start())
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    ready.wait()
+    return site
+
+
+def one_job(parser: Parser, key: str, detail: bool) -> tuple[float, bool]:
+    start = time.perf_counter()
+    try:
+        books = list(parser.search(key))
+        ok = bool(books)
+        if detail and books:
+            parser.get_detail(books[0])
+    except Exception:
+        ok = False
+    return time.perf_counter() - start, ok
+
+
+def run_threads(parser: Parser, keys: list[str], concurrency: int, detail: bool) -> list[tuple[float, bool]]:
+    with ThreadPoolExecutor(concurrency) as pool:
+        return list(pool.map(lambda key: one_job(parser, key, detail), keys))
+
+
+def run_asyncio(parser: Parser, keys: list[str], concurrency: int, detail: bool) -> list[tuple[float, bool]]:
+    async def main():
+        semaphore = asyncio.Semaphore(concurrency)
+        loop = asyncio.get_running_loop()
+        loop.set_default_executor(ThreadPoolExecutor(concurrency))
+
+        async def job(key):
+            async with semaphore:
+                return await asyncio.to_thread(one_job, parser, key, detail)
+
+        return await asyncio.gather(*(job(key) for key in keys))
+
+    return asyncio.run(main())
+
+
+def percentile(values: list[float], q: float) -> float:
+    return statistics.quantiles(values, n=100, method="inclusive")[int(q) - 1] if len(values) > 1 else values[0]
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--layout", default="html", choices=["html", "json"])
+    arg_parser.add_argument("--mode", default="threads", choices=["threads", "asyncio"])
+    arg_parser.add_argument("--requests", type=int, default=500)
+    arg_parser.add_argument("--concurrency", type=int, default=50)
+    arg_parser.add_argument("--detail", action="store_true", help="Get the detail of the first book too.")
+    add_config_arguments(arg_parser)
+    args = arg_parser.parse_args()
+
+    site = start_site(config_from_args(args))
+    parser = Parser(make_source(site.base_url, args.layout))
+    keys = [f"书{i}" for i in range(args.requests)]
+
+    runner = run_threads if args.mode == "threads" else run_asyncio
+    start = time.perf_counter()
+    results = runner(parser, keys, args.concurrency, args.detail)
+    elapsed = time.perf_counter() - start
+
+    latencies = [t for t, ok in results if ok]
+    errors = sum(1 for _, ok in results if not ok)
+    print(f"layout={args.layout} mode={args.mode} requests={args.requests} concurrency={args.concurrency} "
+          f"latency={args.latency}({args.latency_dist}) error_rate={args.error_rate}")
+    print(f"throughput {len(results) / elapsed:.1f} jobs/s, errors {errors} ({errors / len(results):.1%})")
+    if latencies:
+        print(f"latency p50 {percentile(latencies, 50) * 1000:.1f} ms, p90 {percentile(latencies, 90) * 1000:.1f} ms, "
+              f"p99 {percentile(latencies, 99) * 1000:.1f} ms, max {max(latencies) * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
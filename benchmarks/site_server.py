@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#  Copyright (C) 2024. Suto-Commune
+#  _
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#  _
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#  _
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+@File       : site_server.py
+
+@Author     : hsn
+
+@Date       : 2024/10/19 下午9:05
+
+A synthetic book site for end-to-end load tests. It generates the search, detail, toc and chapter pages
+in two common layouts, html (`/html/...`) and json (`/json/...`), and the book source matching each layout
+is served at `/source/html.json` and `/source/json.json`.
+usage:
+    python benchmarks/site_server.py --port 8808 --latency 0.05 --latency-dist exp --error-rate 0.01
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+from dataclasses import dataclass
+from typing import Callable
+from urllib.parse import parse_qs, unquote, urlsplit
+
+WORDS = "斗罗大陆唐三史莱克学院武魂觉醒魂环魂骨海神岛杀戮之都昊天锤蓝银草七宝琉璃塔冰火两仪眼"
+
+
+@dataclass
+class SiteConfig:
+    results_per_page: int = 20
+    toc_size: int = 500
+    chapter_chars: int = 3000
+    padding: int = 0  # Extra bytes of boilerplate on every html page.
+    latency: float = 0.0  # The mean seconds before a response.
+    latency_dist: str = "fixed"  # fixed, uniform, exp or lognormal.
+    error_rate: float = 0.0  # The fraction of the requests answered with a 500.
+    drop_rate: float = 0.0  # The fraction of the connections closed without a response.
+    seed: int = 0
+
+    def sample_latency(self, rng: random.Random) -> float:
+        match self.latency_dist:
+            case "fixed":
+                return self.latency
+            case "uniform":
+                return rng.uniform(0, 2 * self.latency)
+            case "exp":
+                return rng.expovariate(1 / self.latency) if self.latency else 0.0
+            case "lognormal":
+                # sigma=1, and mu chosen so that the mean is `latency`.
+                return rng.lognormvariate(0, 1) * self.latency / 1.6487 if self.latency else 0.0
+            case _:
+                raise ValueError(f"Unknown latency distribution: {self.latency_dist}")
+
+
+def _text(seed: str, length: int) -> str:
+    digest = hashlib.md5(seed.encode()).digest()
+    rng = random.Random(digest)
+    return "".join(rng.choice(WORDS) for _ in range(length))
+
+
+def _book(key: str, book_id: int) -> dict:
+    return {"id": book_id, "name": f"{key}{book_id}", "author": _text(f"a{book_id}", 3),
+            "kind": ["玄幻", "仙侠", "都市", "历史"][book_id % 4], "word_count": f"{(book_id % 500) + 10}万",
+            "intro": _text(f"i{book_id}", 120), "last_chapter": f"第{book_id % 1000 + 100}章 {_text(f'l{book_id}', 4)}"}
+
+
+def _html(title: str, body: str, config: SiteConfig) -> str:
+    padding = f'<div class="ad" style="display:none">{"x" * config.padding}</div>' if config.padding else ""
+    return (f'<!DOCTYPE html><html><head><meta charset="utf-8"><title>{title}</title></head><body>'
+            f'<div class="header"><a href="/">合成书站</a></div>{padding}{body}</body></html>')
+
+
+class Site:
+    def __init__(self, config: SiteConfig):
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.routes: list[tuple[str, Callable[..., tuple[str, str]]]] = [
+            ("/html/search", self.html_search), ("/json/search", self.json_search),
+            ("/html/book/", self.html_book), ("/json/book/", self.json_book),
+            ("/source/", self.source),
+        ]
+        self.base_url = ""
+
+    # The books of a search are deterministic, so a query always gets the same results.
+    def _search_ids(self, key: str, page: int) -> list[int]:
+        start = int(hashlib.md5(key.encode()).hexdigest()[:6], 16) % 100000 * 10
+        start += (page - 1) * self.config.results_per_page
+        return list(range(start, start + self.config.results_per_page))
+
+    def html_search(self, path: str, query: dict) -> tuple[str, str]:
+        key, page = query.get("key", ""), int(query.get("page", 1))
+        items = []
+        for book in (_book(key, i) for i in self._search_ids(key, page)):
+            items.append(
+                f'<div class="result-item"><a class="title" href="/html/book/{book["id"]}">{book["name"]}</a>'
+                f'<p class="info"><span>作者：</span><span class="author">{book["author"]}</span>'
+                f'<span class="kind">{book["kind"]}</span><span class="words">{book["word_count"]}</span></p>'
+                f'<p class="intro">{book["intro"]}</p>'
+                f'<a class="last" href="/html/book/{book["id"]}/1.html">{book["last_chapter"]}</a></div>')
+        return "text/html; charset=utf-8", _html(f"{key} 搜索结果", "".join(items), self.config)
+
+    def json_search(self, path: str, query: dict) -> tuple[str, str]:
+        key, page = query.get("key", ""), int(query.get("page", 1))
+        books = [_book(key, i) for i in self._search_ids(key, page)]
+        return "application/json", json.dumps({"code": 0, "data": {"list": books}}, ensure_ascii=False)
+
+    def html_book(self, path: str, query: dict) -> tuple[str, str]:
+        parts = path.removeprefix("/html/book/").split("/")
+        book_id = int(parts[0])
+        book = _book("书", book_id)
+        if len(parts) == 1:
+            body = (f'<div id="info"><h1>{book["name"]}</h1><p class="author">{book["author"]}</p>'
+                    f'<p class="kind">{book["kind"]}</p><p class="words">{book["word_count"]}</p>'
+                    f'<p class="last"><a href="/html/book/{book["id"]}/1.html">{book["last_chapter"]}</a></p>'
+                    f'<a class="toc" href="/html/book/{book["id"]}/toc">目录</a></div>'
+                    f'<div id="intro">{book["intro"]}</div>')
+        elif parts[1] == "toc":
+            body = '<dl id="list">' + "".join(
+                f'<dd><a href="/html/book/{book_id}/{c}.html">第{c}章 {_text(f"c{book_id}.{c}", 4)}</a></dd>'
+                for c in range(1, self.config.toc_size + 1)) + "</dl>"
+        else:
+            chapter = int(parts[1].removesuffix(".html"))
+            text = _text(f"t{book_id}.{chapter}", self.config.chapter_chars)
+            body = f'<h1>第{chapter}章</h1><div id="content">' + "<br>".join(
+                text[i:i + 100] for i in range(0, len(text), 100)) + "</div>"
+        return "text/html; charset=utf-8", _html(book["name"], body, self.config)
+
+    def json_book(self, path: str, query: dict) -> tuple[str, str]:
+        parts = path.removeprefix("/json/book/").split("/")
+        book_id = int(parts[0])
+        book = _book("书", book_id)
+        if len(parts) == 1:
+            data = {**book, "tocUrl": f"/json/book/{book['id']}/toc"}
+        elif parts[1] == "toc":
+            data = [{"title": f"第{c}章 {_text(f'c{book_id}.{c}', 4)}", "url": f"/json/book/{book_id}/chapter/{c}"}
+                    for c in range(1, self.config.toc_size + 1)]
+        else:
+            chapter = int(parts[-1])
+            data = {"title": f"第{chapter}章", "content": _text(f"t{book_id}.{chapter}", self.config.chapter_chars)}
+        return "application/json", json.dumps({"code": 0, "data": data}, ensure_ascii=False)
+
+    def source(self, path: str, query: dict) -> tuple[str, str]:
+        layout = path.removeprefix("/source/").removesuffix(".json")
+        return "application/json", json.dumps(make_source(self.base_url, layout), ensure_ascii=False)
+
+    def route(self, path: str, query: dict) -> tuple[int, str, str]:
+        for prefix, handler in self.routes:
+            if path.startswith(prefix):
+                try:
+                    return 200, *handler(path, query)
+                except (ValueError, IndexError):
+                    return 400, "text/plain", "bad request"
+        return 404, "text/plain", "not found"
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                lines = head.decode("latin-1").split("\r\n")
+                method, target, _ = lines[0].split(" ", 2)
+                headers = {k.strip().lower(): v.strip() for k, v in (line.split(":", 1) for line in lines[1:] if line)}
+                if length := int(headers.get("content-length", 0)):
+                    await reader.readexactly(length)
+
+                if (delay := self.config.sample_latency(self.rng)) > 0:
+                    await asyncio.sleep(delay)
+                if self.rng.random() < self.config.drop_rate:
+                    break
+
+                url = urlsplit(target)
+                query = {k: v[0] for k, v in parse_qs(url.query).items()}
+                if self.rng.random() < self.config.error_rate:
+                    status, content_type, body = 500, "text/plain", "internal error"
+                else:
+                    status, content_type, body = self.route(unquote(url.path), query)
+                data = body.encode("utf-8")
+                keep_alive = headers.get("connection", "").lower() != "close"
+                writer.write(f"HTTP/1.1 {status} X\r\nContent-Type: {content_type}\r\n"
+                             f"Content-Length: {len(data)}\r\n"
+                             f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> asyncio.Server:
+        server = await asyncio.start_server(self.handle, host, port, backlog=4096)
+        host, port = server.sockets[0].getsockname()[:2]
+        self.base_url = f"http://{host}:{port}"
+        return server
+
+
+def make_source(base_url: str, layout: str) -> dict:
+    """
+    The book source of a layout of the site.
+    """
+    if layout == "html":
+        return {
+            "bookSourceName": "合成书站(html)", "bookSourceUrl": f"{base_url}#html", "bookSourceGroup": "合成",
+            "enabled": True, "searchUrl": "/html/search?key={{key}}&page={{page}}",
+            "ruleSearch": {"bookList": "class.result-item", "name": "class.title@text", "bookUrl": "class.title@href",
+                           "author": "class.author@text", "kind": "class.kind@text",
+                           "wordCount": "class.words@text", "intro": "class.intro@text",
+                           "lastChapter": "class.last@text"},
+            "ruleBookInfo": {"name": "id.info@tag.h1@text", "author": "id.info@class.author@text",
+                             "kind": "id.info@class.kind@text", "wordCount": "id.info@class.words@text",
+                             "lastChapter": "id.info@class.last@tag.a@text", "intro": "id.intro@text",
+                             "tocUrl": "id.info@class.toc@href"},
+            "ruleToc": {"chapterList": "id.list@tag.dd@tag.a", "chapterName": "text", "chapterUrl": "href"},
+            "ruleContent": {"content": "id.content@html"},
+        }
+    if layout == "json":
+        return {
+            "bookSourceName": "合成书站(json)", "bookSourceUrl": f"{base_url}#json", "bookSourceGroup": "合成",
+            "enabled": True, "searchUrl": "/json/search?key={{key}}&page={{page}}",
+            "ruleSearch": {"bookList": "$.data.list[*]", "name": "$.name", "author": "$.author", "kind": "$.kind",
+                           "wordCount": "$.word_count", "intro": "$.intro", "lastChapter": "$.last_chapter",
+                           "bookUrl": "/json/book/{{$.id}}"},
+            "ruleBookInfo": {"init": "$.data", "name": "$.name", "author": "$.author", "kind": "$.kind",
+                             "wordCount": "$.word_count", "intro": "$.intro", "lastChapter": "$.last_chapter",
+                             "tocUrl": "$.tocUrl"},
+            "ruleToc": {"chapterList": "$.data[*]", "chapterName": "$.title", "chapterUrl": "$.url"},
+            "ruleContent": {"content": "$.data.content"},
+        }
+    raise ValueError(f"Unknown layout: {layout}")
+
+
+def add_config_arguments(arg_parser: argparse.ArgumentParser):
+    arg_parser.add_argument("--results-per-page", type=int, default=20)
+    arg_parser.add_argument("--toc-size", type=int, default=500)
+    arg_parser.add_argument("--chapter-chars", type=int, default=3000)
+    arg_parser.add_argument("--padding", type=int, default=0, help="Extra bytes on every html page.")
+    arg_parser.add_argument("--latency", type=float, default=0.0, help="The mean latency in seconds.")
+    arg_parser.add_argument("--latency-dist", default="fixed", choices=["fixed", "uniform", "exp", "lognormal"])
+    arg_parser.add_argument("--error-rate", type=float, default=0.0)
+    arg_parser.add_argument("--drop-rate", type=float, default=0.0)
+    arg_parser.add_argument("--seed", type=int, default=0)
+
+
+def config_from_args(args) -> SiteConfig:
+    return SiteConfig(results_per_page=args.results_per_page, toc_size=args.toc_size,
+                      chapter_chars=args.chapter_chars, padding=args.padding, latency=args.latency,
+                      latency_dist=args.latency_dist, error_rate=args.error_rate, drop_rate=args.drop_rate,
+                      seed=args.seed)
+
+
+async def serve(config: SiteConfig, host: str, port: int):
+    site = Site(config)
+    server = await site.start(host, port)
+    print(f"Serving on {site.base_url}, the sources are {site.base_url}/source/html.json "
+          f"and {site.base_url}/source/json.json")
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    arg_parser.add_argument("--host", default="127.0.0.1")
+    arg_parser.add_argument("--port", type=int, default=8808)
+    add_config_arguments(arg_parser)
+    args = arg_parser.parse_args()
+    try:
+        asyncio.run(serve(config_from_args(args), args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
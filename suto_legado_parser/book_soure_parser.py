@@ -25,14 +25,25 @@
 """
 import json
 import logging
-from typing import Generator
+import re
+from contextlib import contextmanager
+from dataclasses import dataclass, fields
+from typing import Any, Callable, ClassVar, Generator, Literal
 from urllib.parse import quote
 
 import httpx
 from pydantic import BaseModel
 
+from suto_legado_parser import chapters as chapter_store, health, index
+from suto_legado_parser.rule import adaptive, watchdog
 from suto_legado_parser.rule.compile import rule_compile
-from suto_legado_parser.utils.network import request
+from suto_legado_parser.rule.plan import ExtractionPlan, FieldSpec
+from suto_legado_parser.rule.rules import RegexRule
+from suto_legado_parser.rule.template import UrlTemplate, parse_url_options
+from suto_legado_parser.utils import metrics
+from suto_legado_parser.utils.network import DEFAULT_MAX_BODY_SIZE, SourceClient, request, use_transport
+from suto_legado_parser.utils.text import html_to_text
+from suto_legado_parser.utils.trace import Tracer
 
 
 class BookInfo(BaseModel):
@@ -50,6 +61,59 @@ class BookDetail(BookInfo):
     toc_url: str = "https://example.com"
 
 
+@dataclass(slots=True)
+class BookInfoRecord:
+    """
+    A lightweight `BookInfo` with the same fields, it is returned by `Parser(result_mode="record")`.
+    Use `to_model()` to get the pydantic model at the API boundary.
+    """
+    model: ClassVar[type[BookInfo]] = BookInfo
+
+    name: str = "Unknown"
+    author: str = "Unknown"
+    word_count: int = 0
+    book_url: str = "https://example.com"
+    cover_url: str = "https://example.com"
+    intro: str = "Nothing"
+    kind: str = "Unknown"
+    last_chapter: str = "Unknown"
+
+    def to_dict(self) -> dict:
+        return {f.name: getattr(self, f.name) for f in fields(self)}
+
+    def to_model(self) -> BookInfo:
+        return self.model(**self.to_dict())
+
+    @classmethod
+    def from_model(cls, model: BookInfo):
+        return cls(**{f.name: getattr(model, f.name) for f in fields(cls) if hasattr(model, f.name)})
+
+    def validate(self):
+        """
+        Check the types of the fields, it is much cheaper than building the model.
+        """
+        for f in fields(self):
+            value = getattr(self, f.name)
+            if not isinstance(value, f.type):
+                raise ValueError(f"Invalid {f.name} of {self.__class__.__name__}: {value!r}")
+        return self
+
+
+@dataclass(slots=True)
+class BookDetailRecord(BookInfoRecord):
+    """
+    A lightweight `BookDetail`, see `BookInfoRecord`.
+    """
+    model: ClassVar[type[BookInfo]] = BookDetail
+
+    toc_url: str = "https://example.com"
+
+
+class Chapter(BaseModel):
+    name: str = "Unknown"
+    url: str = ""
+
+
 class ProcessedUrl(BaseModel):
     url: str
     decode: str = 'utf-8'
@@ -58,33 +122,41 @@ class ProcessedUrl(BaseModel):
     headers: dict = {}
 
 
+# The options follow the url after a comma, e.g. `https://example.com/s, {"method": "POST"}`.
+_OPTIONS_CUT = re.compile(r"\s*,\s*(?=\{)")
+
+
 def url_process(url: str) -> ProcessedUrl:
     # Process the options
     # example:
     #   https://example.com, {"encode": "utf-8", "method": "post", "body": "key={{key}}"}
     options = {}
-    cut = url.find(",")  # Find the cut point
-    if cut != -1:
-        options_json: str = url[cut + 1:]  # Extract the options
-        url = url[:cut]  # Cut the options
-
-        # The function of next sentence is similar as json.loads(options_json)
-        options = eval(options_json.replace("true", "True").replace("false", "False"))  # Parse the options
-        # Explanation:
-        # The json of the options should be like this:
-        #   {"encode": "utf-8", "method": "post", "body": "key={{key}}"}
-        # But sometimes it may not be a json and like the dict of the python:
-        #   {'encode': 'utf-8', 'method': 'post', 'body': 'key={{key}}'}
-        # So we use eval to parse it
+    if cut := _OPTIONS_CUT.search(url):
+        # It is usually json, but sometimes like a python dict, see `parse_url_options`.
+        options = parse_url_options(url[cut.end():])
+        url = url[:cut.start()]
 
     decode = options.get("decode", None) or options.get("charset", 'utf-8')
     method = options.get("method", 'get')
     body = options.get("body", '')
-    headers = options.get("headers", {})
+    headers = dict(options.get("headers") or {})
 
     return ProcessedUrl(url=url.strip(), decode=decode, method=method, body=body, headers=headers)
 
 
+def as_list(result) -> list:
+    """
+    Turn the result of a list rule into a list, a rule which matches only one item doesn't return a json list.
+    """
+    if isinstance(result, list):
+        return result
+    try:
+        loaded = json.loads(result)
+    except (ValueError, TypeError):
+        return [result]
+    return loaded if isinstance(loaded, list) else [result]
+
+
 def word_count_process(word_count: str | int) -> int:
     if isinstance(word_count, int):
         return word_count
@@ -104,118 +176,257 @@ class Parser:
     The parser of the book source.
     """
 
-    def __init__(self, source_json: dict):
+    def __init__(self, source_json: dict, *, result_mode: Literal["model", "record"] = "model",
+                 trusted: bool = False, transport: httpx.BaseTransport | None = None, proxy: str | None = None,
+                 max_body_size: int = DEFAULT_MAX_BODY_SIZE, js_limits: watchdog.JsLimits | None = None):
+        """
+        :param source_json: The book source.
+        :param result_mode: "model" returns the pydantic models, "record" returns the slotted records,
+                            which are much cheaper to build.
+        :param trusted: Skip the type check of the records. Only used in the "record" mode.
+        :param transport: The transport of all requests of the source, including the ones made by the JS of the
+                          rules. e.g. `RecordingTransport` and `ReplayTransport` in `utils.replay`.
+                          Without it, the requests use the shared client pool, see `utils.network.ClientPool`.
+        :param proxy: The proxy of the requests of the source.
+        :param max_body_size: The maximum size of a response body, a larger one raises `ResponseTooLarge`.
+        :param js_limits: The time and memory limits of the JS of the source, None keeps the default ones,
+                          see `rule.watchdog`.
+        """
         self.j = source_json
+        self.transport = transport
+        self.js_limits = js_limits
+        self.result_mode = result_mode
+        self.trusted = trusted
         raw_burl: str = self.j.get("bookSourceUrl")
         if (point := raw_burl.find("#")) != -1:
             raw_burl = raw_burl[:point]
         self.base_url: str = raw_burl
         self.search_url = self.j.get("searchUrl")
+        self.search_template = UrlTemplate(self.search_url) if self.search_url else None
         self.rule_search = self.j.get("ruleSearch")
         self.rule_book_info = self.j.get("ruleBookInfo")
+        self.rule_toc = self.j.get("ruleToc") or {}
+        self.rule_content = self.j.get("ruleContent") or {}
+        replace_regex = self.rule_content.get("replaceRegex")
+        self.content_replace = RegexRule(replace_regex.removeprefix("##")) if replace_regex else None
+        self.search_plan = self._build_search_plan(self.rule_search or {})
+        self.book_info_plan = self._build_book_info_plan(self.rule_book_info or {})
+        self.toc_plan = self._build_toc_plan(self.rule_toc)
 
         self.headers = self.j.get("header", "{}") or "{}"
 
         self.headers = self.headers if isinstance(self.headers, dict) else json.loads(self.headers)
-        self.client = httpx.Client(base_url=self.base_url,headers=self.headers)
+        self.client = SourceClient(self.base_url, self.headers, transport=transport, proxy=proxy,
+                                   max_body_size=max_body_size)
         self.logger = logging.getLogger(self.__class__.__name__)
-
-    def search(self, title: str) -> Generator[BookInfo, None, None]:
-        self.logger.info(f"Searching for {title}")
+        self.tracer = Tracer(self.__class__.__name__)
+
+    @staticmethod
+    def _build_search_plan(rule_search: dict) -> ExtractionPlan:
+        return ExtractionPlan([
+            FieldSpec(name="author", rule=rule_search.get("author"), allow_str_rule=False, default="Unknown"),
+            FieldSpec(name="name", rule=rule_search.get("name"), allow_str_rule=False),
+            FieldSpec(name="word_count", rule=rule_search.get("wordCount"), allow_str_rule=False, default="0",
+                      callback=word_count_process),
+            FieldSpec(name="book_url", rule=rule_search.get("bookUrl")),
+            FieldSpec(name="cover_url", rule=rule_search.get("coverUrl"), allow_str_rule=False, default=""),
+            FieldSpec(name="intro", rule=rule_search.get("intro"), allow_str_rule=False, default="No description"),
+            FieldSpec(name="kind", rule=rule_search.get("kind"), default="Unclassified"),
+            FieldSpec(name="last_chapter", rule=rule_search.get("lastChapter"), default="Unknown"),
+        ])
+
+    @staticmethod
+    def _build_book_info_plan(rule_book_info: dict) -> ExtractionPlan:
+        return ExtractionPlan([
+            FieldSpec(name="name", rule=rule_book_info.get("name")),
+            FieldSpec(name="author", rule=rule_book_info.get("author")),
+            FieldSpec(name="cover_url", rule=rule_book_info.get("coverUrl")),
+            FieldSpec(name="intro", rule=rule_book_info.get("intro")),
+            FieldSpec(name="kind", rule=rule_book_info.get("kind")),
+            FieldSpec(name="last_chapter", rule=rule_book_info.get("lastChapter")),
+            FieldSpec(name="toc_url", rule=rule_book_info.get("tocUrl")),
+            FieldSpec(name="word_count", rule=rule_book_info.get("wordCount"), default="0",
+                      callback=word_count_process),
+        ])
+
+    @staticmethod
+    def _build_toc_plan(rule_toc: dict) -> ExtractionPlan:
+        return ExtractionPlan([
+            FieldSpec(name="name", rule=rule_toc.get("chapterName"), default="Unknown"),
+            FieldSpec(name="url", rule=rule_toc.get("chapterUrl"), default=""),
+        ])
+
+    def search(self, title: str) -> Generator[BookInfo | BookInfoRecord, None, None]:
+        yield from self._search(title, lambda values: self._make_result(BookInfoRecord, values))
+
+    def search_raw(self, title: str) -> Generator[dict, None, None]:
+        """
+        Search, but yield the fields of each book as a plain dict without building any result object.
+        """
+        yield from self._search(title, lambda values: values)
+
+    def search_columns(self, title: str, batch_size: int = 1024) -> Generator[dict[str, list], None, None]:
+        """
+        Search, but yield the results in columnar batches, see `batch_columns`.
+        """
+        from suto_legado_parser.columns import batch_columns
+
+        yield from batch_columns(self.search_raw(title), batch_size)
+
+    def _search(self, title: str, build: Callable[[dict], Any]) -> Generator[Any, None, None]:
+        self.logger.info("Searching for %s", title)
         var = {"_book_source": self.j,
                "key": quote(title),
                "page": 1}  # Define the var #todo: page
 
-        compiled_url: str = rule_compile(self.search_url, var)  # Compile the url
-        self.logger.debug(f"Compiled url: {compiled_url}")
-
-        p_url = url_process(compiled_url)
-        self.logger.debug(f"Processed url: {p_url}")
-
-        search_result = request(self.client, **(p_url.dict()), allow_redirects=True)
-        self.logger.debug(f"Search result: {search_result}")
-        # `rule_compile` will return a string of list in this case.
-        books = json.loads(
-            rule_compile(self.rule_search.get("bookList"), {"_book_source": self.j, "result": search_result.strip()},
-                         allow_str_rule=False))
-        self.logger.debug(f"Books: {books}")
+        with self._context("search"), health.track(self.j.get("bookSourceUrl"), "search") as tracked:
+            compiled_url: str = self.search_template.render(var)  # Compile the url
+            self.tracer("compiled url", url=compiled_url)
+
+            p_url = url_process(compiled_url)
+            self.tracer("processed url", url=p_url)
+
+            search_result = request(self.client, **(p_url.dict()), allow_redirects=True)
+            self.tracer("search result", result=search_result)
+            # `rule_compile` will return a string of list in this case.
+            books = json.loads(
+                rule_compile(self.rule_search.get("bookList"),
+                             {"_book_source": self.j, "result": search_result.strip()},
+                             allow_str_rule=False))
+            self.tracer("books", count=len(books))
+            tracked.results = len(books)
+
+        seen = [] if index.get_index() is not None else None
+        try:
+            for book in books:
+                try:
+                    # All fields of the book are extracted in one pass, see `ExtractionPlan`.
+                    with self._context("search"):
+                        record = self.search_plan.extract(book)
+                    if self.tracer.enabled:
+                        self.tracer("book", **record)
+                    result = build(record)
+                except Exception as e:
+                    self.logger.exception(e)
+                    continue
+                if seen is not None:
+                    seen.append(result)
+                yield result
+        finally:
+            if seen:  # Indexed in one transaction, also when the caller stops early.
+                index.record(self.j.get("bookSourceUrl"), seen)
+
+    @contextmanager
+    def _context(self, stage: str):
+        source = self.j.get("bookSourceUrl")
+        with (metrics.labels(source=source, stage=stage), use_transport(self.transport), adaptive.scope(source),
+              watchdog.limits(self.js_limits)):
+            yield
+
+    def _make_result(self, record_class: type[BookInfoRecord], values: dict) -> BookInfo | BookInfoRecord:
+        if self.result_mode == "record":
+            record = record_class(**values)
+            return record if self.trusted else record.validate()
+        return record_class.model(**values)
+
+    def get_detail(self, book_info: BookInfo | BookInfoRecord) -> BookDetail | BookDetailRecord:
+        book_url = book_info.book_url
+        var = {"_book_source": self.j}
+        self.logger.info("Getting detail of %s", book_url)
+        with self._context("detail"), health.track(self.j.get("bookSourceUrl"), "detail") as tracked:
+            p_url = url_process(book_url)
+            self.tracer("processed url", url=p_url)
+
+            raw_content = request(self.client, **(p_url.dict()), allow_redirects=True)
+            self.tracer("raw content", content=raw_content)
+
+            init = rule_compile(self.rule_book_info.get("init"), {**var, "result": raw_content},
+                                allow_str_rule=False, default=raw_content)
+            self.tracer("init", result=init)
+
+            detail = self.book_info_plan.extract(init, var)
+            detail["book_url"] = book_url
+            detail = {k: v for k, v in detail.items() if v}
+            tracked.results = len(detail) - 1  # Not counting the book url.
+            detail.setdefault("toc_url", book_url)  # Without a toc url, the toc is on the page of the book.
+            info = book_info.to_dict() if isinstance(book_info, BookInfoRecord) else book_info.dict()
+            info.update(detail)
+            if self.tracer.enabled:
+                self.tracer("detail", **info)
+            result = self._make_result(BookDetailRecord, info)
+        index.record(self.j.get("bookSourceUrl"), [result])
+        return result
+
+    def get_toc(self, book_detail: BookDetail | BookDetailRecord) -> list[Chapter]:
+        """
+        Get the chapters of the book, following `nextTocUrl` if the toc has several pages.
+        """
+        self.logger.info("Getting toc of %s", book_detail.toc_url)
+        return [chapter for _, chapters in self.iter_toc_pages(book_detail.toc_url) for chapter in chapters]
+
+    def iter_toc_pages(self, url: str) -> Generator[tuple[str, list[Chapter]], None, None]:
+        """
+        Get the pages of the toc from `url` on, so a refresh can start from the last page it knows.
+        :return: The url and the chapters of every page.
+        """
+        seen = set()
+        while url and url not in seen:
+            seen.add(url)
+            # The page is got inside the context and yielded outside of it, the caller runs in its own one.
+            with self._context("toc"):
+                chapters, next_url = self._toc_page(url)
+            yield url, chapters
+            url = next_url
+
+    def _toc_page(self, url: str) -> tuple[list[Chapter], str]:
+        """
+        :return: The chapters of the toc page, and the url of the next page, "" on the last page.
+        """
+        var = {"_book_source": self.j}
+        p_url = url_process(url)
+        raw_content = request(self.client, **(p_url.dict()), allow_redirects=True)
+        self.tracer("toc page", url=url, content=raw_content)
 
-        for book in books:
+        items = as_list(rule_compile(self.rule_toc.get("chapterList"), {**var, "result": raw_content},
+                                     allow_str_rule=False, default="[]"))
+        chapters: list[Chapter] = []
+        for item in items:
             try:
-                self.logger.debug(f"Getting author.")
-                author = rule_compile(self.rule_search.get("author"), {"result": book}, allow_str_rule=False,
-                                      default="Unknown")
-
-                self.logger.debug(f"Getting name.")
-                name = rule_compile(self.rule_search.get("name"), {"result": book}, allow_str_rule=False)
-
-                self.logger.debug(f"Getting word count.")
-                word_count = rule_compile(self.rule_search.get("wordCount"), {"result": book}, allow_str_rule=False,
-                                          default="0", callback=word_count_process)
-
-                self.logger.debug(f"Getting book url.")
-                book_url = rule_compile(self.rule_search.get("bookUrl"), {"result": book})
-
-                self.logger.debug(f"Getting cover url.")
-                cover_url = rule_compile(self.rule_search.get("coverUrl"), {"result": book}, allow_str_rule=False,
-                                         default="")
-
-                self.logger.debug(f"Getting intro.")
-                intro = rule_compile(self.rule_search.get("intro"), {"result": book}, allow_str_rule=False,
-                                     default="No description")
-
-                self.logger.debug(f"Getting kind.")
-                kind = rule_compile(self.rule_search.get("kind"), {"result": book},default="Unclassified")
-
-                self.logger.debug(f"Getting last chapter.")
-                last_chapter = rule_compile(self.rule_search.get("lastChapter"), {"result": book},default="Unknown")
-
-                self.logger.debug(
-                    f"Book: name: {name}, author: {author}, word_count: {word_count}, book_url: {book_url}, "
-                    f"cover_url: {cover_url}, intro: {intro}, kind: {kind}, last_chapter: {last_chapter}")
-                yield BookInfo(name=name,
-                               author=author,
-                               word_count=word_count,
-                               book_url=book_url,
-                               cover_url=cover_url,
-                               intro=intro,
-                               kind=kind,
-                               last_chapter=last_chapter)
+                chapters.append(Chapter(**self.toc_plan.extract(item, var)))
             except Exception as e:
                 self.logger.exception(e)
-                continue
-
-    def get_detail(self, book_info: BookInfo) -> BookDetail:
-        book_url = book_info.book_url
+        # The selector of the next page matches nothing on the last page.
+        next_url = rule_compile(self.rule_toc.get("nextTocUrl"), {**var, "result": raw_content}, default="",
+                                empty="")
+        return chapters, next_url
+
+    def get_content(self, chapter: Chapter) -> str:
+        """
+        Get the text of the chapter, following `nextContentUrl` if the chapter has several pages.
+        """
         var = {"_book_source": self.j}
-        self.logger.info(f"Getting detail of {book_url}")
-
-        p_url = url_process(book_url)
-        self.logger.debug(f"Processed url: {p_url}")
-
-        raw_content = request(self.client, **(p_url.dict()), allow_redirects=True)
-        self.logger.debug(f"Raw content: {raw_content}")
-
-        init = rule_compile(self.rule_book_info.get("init"), {**var, "result": raw_content}, allow_str_rule=False,
-                            default=raw_content)
-        self.logger.debug(f"Init: {init}")
-
-        name = rule_compile(self.rule_book_info.get("name"), {**var, "result": init})
-        author = rule_compile(self.rule_book_info.get("author"), {**var, "result": init})
-        cover_url = rule_compile(self.rule_book_info.get("coverUrl"), {**var, "result": init})
-        intro = rule_compile(self.rule_book_info.get("intro"), {**var, "result": init})
-        kind = rule_compile(self.rule_book_info.get("kind"), {**var, "result": init})
-        last_chapter = rule_compile(self.rule_book_info.get("lastChapter"), {**var, "result": init})
-        toc_url = rule_compile(self.rule_book_info.get("tocUrl"), {**var, "result": init})
-        word_count = rule_compile(self.rule_book_info.get("wordCount"), {**var, "result": init}, default="0",
-                                  callback=word_count_process)
-        detail = {"name": name, "author": author, "word_count": word_count, "book_url": book_url,
-                  "cover_url": cover_url,
-                  "intro": intro, "kind": kind, "last_chapter": last_chapter, "toc_url": toc_url}
-        detail = {k: v for k, v in detail.items() if v}
-        info = book_info.copy(update=detail)
-        self.logger.debug(f"Detail: {info}")
-        return BookDetail(**info.dict())
+        if (content := chapter_store.load(self.j.get("bookSourceUrl"), chapter.url)) is not None:
+            return content
+        self.logger.info("Getting content of %s", chapter.url)
+        pages: list[str] = []
+        with self._context("content"):
+            url, seen = chapter.url, set()
+            while url and url not in seen:
+                seen.add(url)
+                p_url = url_process(url)
+                raw_content = request(self.client, **(p_url.dict()), allow_redirects=True)
+                self.tracer("content page", url=url, content=raw_content)
+
+                pages.append(html_to_text(rule_compile(self.rule_content.get("content"),
+                                                       {**var, "result": raw_content}, default=raw_content)))
+                url = rule_compile(self.rule_content.get("nextContentUrl"), {**var, "result": raw_content},
+                                   default="")
+
+            content = "\n".join(pages)
+            if self.content_replace is not None:
+                content = self.content_replace.compile({**var, "result": content})
+        chapter_store.record(self.j.get("bookSourceUrl"), chapter.url, content)
+        return content
 
     def get_book(self, book_url: str):
         self.logger.debug((self.client.get(book_url)).content)
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#  Copyright (C) 2024. Suto-Commune
+#  _
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#  _
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#  _
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+@File       : chapters.py
+
+@Author     : hsn
+
+@Date       : 2024/10/31 上午10:10
+
+A store of the chapter texts, addressed by the hash of the text, so the same chapter of many mirrors is kept once.
+"""
+import hashlib
+import logging
+import mmap
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from functools import lru_cache
+from pathlib import Path
+
+from suto_legado_parser.utils import metrics
+
+logger = logging.getLogger("suto_legado_parser.chapters")
+
+_store: "ChapterStore | None" = None
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS blobs (
+    hash TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    used_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS blobs_used_at ON blobs (used_at);
+CREATE TABLE IF NOT EXISTS chapters (
+    source TEXT NOT NULL,
+    url TEXT NOT NULL,
+    hash TEXT NOT NULL,
+    PRIMARY KEY (source, url)
+);
+CREATE INDEX IF NOT EXISTS chapters_hash ON chapters (hash);
+"""
+
+
+@lru_cache(maxsize=1)
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        logger.warning("zstandard is not installed, the chapter texts are compressed with zlib. "
+                       "Install the zstd extra for smaller and faster ones.")
+        return None
+    return zstandard
+
+
+def normalize(text: str) -> str:
+    """
+    The mirrors of a site differ in the spaces around the lines and the blank lines, not in the text.
+    """
+    return "\n".join(line for line in (line.strip() for line in text.splitlines()) if line)
+
+
+def digest(text: str) -> str:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=20).hexdigest()
+
+
+def compress(data: bytes, level: int = 6) -> bytes:
+    """
+    zstd if zstandard is installed, otherwise zlib. The first byte tells which one, so a store
+    written with zstd is still read after zstandard was removed, as a miss.
+    """
+    if (zstd := _zstd()) is not None:
+        return b"Z" + zstd.ZstdCompressor(level=level).compress(data)
+    return b"z" + zlib.compress(data, level)
+
+
+def decompress(data: bytes | memoryview | mmap.mmap) -> bytes:
+    match data[:1]:
+        case b"z":
+            return zlib.decompress(memoryview(data)[1:])
+        case b"Z" if (zstd := _zstd()) is not None:
+            return zstd.ZstdDecompressor().decompress(memoryview(data)[1:])
+        case codec:
+            raise ValueError(f"unknown chapter codec: {codec!r}")
+
+
+class ChapterStore:
+    """
+    The texts are compressed files named by their hash, read with mmap.
+    An SQLite index maps (source, chapter url) to the hash and keeps when each text was last used,
+    the least recently used texts are removed when they take more than `max_bytes`.
+    :param path: The directory of the store.
+    """
+
+    def __init__(self, path: str | Path, *, max_bytes: int = 1 << 30, level: int = 6):
+        self.path = Path(path)
+        self.objects = self.path / "objects"
+        self.objects.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.level = level
+        self.connection = sqlite3.connect(str(self.path / "index.db"), check_same_thread=False,
+                                          isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(_SCHEMA)
+        self.bytes = self.connection.execute("SELECT coalesce(sum(size), 0) FROM blobs").fetchone()[0]
+        self._lock = threading.Lock()
+
+    def _blob_path(self, hash_: str) -> Path:
+        return self.objects / hash_[:2] / hash_[2:]
+
+    def _read(self, hash_: str) -> str:
+        with open(self._blob_path(hash_), "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            return decompress(m).decode("utf-8")
+
+    def get(self, source: str, url: str) -> str | None:
+        """
+        :return: The text of the chapter, None if it isn't stored.
+        """
+        with self._lock:
+            row = self.connection.execute("SELECT hash FROM chapters WHERE source = ? AND url = ?",
+                                          (source, url)).fetchone()
+        if row is None:
+            metrics.observe("chapters.miss", 1)
+            return None
+        try:
+            text = self._read(row[0])
+        except (OSError, ValueError, zlib.error) as e:  # Removed by hand, or written with zstd.
+            logger.debug("Failed to read the chapter %s of %s: %s", url, source, e)
+            self._forget(row[0])
+            metrics.observe("chapters.miss", 1)
+            return None
+        with self._lock:
+            self.connection.execute("UPDATE blobs SET used_at = ? WHERE hash = ?", (time.time(), row[0]))
+        metrics.observe("chapters.hit", 1)
+        return text
+
+    def _forget(self, hash_: str):
+        """
+        Remove a text which can't be read, and the chapters of it, so the next put writes it again.
+        """
+        with self._lock:
+            self.connection.execute("BEGIN")
+            self.connection.execute("DELETE FROM chapters WHERE hash = ?", (hash_,))
+            if (row := self.connection.execute("SELECT size FROM blobs WHERE hash = ?", (hash_,)).fetchone()):
+                self.connection.execute("DELETE FROM blobs WHERE hash = ?", (hash_,))
+                self.bytes -= row[0]
+            self.connection.execute("COMMIT")
+            self._blob_path(hash_).unlink(missing_ok=True)  # Under the lock, a put may write it again.
+
+    def put(self, source: str, url: str, text: str) -> str:
+        """
+        Store the text of the chapter as it is. The mirrors which differ only in the spaces and the
+        blank lines share it, see `normalize`: the text of the first one is kept.
+        :return: The hash of the normalized text.
+        """
+        hash_ = digest(normalize(text))
+        with self._lock:
+            if self._link(source, url, hash_):
+                return hash_
+        # Compressed and written outside of the lock, only renamed under it.
+        data = compress(text.encode("utf-8"), self.level)
+        path = self._blob_path(hash_)
+        path.parent.mkdir(exist_ok=True)
+        tmp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            tmp.write_bytes(data)
+            with self._lock:
+                if self._link(source, url, hash_):  # Stored by another thread meanwhile.
+                    return hash_
+                os.replace(tmp, path)
+                self.connection.execute("INSERT INTO blobs (hash, size, used_at) VALUES (?, ?, ?)",
+                                        (hash_, len(data), time.time()))
+                self.bytes += len(data)
+                metrics.observe("chapters.stored.bytes", len(data))
+                self._insert_chapter(source, url, hash_)
+                if self.bytes > self.max_bytes:
+                    self._evict()
+        finally:
+            tmp.unlink(missing_ok=True)
+        return hash_
+
+    def _link(self, source: str, url: str, hash_: str) -> bool:
+        """
+        Point the chapter to the text if it is stored. The caller holds the lock.
+        :return: Whether the text is stored.
+        """
+        if self.connection.execute("UPDATE blobs SET used_at = ? WHERE hash = ?", (time.time(), hash_)).rowcount == 0:
+            return False
+        metrics.observe("chapters.deduplicated", 1)
+        self._insert_chapter(source, url, hash_)
+        return True
+
+    def _insert_chapter(self, source: str, url: str, hash_: str):
+        self.connection.execute("INSERT INTO chapters (source, url, hash) VALUES (?, ?, ?) "
+                                "ON CONFLICT (source, url) DO UPDATE SET hash = excluded.hash", (source, url, hash_))
+
+    def _evict(self):
+        """
+        Remove the least recently used texts, down to 90% of the budget so it isn't done on every put.
+        """
+        target = self.max_bytes * 0.9
+        removed = []
+        for hash_, size in self.connection.execute("SELECT hash, size FROM blobs ORDER BY used_at"):
+            if self.bytes <= target:
+                break
+            removed.append((hash_,))
+            self.bytes -= size
+        self.connection.execute("BEGIN")
+        self.connection.executemany("DELETE FROM chapters WHERE hash = ?", removed)
+        self.connection.executemany("DELETE FROM blobs WHERE hash = ?", removed)
+        self.connection.execute("COMMIT")
+        for hash_, in removed:
+            self._blob_path(hash_).unlink(missing_ok=True)
+        metrics.observe("chapters.evicted", len(removed))
+
+    def stats(self) -> dict:
+        with self._lock:
+            blobs = self.connection.execute("SELECT count(*) FROM blobs").fetchone()[0]
+            chapters = self.connection.execute("SELECT count(*) FROM chapters").fetchone()[0]
+        return {"chapters": chapters, "texts": blobs, "bytes": self.bytes, "max_bytes": self.max_bytes}
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
+
+
+def set_store(store: ChapterStore | None):
+    """
+    Set the process-wide store which `Parser.get_content` reads and fills, None disables it.
+    """
+    global _store
+    _store = store
+
+
+def get_store() -> ChapterStore | None:
+    return _store
+
+
+def load(source: str, url: str) -> str | None:
+    """
+    The stored text of the chapter, None without a store or if it isn't stored. It never raises.
+    """
+    if (store := _store) is None:
+        return None
+    try:
+        return store.get(source, url)
+    except Exception:
+        logger.exception("Failed to load the chapter %s of %s", url, source)
+        return None
+
+
+def record(source: str, url: str, text: str):
+    """
+    Store the text of the chapter. It does nothing without a store, and never raises.
+    """
+    if (store := _store) is None or not text:
+        return
+    try:
+        store.put(source, url, text)
+    except Exception:
+        logger.exception("Failed to store the chapter %s of %s", url, source)
@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#  Copyright (C) 2024. Suto-Commune
+#  _
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#  _
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#  _
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+@File       : checker.py
+
+@Author     : hsn
+
+@Date       : 2024/10/28 下午2:15
+
+Check which sources of a collection work: search -> detail -> toc -> first chapter, many sources at a time.
+"""
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from typing import Callable, Generator, Iterable
+from urllib.parse import urlsplit
+
+import httpx
+
+from suto_legado_parser.book_soure_parser import Parser
+from suto_legado_parser.utils import network
+
+STAGES = ("search", "detail", "toc", "content")
+
+
+@dataclass(slots=True)
+class StageResult:
+    stage: str
+    ok: bool
+    seconds: float
+    # How many books, fields, chapters or characters the stage got.
+    count: int = 0
+    error: str = ""
+
+
+@dataclass(slots=True)
+class SourceReport:
+    source: dict
+    stages: list[StageResult] = field(default_factory=list)
+
+    @property
+    def url(self) -> str:
+        return self.source.get("bookSourceUrl", "")
+
+    @property
+    def ok(self) -> bool:
+        return len(self.stages) == len(STAGES) and all(s.ok for s in self.stages)
+
+    def passed(self, stage: str) -> bool:
+        return any(s.stage == stage and s.ok for s in self.stages)
+
+    def to_dict(self) -> dict:
+        return {"source": self.url, "name": self.source.get("bookSourceName", ""), "ok": self.ok,
+                "stages": [{"stage": s.stage, "ok": s.ok, "seconds": round(s.seconds, 4), "count": s.count,
+                            **({"error": s.error} if s.error else {})} for s in self.stages]}
+
+
+def check_source(source: dict, query: str, timeout: float = 60.0) -> SourceReport:
+    """
+    Run the stages one after another, until one fails or the source takes more than `timeout` seconds.
+    Every request gets the time left as its timeout, at most the one of the client pool, see
+    `utils.network.deadline`, so a stage of many requests, e.g. a toc of many pages, stops at the timeout too.
+    It never raises, a failure is reported in the stage.
+    """
+    report = SourceReport(source)
+    deadline = time.monotonic() + timeout
+    state = {}
+
+    def search():
+        parser = state["parser"] = Parser(source)
+        books = state["books"] = list(parser.search(query))
+        return len(books)
+
+    def detail():
+        detail = state["detail"] = state["parser"].get_detail(state["books"][0])
+        return sum(1 for v in detail.dict().values() if v)
+
+    def toc():
+        chapters = state["toc"] = state["parser"].get_toc(state["detail"])
+        return len(chapters)
+
+    def content():
+        return len(state["parser"].get_content(state["toc"][0]))
+
+    stages: dict[str, Callable[[], int]] = {"search": search, "detail": detail, "toc": toc, "content": content}
+    for stage in STAGES:
+        if time.monotonic() > deadline:
+            report.stages.append(StageResult(stage, False, 0.0, error=f"timeout after {timeout:g}s"))
+            break
+        start = time.perf_counter()
+        try:
+            with network.deadline(deadline - time.monotonic()):
+                count = stages[stage]()
+            error = "" if count else "nothing found"
+        except httpx.TimeoutException as e:
+            count, error = 0, f"timeout after {timeout:g}s" if time.monotonic() > deadline else f"TimeoutException: {e}"
+        except Exception as e:
+            count, error = 0, f"{type(e).__name__}: {e}"
+        report.stages.append(StageResult(stage, not error, time.perf_counter() - start, count, error))
+        if error:
+            break
+    return report
+
+
+def _host(source: dict) -> str:
+    return urlsplit(source.get("bookSourceUrl", "")).netloc
+
+
+def check_sources(sources: Iterable[dict], query: str, *, workers: int = 32, per_host: int = 4,
+                  timeout: float = 60.0) -> Generator[SourceReport, None, None]:
+    """
+    Check the sources concurrently, with at most `per_host` of them on the same host at a time,
+    so a site with many mirrors in the collection isn't flooded.
+    :return: The reports, in the order the sources complete.
+    """
+    sources = iter(sources)
+    waiting: deque[dict] = deque()  # The sources whose host is busy.
+    running: dict[str, int] = {}
+    pending = {}
+
+    def next_source() -> dict | None:
+        for _ in range(len(waiting)):
+            source = waiting.popleft()
+            if running.get(_host(source), 0) < per_host:
+                return source
+            waiting.append(source)
+        # Don't read the whole collection ahead when one host blocks, a catalog may be huge.
+        while len(waiting) < workers * 4 and (source := next(sources, None)) is not None:
+            if running.get(_host(source), 0) < per_host:
+                return source
+            waiting.append(source)
+        return None
+
+    with ThreadPoolExecutor(workers) as executor:
+        while True:
+            while len(pending) < workers and (source := next_source()) is not None:
+                host = _host(source)
+                running[host] = running.get(host, 0) + 1
+                pending[executor.submit(check_source, source, query, timeout)] = host
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                running[pending.pop(future)] -= 1
+                yield future.result()
+
+
+def summarize(reports: Iterable[SourceReport]) -> dict[str, dict]:
+    """
+    :return: The number of sources which reached and passed every stage, and the median latency of the passes.
+    """
+    summary = {stage: {"tried": 0, "passed": 0, "seconds": []} for stage in STAGES}
+    for report in reports:
+        for s in report.stages:
+            summary[s.stage]["tried"] += 1
+            if s.ok:
+                summary[s.stage]["passed"] += 1
+                summary[s.stage]["seconds"].append(s.seconds)
+    for stage in summary.values():
+        seconds = sorted(stage.pop("seconds"))
+        stage["p50"] = round(seconds[len(seconds) // 2], 4) if seconds else 0.0
+    return summary
@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#  Copyright (C) 2024. Suto-Commune
+#  _
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#  _
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#  _
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+@File       : cli.py
+
+@Author     : hsn
+
+@Date       : 2024/10/20 上午10:05
+"""
+import argparse
+import asyncio
+import json
+import logging
+import sys
+from concurrent.futures import FIRST_COMPLETED, Executor, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterable, TextIO
+
+from suto_legado_parser import chapters, health, index as book_index
+from suto_legado_parser.book_soure_parser import Parser
+from suto_legado_parser.rule import adaptive, watchdog
+
+# The parsers of the current worker, a process worker keeps its own.
+_parsers: dict[str, Parser] = {}
+
+
+def _get_parser(source: dict) -> Parser:
+    key = source.get("bookSourceUrl", "")
+    if (parser := _parsers.get(key)) is None:
+        parser = _parsers[key] = Parser(source)
+    return parser
+
+
+def search_job(source: dict, query: str, detail: bool = False, toc: bool = False,
+               limit: int | None = None) -> list[dict]:
+    """
+    Search one query in one source, and get the details and the tocs of the books.
+    It never raises, a failure is reported as an `error` line.
+    :return: The NDJSON lines of the job.
+    """
+    head = {"source": source.get("bookSourceUrl", ""), "query": query}
+    lines = []
+    try:
+        parser = _get_parser(source)
+        for i, book in enumerate(parser.search(query)):
+            if limit is not None and i >= limit:
+                break
+            line = {**head, "book": book.dict()}
+            try:
+                if detail or toc:
+                    book_detail = parser.get_detail(book)
+                    line["detail"] = book_detail.dict()
+                    if toc:
+                        line["toc"] = [chapter.dict() for chapter in parser.get_toc(book_detail)]
+            except Exception as e:
+                line["error"] = f"{type(e).__name__}: {e}"
+            lines.append(line)
+    except Exception as e:
+        lines.append({**head, "error": f"{type(e).__name__}: {e}"})
+    return lines
+
+
+class Checkpoint:
+    """
+    The jobs which are done, one json line per job, so an interrupted run can be resumed.
+    """
+
+    def __init__(self, path: str | Path | None):
+        self.path = Path(path) if path else None
+        self.done: set[tuple[str, str]] = set()
+        if self.path and self.path.exists():
+            for line in self.path.read_text(encoding="utf-8").splitlines():
+                try:
+                    j = json.loads(line)
+                except ValueError:  # The last line of a killed run may be cut.
+                    continue
+                self.done.add((j["source"], j["query"]))
+        self.file = self.path.open("a", encoding="utf-8") if self.path else None
+
+    def __contains__(self, job: tuple[str, str]):
+        return job in self.done
+
+    def add(self, source: str, query: str):
+        self.done.add((source, query))
+        if self.file:
+            self.file.write(json.dumps({"source": source, "query": query}, ensure_ascii=False) + "\n")
+            self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+
+def _emit(out: TextIO, checkpoint: Checkpoint, job: tuple[dict, str], lines: list[dict]):
+    for line in lines:
+        out.write(json.dumps(line, ensure_ascii=False) + "\n")
+    out.flush()
+    # Only checkpoint after the lines are written, a job is never lost, at worst repeated.
+    checkpoint.add(job[0].get("bookSourceUrl", ""), job[1])
+
+
+def _run_executor(executor: Executor, jobs: Iterable[tuple[dict, str]], workers: int, job_args: tuple,
+                  out: TextIO, checkpoint: Checkpoint):
+    jobs = iter(jobs)
+    pending = {}
+    with executor:
+        while True:
+            # Keep a bounded number of jobs in flight, a catalog may have millions of them.
+            for job in jobs:
+                pending[executor.submit(search_job, *job, *job_args)] = job
+                if len(pending) >= workers * 2:
+                    break
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                _emit(out, checkpoint, pending.pop(future), future.result())
+
+
+async def _run_asyncio(jobs: Iterable[tuple[dict, str]], workers: int, job_args: tuple, out: TextIO,
+                       checkpoint: Checkpoint):
+    # The parser is synchronous, so each job runs in a thread and the event loop only schedules them.
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(workers))
+    semaphore = asyncio.Semaphore(workers)
+
+    async def run(job):
+        try:
+            _emit(out, checkpoint, job, await asyncio.to_thread(search_job, *job, *job_args))
+        finally:
+            semaphore.release()
+
+    tasks = set()
+    for job in jobs:
+        await semaphore.acquire()  # Don't create a task per job up front, a catalog may have millions of them.
+        task = asyncio.create_task(run(job))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    await asyncio.gather(*tasks)
+
+
+@contextmanager
+def _or_stats(path: str | None):
+    """
+    Reorder the alternatives of the `||` rules by the statistics saved in the file, and save them at the end.
+    """
+    if not path:
+        yield
+        return
+    stats = adaptive.enable(path)
+    try:
+        yield
+    finally:
+        adaptive.disable()
+        stats.save(path)
+
+
+def _add_js_limits(parser: argparse.ArgumentParser):
+    parser.add_argument("--js-timeout", type=float, default=10.0,
+                        help="Terminate a script of a rule after this many seconds of CPU time, 0 disables it.")
+    parser.add_argument("--js-memory", type=int, default=512,
+                        help="Terminate a script of a rule when the V8 heap grew by this many MiB while it ran, "
+                             "0 disables it.")
+
+
+def _set_js_limits(args, boot: bool = True):
+    watchdog.set_default_limits(watchdog.JsLimits(args.js_timeout, args.js_memory << 20))
+    if boot:
+        watchdog.boot()  # In the main thread, the scripts run in the worker threads.
+
+
+def cmd_search(args):
+    _set_js_limits(args, boot=args.executor != "processes")  # V8 doesn't survive the fork of the workers.
+    from suto_legado_parser.registry import SourceRegistry
+
+    # Only the index of the collection is kept, a source is read when its jobs are submitted.
+    registry = SourceRegistry.from_file(args.sources)
+    queries = list(args.query or [])
+    if args.queries:
+        queries += [q.strip() for q in Path(args.queries).read_text(encoding="utf-8").splitlines() if q.strip()]
+    checkpoint = Checkpoint(args.checkpoint)
+    jobs = ((registry.get_source(url), query) for query in queries for url in registry.urls()
+            if (url, query) not in checkpoint)
+    job_args = (args.detail, args.toc, args.limit)
+
+    try:
+        # The statistics of the process workers stay in them, so they are only kept with threads.
+        with _or_stats(args.or_stats if args.executor != "processes" else None):
+            _run_search(args, jobs, job_args, checkpoint)
+    finally:
+        checkpoint.close()
+
+
+def _run_search(args, jobs: Iterable[tuple[dict, str]], job_args: tuple, checkpoint: Checkpoint):
+    match args.executor:
+        case "threads":
+            _run_executor(ThreadPoolExecutor(args.workers), jobs, args.workers, job_args, sys.stdout, checkpoint)
+        case "processes":
+            _run_executor(ProcessPoolExecutor(args.workers), jobs, args.workers, job_args, sys.stdout, checkpoint)
+        case "asyncio":
+            asyncio.run(_run_asyncio(jobs, args.workers, job_args, sys.stdout, checkpoint))
+
+
+def cmd_serve(args):
+    from suto_legado_parser.registry import SourceRegistry
+    from suto_legado_parser.service import ServiceConfig, serve
+
+    registry = SourceRegistry.from_file(args.sources, max_parsers=args.max_parsers, idle_timeout=args.idle_timeout)
+    config = ServiceConfig(host=args.host, port=args.port, workers=args.workers, max_queue=args.max_queue,
+                           cache_ttl=args.cache_ttl, warm=args.warm, search_concurrency=args.search_concurrency)
+    policy = None
+    if args.health:
+        health.set_registry(health_registry := health.HealthRegistry(args.health))
+        policy = health.SelectionPolicy(health_registry, deadline=args.deadline)
+    cached_search = None
+    if args.index:
+        book_index.set_index(index := book_index.BookIndex(args.index))
+        cached_search = book_index.StaleWhileRevalidate(index, ThreadPoolExecutor(args.refresh_workers),
+                                                        args.refresh_interval)
+    _set_js_limits(args)
+    if args.chapters:
+        chapters.set_store(chapters.ChapterStore(args.chapters, max_bytes=args.chapters_size << 20))
+    try:
+        with _or_stats(args.or_stats):
+            serve(registry, config, policy, cached_search)
+    finally:
+        if policy is not None:
+            health.set_registry(None)
+            policy.registry.close()
+
+
+def _iter_collection(path: str | Path) -> Iterable[dict]:
+    from suto_legado_parser.registry import iter_source_spans
+
+    with open(path, "rb") as f:
+        for _, data in iter_source_spans(f):
+            yield json.loads(data)
+
+
+def cmd_check(args):
+    from suto_legado_parser.checker import check_sources, summarize
+    from suto_legado_parser.utils.network import PoolConfig, set_pool
+
+    set_pool(PoolConfig(timeout=args.request_timeout))
+    _set_js_limits(args)
+    reports = []
+    for report in check_sources(_iter_collection(args.sources), args.query, workers=args.workers,
+                                per_host=args.per_host, timeout=args.timeout):
+        sys.stdout.write(json.dumps(report.to_dict(), ensure_ascii=False) + "\n")
+        sys.stdout.flush()
+        # Only the outcome is kept, not the sources, unless the working ones are written.
+        if not args.output:
+            report.source = {"bookSourceUrl": report.url}
+        reports.append(report)
+
+    sys.stderr.write(json.dumps(summarize(reports), ensure_ascii=False) + "\n")
+    if args.output:
+        working = [r.source for r in reports if all(r.passed(stage) for stage in args.require)]
+        Path(args.output).write_text(json.dumps(working, ensure_ascii=False, indent=2), encoding="utf-8")
+
+
+def build_arg_parser() -> argparse.ArgumentParser:
+    arg_parser = argparse.ArgumentParser(prog="python -m suto_legado_parser")
+    arg_parser.add_argument("--log-level", default="WARNING")
+    sub = arg_parser.add_subparsers(dest="command", required=True)
+
+    search = sub.add_parser("search", help="Search the queries in every source and stream the books as NDJSON.")
+    search.add_argument("sources", help="A json file of a book source or an array of book sources.")
+    search.add_argument("-q", "--query", action="append", help="A query, can be given several times.")
+    search.add_argument("--queries", help="A file of queries, one per line.")
+    search.add_argument("--detail", action="store_true", help="Get the detail of every book.")
+    search.add_argument("--toc", action="store_true", help="Get the toc of every book, implies --detail.")
+    search.add_argument("--limit", type=int, help="At most this many books per source and query.")
+    search.add_argument("--executor", default="threads", choices=["threads", "processes", "asyncio"])
+    search.add_argument("-j", "--workers", type=int, default=16)
+    search.add_argument("--checkpoint", help="Skip the jobs recorded in this file and record the new ones.")
+    search.add_argument("--or-stats", help="Reorder the alternatives of the || rules by the statistics in this file, "
+                                           "and update it. Not with --executor processes.")
+    _add_js_limits(search)
+    search.set_defaults(func=cmd_search)
+
+    check = sub.add_parser("check", help="Check search, detail, toc and the first chapter of every source, "
+                                         "one NDJSON report per source.")
+    check.add_argument("sources", help="A json file of a book source or an array of book sources.")
+    check.add_argument("-q", "--query", required=True, help="The query to search in every source.")
+    check.add_argument("-j", "--workers", type=int, default=64)
+    check.add_argument("--per-host", type=int, default=4, help="At most this many sources of a host at a time.")
+    check.add_argument("--timeout", type=float, default=60.0, help="Seconds for all the stages of a source.")
+    check.add_argument("--request-timeout", type=float, default=10.0, help="Seconds for one request.")
+    check.add_argument("-o", "--output", help="Write the working sources to this json file.")
+    check.add_argument("--require", nargs="+", default=["search", "detail", "toc", "content"],
+                       choices=["search", "detail", "toc", "content"],
+                       help="The stages a source must pass to be written to --output.")
+    _add_js_limits(check)
+    check.set_defaults(func=cmd_check)
+
+    serve = sub.add_parser("serve", help="Serve search, detail, toc and content over HTTP.")
+    serve.add_argument("sources", help="A json file of a book source or an array of book sources.")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8080)
+    serve.add_argument("-j", "--workers", type=int, default=32, help="How many parser calls run at the same time.")
+    serve.add_argument("--max-queue", type=int, default=256,
+                       help="How many requests may wait for a worker before answering 503.")
+    serve.add_argument("--search-concurrency", type=int, default=8,
+                       help="How many sources of one search wait for a worker at the same time.")
+    serve.add_argument("--cache-ttl", type=float, default=300, help="Seconds to cache detail, toc and content.")
+    serve.add_argument("--warm", action="store_true", help="Create the parsers of every source at start.")
+    serve.add_argument("--max-parsers", type=int, help="Keep at most this many parsers, the least recently used "
+                                                       "ones are dropped.")
+    serve.add_argument("--idle-timeout", type=float, help="Drop the parsers unused for this many seconds.")
+    serve.add_argument("--or-stats", help="Reorder the alternatives of the || rules by the statistics in this file, "
+                                          "and update it at exit.")
+    serve.add_argument("--health", help="Record the health of the sources in this file, and use it to skip, "
+                                        "deprioritize or give tighter deadlines to the unhealthy ones.")
+    serve.add_argument("--deadline", type=float, default=10.0, help="The deadline of a source in a search, "
+                                                                     "with --health.")
+    serve.add_argument("--index", help="Index the books seen in this SQLite file, and answer /search?mode=cached "
+                                       "from it.")
+    serve.add_argument("--refresh-interval", type=float, default=300.0,
+                       help="Refresh a cached query from the sources at most once in this many seconds.")
+    serve.add_argument("--refresh-workers", type=int, default=4)
+    serve.add_argument("--chapters", help="Store the chapter texts in this directory, and serve them from it.")
+    serve.add_argument("--chapters-size", type=int, default=1024, help="The size of --chapters in MiB.")
+    _add_js_limits(serve)
+    serve.set_defaults(func=cmd_serve)
+    return arg_parser
+
+
+def main(argv: list[str] | None = None):
+    args = build_arg_parser().parse_args(argv)
+    logging.basicConfig(level=args.log_level.upper(), stream=sys.stderr)
+    args.func(args)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#  Copyright (C) 2024. Suto-Commune
+#  _
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#  _
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#  _
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+@File       : columns.py
+
+@Author     : hsn
+
+@Date       : 2024/10/19 下午5:02
+"""
+import logging
+import sys
+from array import array
+from typing import Generator, Iterable
+
+from suto_legado_parser.book_soure_parser import BookInfo, Parser
+from suto_legado_parser.utils.lazy import lazy_import
+
+pyarrow = lazy_import("pyarrow")  # Optional, only used by `to_arrow`.
+
+# The columns of a search batch, in the order of `BookInfo`. `source` is the url of the book source.
+STR_COLUMNS = ("name", "author", "book_url", "cover_url", "intro", "kind", "last_chapter")
+INT_COLUMNS = ("word_count",)
+# The values of these columns repeat a lot, so they are interned and the batch keeps one copy of each.
+INTERNED_COLUMNS = frozenset({"author", "kind", "source"})
+_DEFAULTS = {name: field.default for name, field in BookInfo.model_fields.items()} | {"source": ""}
+
+
+class ColumnBuilder:
+    """
+    Collect the search records into columns.
+    The string columns are lists, the int columns are `array("q")`, which support the buffer protocol.
+    """
+
+    def __init__(self, with_source: bool = False):
+        self.str_columns = STR_COLUMNS + (("source",) if with_source else ())
+        self.columns: dict[str, list | array] = {}
+        self.clear()
+
+    def __len__(self):
+        return len(self.columns[INT_COLUMNS[0]])
+
+    def clear(self):
+        self.columns = {name: [] for name in self.str_columns}
+        self.columns.update({name: array("q") for name in INT_COLUMNS})
+
+    def append(self, record: dict):
+        """
+        Append a record, the missing fields get the defaults of `BookInfo`.
+        :raise ValueError: If the type of a field is wrong, the columns are left untouched.
+        """
+        row = {}
+        for name in self.str_columns:
+            value = record.get(name, _DEFAULTS[name])
+            if not isinstance(value, str):
+                raise ValueError(f"Invalid {name}: {value!r}")
+            row[name] = sys.intern(value) if name in INTERNED_COLUMNS else value
+        for name in INT_COLUMNS:
+            value = record.get(name, _DEFAULTS[name])
+            if not isinstance(value, int):
+                raise ValueError(f"Invalid {name}: {value!r}")
+            row[name] = value
+
+        for name, value in row.items():
+            self.columns[name].append(value)
+
+    def flush(self) -> dict[str, list | array]:
+        """
+        Take the collected columns and start a new batch.
+        """
+        batch = self.columns
+        self.clear()
+        return batch
+
+
+def batch_columns(records: Iterable[dict], batch_size: int = 1024, *,
+                  with_source: bool = False) -> Generator[dict[str, list | array], None, None]:
+    """
+    Transpose the records into columnar batches of at most `batch_size` rows.
+    example:
+        {"name": ["a", "b"], "author": ["x", "x"], "word_count": array("q", [1, 2]), ...}
+    """
+    logger = logging.getLogger("batch_columns")
+    builder = ColumnBuilder(with_source)
+    for record in records:
+        try:
+            builder.append(record)
+        except ValueError as e:
+            logger.warning(e)
+            continue
+        if len(builder) >= batch_size:
+            yield builder.flush()
+    if len(builder):
+        yield builder.flush()
+
+
+def search_columns(parsers: Iterable[Parser], title: str,
+                   batch_size: int = 1024) -> Generator[dict[str, list | array], None, None]:
+    """
+    Search the title in several sources, the batches have a `source` column with the url of the book source.
+    """
+
+    def records():
+        for parser in parsers:
+            source = parser.j.get("bookSourceUrl", "")
+            try:
+                for record in parser.search_raw(title):
+                    record["source"] = source
+                    yield record
+            except Exception as e:
+                parser.logger.exception(e)
+
+    yield from batch_columns(records(), batch_size, with_source=True)
+
+
+def to_arrow(batch: dict[str, list | array]):
+    """
+    Convert a batch to a `pyarrow.RecordBatch`, the int columns are wrapped without copying.
+    pyarrow is an optional dependency.
+    """
+    arrays, names = [], []
+    for name, column in batch.items():
+        if isinstance(column, array):
+            arrays.append(pyarrow.Array.from_buffers(pyarrow.int64(), len(column), [None, pyarrow.py_buffer(column)]))
+        else:
+            arrays.append(pyarrow.array(column, pyarrow.string()))
+        names.append(name)
+    return pyarrow.RecordBatch.from_arrays(arrays, names=names)
@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#  Copyright (C) 2024. Suto-Commune
+#  _
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#  _
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#  _
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+@File       : health.py
+
+@Author     : hsn
+
+@Date       : 2024/10/27 上午9:50
+"""
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, Literal
+
+logger = logging.getLogger("suto_legado_parser.health")
+
+_registry: "HealthRegistry | None" = None
+
+
+class SourceHealth:
+    """
+    The last outcomes of one operation of one source, so the health follows the recent behavior.
+    """
+    __slots__ = ("outcomes", "last_try", "last_ok", "consecutive_failures")
+
+    def __init__(self, window: int = 100):
+        # (ok, seconds, results)
+        self.outcomes: deque[tuple[bool, float, int]] = deque(maxlen=window)
+        self.last_try = 0.0
+        self.last_ok = 0.0
+        self.consecutive_failures = 0
+
+    def add(self, ok: bool, seconds: float, results: int, at: float):
+        self.outcomes.append((ok, seconds, results))
+        self.last_try = at
+        if ok:
+            self.last_ok = at
+            self.consecutive_failures = 0
+        else:
+            self.consecutive_failures += 1
+
+    @property
+    def calls(self) -> int:
+        return len(self.outcomes)
+
+    @property
+    def success_rate(self) -> float:
+        return sum(o[0] for o in self.outcomes) / len(self.outcomes) if self.outcomes else 1.0
+
+    @property
+    def yield_rate(self) -> float:
+        """
+        The share of the successful calls which returned something, a source may answer but never find a book.
+        """
+        ok = [o for o in self.outcomes if o[0]]
+        return sum(1 for o in ok if o[2] > 0) / len(ok) if ok else 1.0
+
+    def latency(self, q: float) -> float:
+        """
+        The quantile of the latency of the successful calls.
+        """
+        seconds = sorted(o[1] for o in self.outcomes if o[0])
+        if not seconds:
+            return 0.0
+        return seconds[min(int(q * len(seconds)), len(seconds) - 1)]
+
+    def summary(self) -> dict:
+        return {"calls": self.calls, "success_rate": round(self.success_rate, 4),
+                "yield_rate": round(self.yield_rate, 4), "p50": round(self.latency(0.5), 4),
+                "p95": round(self.latency(0.95), 4), "consecutive_failures": self.consecutive_failures,
+                "last_try": self.last_try, "last_ok": self.last_ok}
+
+    def to_json(self) -> dict:
+        return {"outcomes": list(self.outcomes), "last_try": self.last_try, "last_ok": self.last_ok,
+                "consecutive_failures": self.consecutive_failures}
+
+    def copy(self) -> "SourceHealth":
+        health = SourceHealth(self.outcomes.maxlen)
+        health.outcomes.extend(self.outcomes)
+        health.last_try, health.last_ok = self.last_try, self.last_ok
+        health.consecutive_failures = self.consecutive_failures
+        return health
+
+    @classmethod
+    def from_json(cls, data: dict, window: int = 100):
+        health = cls(window)
+        health.outcomes.extend(tuple(o) for o in data["outcomes"])
+        health.last_try = data["last_try"]
+        health.last_ok = data["last_ok"]
+        health.consecutive_failures = data["consecutive_failures"]
+        return health
+
+
+class HealthRegistry:
+    """
+    The health of every source and operation ("search", "detail"), recorded by the parsers.
+    The parsers record from many threads, so the readers get copies made under the lock.
+    :param path: Load the registry from it if it exists, and save it there every `autosave_interval` seconds,
+                 from a background thread, not from the requests.
+    """
+
+    def __init__(self, path: str | Path | None = None, *, window: int = 100, autosave_interval: float = 60.0):
+        self.path = Path(path) if path else None
+        self.window = window
+        self.autosave_interval = autosave_interval
+        self.sources: dict[str, dict[str, SourceHealth]] = {}
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._dirty = False
+        self._closed = threading.Event()
+        if self.path is not None and self.path.exists():
+            self.load(self.path)
+        self._saver = None
+        if self.path is not None and autosave_interval > 0:
+            self._saver = threading.Thread(target=self._autosave, name="health-autosave", daemon=True)
+            self._saver.start()
+
+    def record(self, source: str, operation: str, ok: bool, seconds: float, results: int = 0):
+        with self._lock:
+            if (health := self.sources.setdefault(source, {}).get(operation)) is None:
+                health = self.sources[source][operation] = SourceHealth(self.window)
+            health.add(ok, seconds, results, time.time())
+            self._dirty = True
+
+    def get(self, source: str, operation: str = "search") -> SourceHealth | None:
+        """
+        :return: A copy, which the recording threads don't change while it is read.
+        """
+        with self._lock:
+            health = self.sources.get(source, {}).get(operation)
+            return health.copy() if health is not None else None
+
+    def report(self, operation: str = "search") -> dict[str, dict]:
+        with self._lock:
+            healths = {source: ops[operation].copy() for source, ops in self.sources.items() if operation in ops}
+        return {source: health.summary() for source, health in healths.items()}
+
+    def _autosave(self):
+        while not self._closed.wait(self.autosave_interval):
+            if self._dirty:
+                try:
+                    self.save()
+                except OSError as e:
+                    logger.warning("Failed to save the health to %s: %s", self.path, e)
+
+    def save(self, path: str | Path | None = None):
+        path = Path(path) if path else self.path
+        with self._lock:
+            data = {source: {op: health.to_json() for op, health in ops.items()}
+                    for source, ops in self.sources.items()}
+            self._dirty = False
+        with self._save_lock:
+            tmp = path.with_name(path.name + ".tmp")
+            tmp.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+            os.replace(tmp, path)
+
+    def load(self, path: str | Path):
+        data = json.loads(Path(path).read_text(encoding="utf-8"))
+        with self._lock:
+            self.sources = {source: {op: SourceHealth.from_json(health, self.window) for op, health in ops.items()}
+                            for source, ops in data.items()}
+
+    def close(self):
+        """
+        Stop the autosave, and save the registry a last time.
+        """
+        self._closed.set()
+        if self._saver is not None:
+            self._saver.join()
+        if self.path is not None:
+            self.save()
+
+
+def set_registry(registry: HealthRegistry | None):
+    """
+    Set the process-wide registry which the parsers record to, None disables the recording.
+    """
+    global _registry
+    _registry = registry
+
+
+def get_registry() -> HealthRegistry | None:
+    return _registry
+
+
+class track:
+    """
+    Record the outcome of the operation inside the with block, set `results` to the number of results.
+    An exception is recorded as a failure. It does nothing without a registry.
+    """
+    __slots__ = ("source", "operation", "results", "start")
+
+    def __init__(self, source: str, operation: str):
+        self.source = source
+        self.operation = operation
+        self.results = 0
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if (registry := _registry) is not None:
+            registry.record(self.source, self.operation, exc_type is None, time.perf_counter() - self.start,
+                            self.results)
+
+
+@dataclass(slots=True)
+class Selection:
+    source: str
+    deadline: float
+    status: Literal["healthy", "poor", "probe"]
+
+
+class SelectionPolicy:
+    """
+    Choose the sources to send a request to, by their health.
+    - dead (`min_samples` calls in a row failed): skipped, but one probe every `probe_interval` seconds,
+      so a recovered source comes back.
+    - poor (low success or yield rate, or slow): tried after the healthy ones, with a deadline from its latency.
+    - healthy or unknown: tried first, the fastest first, with the default deadline.
+    """
+
+    def __init__(self, registry: HealthRegistry, *, operation: str = "search", min_samples: int = 5,
+                 poor_success_rate: float = 0.5, poor_yield_rate: float = 0.1, slow_seconds: float = 5.0,
+                 probe_interval: float = 600.0, deadline: float = 10.0, min_deadline: float = 1.0,
+                 deadline_factor: float = 2.0):
+        self.registry = registry
+        self.operation = operation
+        self.min_samples = min_samples
+        self.poor_success_rate = poor_success_rate
+        self.poor_yield_rate = poor_yield_rate
+        self.slow_seconds = slow_seconds
+        self.probe_interval = probe_interval
+        self.deadline = deadline
+        self.min_deadline = min_deadline
+        self.deadline_factor = deadline_factor
+        # The sources being probed, so concurrent requests don't all probe the same dead source.
+        self._probes: dict[str, float] = {}
+
+    def classify(self, source: str, now: float | None = None) -> Literal["healthy", "poor", "dead", "probe"]:
+        health = self.registry.get(source, self.operation)
+        if health is None or health.calls < self.min_samples:
+            return "healthy"
+        if health.consecutive_failures >= self.min_samples:
+            now = time.time() if now is None else now
+            if now - max(health.last_try, self._probes.get(source, 0.0)) >= self.probe_interval:
+                return "probe"
+            return "dead"
+        if (health.success_rate < self.poor_success_rate or health.yield_rate < self.poor_yield_rate
+                or health.latency(0.5) > self.slow_seconds):
+            return "poor"
+        return "healthy"
+
+    def select(self, sources: Iterable[str], now: float | None = None) -> list[Selection]:
+        now = time.time() if now is None else now
+        healthy, poor, probes = [], [], []
+        for source in sources:
+            match self.classify(source, now):
+                case "healthy":
+                    health = self.registry.get(source, self.operation)
+                    healthy.append((health.latency(0.5) if health else 0.0, source))
+                case "poor":
+                    health = self.registry.get(source, self.operation)
+                    deadline = min(max(health.latency(0.95) * self.deadline_factor, self.min_deadline), self.deadline)
+                    poor.append(Selection(source, deadline, "poor"))
+                case "probe":
+                    self._probes[source] = now
+                    probes.append(Selection(source, self.deadline, "probe"))
+        healthy.sort(key=lambda item: item[0])
+        return [Selection(source, self.deadline, "healthy") for _, source in healthy] + poor + probes
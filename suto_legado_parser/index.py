@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#  Copyright (C) 2024. Suto-Commune
+#  _
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#  _
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#  _
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+@File       : index.py
+
+@Author     : hsn
+
+@Date       : 2024/10/29 上午11:00
+
+A local full-text index of the books the parsers have seen, so a repeated query is answered without the network.
+"""
+import json
+import logging
+import sqlite3
+import threading
+import time
+from concurrent.futures import Executor
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Callable, Iterable
+
+from pydantic import BaseModel
+
+logger = logging.getLogger("suto_legado_parser.index")
+
+_index: "BookIndex | None" = None
+
+COLUMNS = ("name", "author", "intro", "kind", "last_chapter", "word_count", "cover_url", "toc_url")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS books (
+    id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL,
+    book_url TEXT NOT NULL,
+    name TEXT, author TEXT, intro TEXT, kind TEXT, last_chapter TEXT, word_count INTEGER,
+    cover_url TEXT, toc_url TEXT,
+    seen_at REAL NOT NULL,
+    UNIQUE (source, book_url)
+);
+"""
+# The trigram tokenizer, chinese has no spaces between the words.
+_FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS books_fts USING fts5(
+    name, author, intro, source, content='books', content_rowid='id', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS books_ai AFTER INSERT ON books BEGIN
+    INSERT INTO books_fts(rowid, name, author, intro, source)
+        VALUES (new.id, new.name, new.author, new.intro, new.source);
+END;
+CREATE TRIGGER IF NOT EXISTS books_ad AFTER DELETE ON books BEGIN
+    INSERT INTO books_fts(books_fts, rowid, name, author, intro, source)
+        VALUES ('delete', old.id, old.name, old.author, old.intro, old.source);
+END;
+CREATE TRIGGER IF NOT EXISTS books_au AFTER UPDATE ON books BEGIN
+    INSERT INTO books_fts(books_fts, rowid, name, author, intro, source)
+        VALUES ('delete', old.id, old.name, old.author, old.intro, old.source);
+    INSERT INTO books_fts(rowid, name, author, intro, source)
+        VALUES (new.id, new.name, new.author, new.intro, new.source);
+END;
+"""
+
+
+@lru_cache(maxsize=1)
+def _defaults() -> dict:
+    from suto_legado_parser.book_soure_parser import BookDetail
+
+    return {name: field.default for name, field in BookDetail.model_fields.items()}
+
+
+def _as_dict(book: Any) -> dict:
+    if isinstance(book, dict):
+        return book
+    if isinstance(book, BaseModel):
+        return book.dict()
+    return book.to_dict()  # A record, see `BookInfoRecord`.
+
+
+class BookIndex:
+    """
+    The books seen by `Parser.search` and `Parser.get_detail`, indexed by name, author, intro and source.
+    Uses SQLite FTS5 when the sqlite library has it, otherwise LIKE queries.
+    :param path: The database file, ":memory:" keeps it in memory.
+    """
+
+    def __init__(self, path: str | Path = ":memory:"):
+        self.connection = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(_SCHEMA)
+        try:
+            self.connection.executescript(_FTS_SCHEMA)
+            self.fts = True
+        except sqlite3.OperationalError:
+            logger.warning("SQLite has no FTS5 with the trigram tokenizer, the index uses LIKE queries")
+            self.fts = False
+        self._lock = threading.Lock()
+
+    def add(self, source: str, books: Iterable[Any]):
+        """
+        Insert or update the books, a `BookDetail` only overwrites the fields it has.
+        """
+        now = time.time()
+        defaults = _defaults()
+        rows = []
+        for book in books:
+            book = _as_dict(book)
+            if not (book_url := book.get("book_url")):
+                continue
+            # A placeholder, e.g. "Unknown", is not known, so it doesn't overwrite what a detail page gave.
+            values = (None if (v := book.get(c)) == defaults.get(c) else v for c in COLUMNS)
+            rows.append((source, book_url, *values, now))
+        if not rows:
+            return
+        updates = ", ".join(f"{c} = coalesce(excluded.{c}, {c})" for c in COLUMNS)
+        with self._lock:
+            self.connection.execute("BEGIN")
+            try:
+                self.connection.executemany(
+                    f"INSERT INTO books (source, book_url, {', '.join(COLUMNS)}, seen_at) "
+                    f"VALUES ({', '.join('?' * (len(COLUMNS) + 3))}) "
+                    f"ON CONFLICT (source, book_url) DO UPDATE SET {updates}, seen_at = excluded.seen_at", rows)
+                self.connection.execute("COMMIT")
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def search(self, query: str, limit: int = 50, sources: Iterable[str] | None = None) -> list[dict]:
+        """
+        :param sources: Only the books of these sources, None is all of them.
+        :return: The books, the best match first, with their `source` and `seen_at`.
+        """
+        query = query.strip()
+        if not query:
+            return []
+        columns = ", ".join(f"b.{c}" for c in ("source", "book_url", *COLUMNS, "seen_at"))
+        where, params = "", ()
+        if sources is not None:
+            where, params = " AND b.source IN (SELECT value FROM json_each(?))", (json.dumps(list(sources)),)
+        if self.fts and len(query) >= 3:
+            # A phrase, so the characters of the query are matched in order.
+            phrase = '"' + query.replace('"', '""') + '"'
+            sql = (f"SELECT {columns} FROM books_fts JOIN books b ON b.id = books_fts.rowid "
+                   f"WHERE books_fts MATCH ?{where} ORDER BY bm25(books_fts, 10.0, 5.0, 1.0, 0.5) LIMIT ?")
+            params = (phrase, *params, limit)
+        else:  # The trigram tokenizer can't match less than 3 characters.
+            pattern = "%" + query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+            sql = (f"SELECT {columns} FROM books b "
+                   f"WHERE (b.name LIKE ? ESCAPE '\\' OR b.author LIKE ? ESCAPE '\\'){where} "
+                   f"ORDER BY (b.name = ?) DESC, length(b.name) LIMIT ?")
+            params = (pattern, pattern, *params, query, limit)
+        with self._lock:
+            rows = self.connection.execute(sql, params).fetchall()
+        keys = ("source", "book_url", *COLUMNS, "seen_at")
+        return [dict(zip(keys, row)) for row in rows]
+
+    def __len__(self):
+        with self._lock:
+            return self.connection.execute("SELECT count(*) FROM books").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
+
+
+def set_index(index: BookIndex | None):
+    """
+    Set the process-wide index which the parsers add their results to, None disables it.
+    """
+    global _index
+    _index = index
+
+
+def get_index() -> BookIndex | None:
+    return _index
+
+
+def record(source: str, books: Iterable[Any]):
+    """
+    Add the books to the process-wide index. It does nothing without one, and never raises:
+    the index must not break a search.
+    """
+    if (index := _index) is None:
+        return
+    try:
+        index.add(source, books)
+    except Exception:
+        logger.exception("Failed to index the books of %s", source)
+
+
+class StaleWhileRevalidate:
+    """
+    Answer a query from the index at once, and refresh it from the sources in the background.
+    A query is refreshed at most once every `refresh_interval` seconds, and at most `max_pending` refreshes of
+    a source wait for the executor: the sources past it are refreshed by a later query.
+    """
+
+    def __init__(self, index: BookIndex, executor: Executor, refresh_interval: float = 300.0,
+                 max_pending: int = 1024):
+        self.index = index
+        self.executor = executor
+        self.refresh_interval = refresh_interval
+        self.max_pending = max_pending
+        self._refreshed: dict[str, float] = {}
+        # (source, query) of the refreshes submitted and not done, the same one is never submitted twice.
+        self._pending: set[tuple[str, str]] = set()
+        self._lock = threading.Lock()
+
+    def should_refresh(self, query: str) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            if now - self._refreshed.get(query, -self.refresh_interval) < self.refresh_interval:
+                return False
+            self._refreshed[query] = now
+            if len(self._refreshed) > 100_000:  # Forget the old queries.
+                self._refreshed = {q: t for q, t in self._refreshed.items() if now - t < self.refresh_interval}
+            return True
+
+    def search(self, query: str, sources: Iterable[str], get_parser: Callable[[str], Any],
+               limit: int = 50) -> list[dict]:
+        """
+        :param sources: Only the books of these sources, and the sources to refresh the query with.
+        :param get_parser: Get the parser of a source, its results are indexed by `Parser.search`. It is called in
+                           the executor, creating a parser may be slow.
+        """
+        sources = list(sources)
+        books = self.index.search(query, limit, sources)
+        if self.should_refresh(query):
+            for source in sources:
+                key = (source, query)
+                with self._lock:
+                    if len(self._pending) >= self.max_pending:
+                        break
+                    if key in self._pending:
+                        continue
+                    self._pending.add(key)
+                self.executor.submit(self._refresh, get_parser, key)
+        return books
+
+    def _refresh(self, get_parser: Callable[[str], Any], key: tuple[str, str]):
+        try:
+            for _ in get_parser(key[0]).search(key[1]):
+                pass
+        except Exception as e:
+            logger.debug("Failed to refresh %s: %s", key[1], e)
+        finally:
+            with self._lock:
+                self._pending.discard(key)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#  Copyright (C) 2024. Suto-Commune
+#  _
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#  _
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#  _
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+@File       : merge.py
+
+@Author     : hsn
+
+@Date       : 2024/10/30 下午3:30
+
+Merge the search results of many sources: the same book found by several sources becomes one entry.
+"""
+import logging
+import math
+import re
+import unicodedata
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Any, Iterable
+
+from suto_legado_parser.index import _as_dict
+
+logger = logging.getLogger("suto_legado_parser.merge")
+
+# The traditional characters which are common in book names and authors, used without OpenCC.
+# It is far from complete, install the `opencc` extra for the other ones.
+_T2S_PAIRS = ("書书說说門门國国長长這这們们來来時时為为後后開开過过還还點点學学無无與与義义發发經经現现麼么對对"
+              "進进實实動动當当從从兩两個个會会間间問问題题東东車车將将師师龍龙鳳凤劍剑氣气靈灵飛飞夢梦戰战獸兽"
+              "記记傳传貓猫鬥斗羅罗陸陆萬万歲岁雲云電电話话語语詩诗頭头體体變变處处聖圣殺杀絕绝紀纪錄录風风華华"
+              "歸归騎骑蘭兰鐵铁鳥鸟魚鱼馬马獄狱鎮镇屍尸葉叶陰阴陽阳錦锦歡欢樂乐愛爱妝妆嬌娇緣缘總总蒼苍蠶蚕"
+              "劉刘張张陳陈楊杨趙赵黃黄吳吴孫孙鄭郑馮冯許许蕭萧韓韩顧顾謝谢羅罗蘇苏貴贵賊贼傑杰鋒锋錢钱")
+_T2S = str.maketrans(_T2S_PAIRS[::2], _T2S_PAIRS[1::2])
+# The notes sources add to the name, e.g. "(全本)", "【精校版】".
+_NOTES = re.compile(r"[(（\[【][^)）\]】]*[)）\]】]")
+_UNKNOWN_AUTHORS = frozenset({"", "unknown", "未知", "佚名"})
+
+
+@lru_cache(maxsize=1)
+def _opencc():
+    try:
+        import opencc
+    except ImportError:
+        logger.warning("OpenCC is not installed, only the common traditional characters are converted to simplified "
+                       "when the search results are merged. Install the opencc extra for the other ones.")
+        return None
+    return opencc.OpenCC("t2s")
+
+
+@lru_cache(maxsize=65536)
+def normalize(text: str) -> str:
+    """
+    The form of a name or an author which is compared: half width, simplified, lower case,
+    without the notes, the punctuation and the spaces.
+    """
+    text = unicodedata.normalize("NFKC", text)
+    text = _NOTES.sub("", text)
+    text = "".join(c for c in text if unicodedata.category(c)[0] not in "PSZC").lower()
+    if (converter := _opencc()) is not None:
+        return converter.convert(text)
+    return text.translate(_T2S)
+
+
+def bigrams(text: str) -> set[str]:
+    return {text[i:i + 2] for i in range(len(text) - 1)} if len(text) > 1 else {text}
+
+
+def similarity(a: set[str], b: set[str]) -> float:
+    return len(a & b) / len(a | b) if a and b else 0.0
+
+
+@dataclass(slots=True)
+class MergedBook:
+    name: str
+    author: str
+    key_name: str
+    key_author: str
+    grams: set[str]
+    # (source, book) of every source which found it.
+    books: list[tuple[str, dict]] = field(default_factory=list)
+    score: float = 0.0
+
+    @property
+    def sources(self) -> list[str]:
+        return [source for source, _ in self.books]
+
+    def best(self) -> dict:
+        """
+        The most complete of the books, the one with the most fields and the longest intro.
+        """
+        return max((book for _, book in self.books),
+                   key=lambda b: (sum(1 for v in b.values() if v), len(str(b.get("intro", "")))))
+
+    def to_dict(self) -> dict:
+        best = self.best()
+        return {**best, "word_count": max(int(b.get("word_count") or 0) for _, b in self.books),
+                "score": round(self.score, 3), "sources": [{"source": s, "book_url": b.get("book_url", "")}
+                                                            for s, b in self.books]}
+
+
+class BookMerger:
+    """
+    Merge the books incrementally, as the results of the sources stream in.
+    A book joins the entry of the same normalized name and author, otherwise an entry whose name shares
+    `min_similarity` of its bigrams and whose author is the same or unknown.
+    The candidates of the fuzzy match are found in a bigram index, so a book is only compared with the entries
+    sharing its rarest bigrams, not with all of them.
+    """
+
+    def __init__(self, query: str = "", *, min_similarity: float = 0.8):
+        self.query = normalize(query)
+        self.query_grams = bigrams(self.query) if self.query else set()
+        self.min_similarity = min_similarity
+        self.entries: list[MergedBook] = []
+        self._exact: dict[tuple[str, str], MergedBook] = {}
+        self._postings: dict[str, list[MergedBook]] = {}
+
+    def add(self, book: Any, source: str = "") -> MergedBook:
+        book = _as_dict(book)
+        source = source or book.get("source", "")
+        name, author = book.get("name") or "", book.get("author") or ""
+        key_name = normalize(name)
+        key_author = normalize(author)
+        if key_author in _UNKNOWN_AUTHORS:
+            key_author = ""
+
+        if (entry := self._exact.get((key_name, key_author))) is None:
+            grams = bigrams(key_name)
+            if (entry := self._find_similar(grams, key_author)) is None:
+                entry = MergedBook(name, author, key_name, key_author, grams)
+                self.entries.append(entry)
+                for gram in grams:
+                    self._postings.setdefault(gram, []).append(entry)
+            self._exact[(key_name, key_author)] = entry
+        if not entry.key_author and key_author:  # The author is known now.
+            entry.author, entry.key_author = author, key_author
+        entry.books.append((source, book))
+        entry.score = self._score(entry)
+        return entry
+
+    def extend(self, books: Iterable[Any]):
+        for book in books:
+            self.add(book)
+
+    def _find_similar(self, grams: set[str], key_author: str) -> MergedBook | None:
+        # An entry similar enough shares all but `len(grams) * (1 - min_similarity)` of the bigrams,
+        # so it is in one of the postings of the rarest `needed` ones: only those are read, all of them.
+        postings = sorted((self._postings.get(gram, ()) for gram in grams), key=len)
+        needed = max(1, len(grams) - math.floor(len(grams) * self.min_similarity) + 1)
+        seen = set()
+        best, best_similarity = None, self.min_similarity
+        for posting in postings[:needed]:
+            for entry in posting:
+                if id(entry) in seen:
+                    continue
+                seen.add(id(entry))
+                if key_author and entry.key_author and key_author != entry.key_author:
+                    continue
+                if (s := similarity(grams, entry.grams)) >= best_similarity:
+                    best, best_similarity = entry, s
+        return best
+
+    def _score(self, entry: MergedBook) -> float:
+        """
+        The relevance to the query, and a bonus for the books found by many sources.
+        """
+        score = 0.0
+        if self.query:
+            if entry.key_name == self.query:
+                score = 100.0
+            elif entry.key_name.startswith(self.query):
+                score = 60.0
+            elif self.query in entry.key_name:
+                score = 40.0
+            elif self.query == entry.key_author:
+                score = 30.0
+            else:
+                score = 30.0 * similarity(self.query_grams, entry.grams)
+        return score + 10.0 * math.log1p(len({source for source, _ in entry.books}))
+
+    def ranked(self, limit: int | None = None) -> list[MergedBook]:
+        return sorted(self.entries, key=lambda e: e.score, reverse=True)[:limit]
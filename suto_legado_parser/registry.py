@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#  Copyright (C) 2024. Suto-Commune
+#  _
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#  _
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#  _
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+@File       : registry.py
+
+@Author     : hsn
+
+@Date       : 2024/10/23 上午11:15
+"""
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, BinaryIO, Callable, Iterable, Iterator
+
+from suto_legado_parser.book_soure_parser import Parser
+
+# The structural characters of json are ascii, and no byte of a multibyte utf-8 character is,
+# so the bytes can be scanned without decoding them.
+_TOKEN = re.compile(rb'[{}\[\]"]')
+_STRING = re.compile(rb'\\.|"', re.DOTALL)
+_GROUP_SEP = re.compile(r"[,;，；]")
+
+
+def iter_source_spans(f: BinaryIO, chunk_size: int = 1 << 16) -> Iterator[tuple[int, bytes]]:
+    """
+    Stream the top-level objects of a json array, or the single object of the file.
+    Only the object being scanned is kept in memory.
+    :return: The offset of every object in the file and its bytes.
+    """
+    buf, base, pos = b"", 0, 0
+    depth, level, start, in_string = 0, 0, None, False
+    while chunk := f.read(chunk_size):
+        buf += chunk
+        while True:
+            if in_string:
+                if (m := _STRING.search(buf, pos)) is None:
+                    # Everything left is plain text, but a trailing backslash escapes the next chunk.
+                    pos = max(pos, len(buf) - 1) if buf.endswith(b"\\") else len(buf)
+                    break
+                pos = m.end()
+                in_string = m.group() != b'"'
+                continue
+            if (m := _TOKEN.search(buf, pos)) is None:
+                pos = len(buf)
+                break
+            pos = m.end()
+            match m.group():
+                case b'"':
+                    in_string = True
+                case b"[":
+                    if depth == 0:
+                        level = 1
+                    depth += 1
+                case b"{":
+                    if depth == level:
+                        start = m.start()
+                    depth += 1
+                case _:
+                    depth -= 1
+                    if depth == level and start is not None:
+                        yield base + start, buf[start:pos]
+                        start = None
+        keep = pos if start is None else start
+        buf, base, pos = buf[keep:], base + keep, pos - keep
+        if start is not None:
+            start = 0
+
+
+@dataclass(slots=True)
+class SourceEntry:
+    url: str
+    name: str
+    groups: tuple[str, ...]
+    enabled: bool
+    # Where the source is in the collection file, a source is only parsed again when it is used.
+    offset: int = -1
+    length: int = 0
+
+    @classmethod
+    def from_source(cls, source: dict, offset: int = -1, length: int = 0):
+        group = source.get("bookSourceGroup") or ""
+        return cls(url=source.get("bookSourceUrl", ""), name=source.get("bookSourceName", ""),
+                   groups=tuple(g.strip() for g in _GROUP_SEP.split(group) if g.strip()),
+                   enabled=bool(source.get("enabled", True)), offset=offset, length=length)
+
+
+class SourceRegistry:
+    """
+    An index of a book source collection, which creates the parser of a source at its first use.
+    With `max_parsers` or `idle_timeout`, the least recently used and the idle parsers are dropped,
+    so the memory stays flat however large the collection is.
+    """
+
+    def __init__(self, entries: Iterable[SourceEntry], load: Callable[[SourceEntry], dict], *,
+                 max_parsers: int | None = None, idle_timeout: float | None = None,
+                 parser_options: dict[str, Any] | None = None):
+        self.entries: dict[str, SourceEntry] = {entry.url: entry for entry in entries}
+        # (group, enabled) -> urls, None matches any, so `urls` is a dict lookup.
+        self._urls: dict[tuple[str | None, bool | None], list[str]] = {}
+        for entry in self.entries.values():
+            for group in (None, *entry.groups):
+                for enabled in (None, entry.enabled):
+                    self._urls.setdefault((group, enabled), []).append(entry.url)
+        self._load = load
+        self.max_parsers = max_parsers
+        self.idle_timeout = idle_timeout
+        self.parser_options = parser_options or {}
+        # url -> (parser, last use), the least recently used first.
+        self._parsers: OrderedDict[str, tuple[Parser, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path: str | Path, **kwargs):
+        path = Path(path)
+        with path.open("rb") as f:
+            entries = [SourceEntry.from_source(json.loads(data), offset, len(data))
+                       for offset, data in iter_source_spans(f)]
+
+        def load(entry: SourceEntry) -> dict:
+            with path.open("rb") as source_file:
+                source_file.seek(entry.offset)
+                return json.loads(source_file.read(entry.length))
+
+        return cls(entries, load, **kwargs)
+
+    @classmethod
+    def from_sources(cls, sources: Iterable[dict], **kwargs):
+        sources = {source.get("bookSourceUrl", ""): source for source in sources}
+        return cls(map(SourceEntry.from_source, sources.values()), lambda entry: sources[entry.url], **kwargs)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, url: str):
+        return url in self.entries
+
+    def __iter__(self) -> Iterator[SourceEntry]:
+        return iter(self.entries.values())
+
+    def urls(self, *, group: str | None = None, enabled: bool | None = None) -> list[str]:
+        return list(self._urls.get((group, enabled), ()))
+
+    def groups(self) -> dict[str, int]:
+        """
+        :return: The number of sources of every group.
+        """
+        return {group: len(urls) for (group, enabled), urls in self._urls.items()
+                if group is not None and enabled is None}
+
+    def get_source(self, url: str) -> dict:
+        return self._load(self.entries[url])
+
+    def get_parser(self, url: str) -> Parser:
+        """
+        :raise KeyError: The source is not in the collection.
+        """
+        now = time.monotonic()
+        with self._lock:
+            if (item := self._parsers.get(url)) is not None:
+                self._parsers[url] = (item[0], now)
+                self._parsers.move_to_end(url)
+                return item[0]
+        entry = self.entries[url]
+        # Build the parser outside of the lock, it is the slow part.
+        parser = Parser(self._load(entry), **self.parser_options)
+        with self._lock:
+            if (item := self._parsers.get(url)) is not None:  # Another thread was faster.
+                parser = item[0]
+            self._parsers[url] = (parser, now)
+            self._parsers.move_to_end(url)
+            self._evict(now)
+        return parser
+
+    @property
+    def loaded(self) -> int:
+        return len(self._parsers)
+
+    def evict_idle(self):
+        with self._lock:
+            self._evict(time.monotonic())
+
+    def _evict(self, now: float):
+        # The parsers are only dropped, not closed, a thread may still be using one. There is nothing to close:
+        # the connections are in the clients of the `ClientPool`, and a given transport is shared by the parsers.
+        while self.max_parsers is not None and len(self._parsers) > self.max_parsers:
+            self._parsers.popitem(last=False)
+        if self.idle_timeout is not None:
+            while self._parsers and next(iter(self._parsers.values()))[1] < now - self.idle_timeout:
+                self._parsers.popitem(last=False)
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#  Copyright (C) 2024. Suto-Commune
+#  _
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#  _
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#  _
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+@File       : adaptive.py
+
+@Author     : hsn
+
+@Date       : 2024/10/26 下午4:20
+
+The hit statistics of the alternatives of `OrRule`, used to try the alternatives which never match last.
+"""
+import contextvars
+import json
+import os
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+
+# The source of the running parser, the same rule string means different things on different sites.
+_scope: contextvars.ContextVar[str] = contextvars.ContextVar("or_scope", default="")
+_stats: "OrStats | None" = None
+
+
+class scope:
+    """
+    Record the statistics of the `OrRule`s inside the with block under the source.
+    """
+    __slots__ = ("name", "token")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.token = None
+
+    def __enter__(self):
+        if _stats is not None:
+            self.token = _scope.set(self.name)
+        return self
+
+    def __exit__(self, *exc):
+        if self.token is not None:
+            _scope.reset(self.token)
+            self.token = None
+
+
+@dataclass(slots=True)
+class AlternativeStats:
+    tries: int = 0
+    hits: int = 0
+    seconds: float = 0.0
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / self.tries if self.tries else 0.0
+
+    @property
+    def mean_seconds(self) -> float:
+        return self.seconds / self.tries if self.tries else 0.0
+
+
+class OrStats:
+    """
+    The tries, hits and time of every alternative of every `OrRule`, per source.
+
+    The orders only change in `refresh`, every `refresh_every` records, which bumps `version`.
+    An alternative which was tried `min_samples` times and hit less than `min_hit_rate` of them is demoted:
+    it is tried after the other ones, the cheapest per hit first. The other ones keep their order,
+    so when several alternatives match, the result is still the one of the first in the rule.
+    A demoted alternative is never tried while an earlier one matches, so its stats would never change:
+    one call in `probe_every` of a reordered rule is a probe, it tries the alternatives in the order of the rule,
+    which gives the result the rule gives without the stats, and records them all again.
+    """
+
+    def __init__(self, *, refresh_every: int = 1000, min_samples: int = 20, min_hit_rate: float = 0.01,
+                 window: int = 10000, probe_every: int = 100):
+        self.refresh_every = refresh_every
+        self.min_samples = min_samples
+        self.min_hit_rate = min_hit_rate
+        # The counts are halved past it, so the recent tries, the probes included, outweigh the old ones
+        # and an alternative which starts to match again is promoted back.
+        self.window = window
+        self.probe_every = probe_every
+        self.version = 0
+        self.stats: dict[str, list[AlternativeStats]] = {}
+        self.orders: dict[str, tuple[int, ...]] = {}
+        self._calls: dict[str, int] = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(rule_text: str) -> str:
+        return f"{_scope.get()}\t{rule_text}"
+
+    def order(self, key: str, n: int) -> tuple[int, ...] | range:
+        if (order := self.orders.get(key)) is None:
+            return range(n)
+        # Not under the lock, a lost increment only delays a probe.
+        calls = self._calls[key] = self._calls.get(key, 0) + 1
+        return range(n) if calls % self.probe_every == 0 else order
+
+    def record(self, key: str, index: int, n: int, hit: bool, seconds: float):
+        with self._lock:
+            if (alternatives := self.stats.get(key)) is None:
+                alternatives = self.stats[key] = [AlternativeStats() for _ in range(n)]
+            stats = alternatives[index]
+            stats.tries += 1
+            stats.hits += hit
+            stats.seconds += seconds
+            self._pending += 1
+            if self._pending >= self.refresh_every:
+                self._refresh()
+
+    def refresh(self):
+        with self._lock:
+            self._refresh()
+
+    def _refresh(self):
+        self._pending = 0
+        orders = {}
+        for key, alternatives in self.stats.items():
+            for stats in alternatives:
+                if stats.tries > self.window:
+                    stats.tries, stats.hits, stats.seconds = stats.tries // 2, stats.hits // 2, stats.seconds / 2
+            if order := self._order(alternatives):
+                orders[key] = order
+        self.orders = orders
+        self._calls = {key: calls for key, calls in self._calls.items() if key in orders}
+        self.version += 1
+
+    def _order(self, alternatives: list[AlternativeStats]) -> tuple[int, ...] | None:
+        """
+        :return: None if the order of the rule is kept.
+        """
+        demoted = [i for i, s in enumerate(alternatives)
+                   if s.tries >= self.min_samples and s.hit_rate < self.min_hit_rate]
+        if not demoted:
+            return None
+        kept = [i for i in range(len(alternatives)) if i not in demoted]
+        # The cost per hit, the index breaks the ties so the order only depends on the stats.
+        demoted.sort(key=lambda i: (alternatives[i].mean_seconds / max(alternatives[i].hit_rate, 1e-6), i))
+        order = tuple(kept + demoted)
+        return None if order == tuple(range(len(alternatives))) else order
+
+    def save(self, path: str | Path):
+        with self._lock:
+            data = {"version": self.version,
+                    "stats": {key: [[s.tries, s.hits, s.seconds] for s in alternatives]
+                              for key, alternatives in self.stats.items()}}
+        path = Path(path)
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_text(json.dumps(data, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, path)
+
+    def load(self, path: str | Path):
+        data = json.loads(Path(path).read_text(encoding="utf-8"))
+        with self._lock:
+            self.stats = {key: [AlternativeStats(*s) for s in alternatives]
+                          for key, alternatives in data["stats"].items()}
+            self._refresh()
+            # The same stats give the same orders, so the version of the saved ones is kept.
+            self.version = data["version"]
+
+
+def enable(path: str | Path | None = None, **kwargs) -> OrStats:
+    """
+    Record the statistics of the `OrRule`s and reorder their alternatives.
+    :param path: Load the statistics saved by `OrStats.save` there, if the file exists.
+    """
+    global _stats
+    stats = OrStats(**kwargs)
+    if path is not None and Path(path).exists():
+        stats.load(path)
+    _stats = stats
+    return stats
+
+
+def disable():
+    global _stats
+    _stats = None
+
+
+def get_stats() -> OrStats | None:
+    return _stats
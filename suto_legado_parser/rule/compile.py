@@ -23,15 +23,54 @@
 
 @Date       : 2024/9/4 下午6:21
 """
-import logging
-from typing import Callable
+from functools import lru_cache
+from typing import Callable, Iterable
 
 from .parser import split_rule
-from .rules import JSoupRule, JsonPath, StrRule
+from .rules import JSoupRule, JsonPath, Rule, StrRule
+from ..utils import metrics
 from ..utils.text import classify_string
+from ..utils.trace import Tracer
 
+tracer = Tracer("rule_compile")
 
-def rule_compile(rules_str: str, var: dict, *, allow_str_rule=True, default=None,
+
+@lru_cache(maxsize=4096)
+def compile_rules(rules_str: str) -> tuple[Rule, ...]:
+    """
+    Split the rule string into rule objects.
+    The rule objects keep no state between compiles, so the result is cached and shared.
+    :param rules_str: The rule string.
+    :return: The rule objects.
+    """
+    return tuple(split_rule(rules_str))
+
+
+def apply_rules(rules: Iterable[Rule], var: dict, *, allow_str_rule=True, empty=None) -> str:
+    """
+    Compile the rule objects one by one, each one takes the result of the previous one.
+    :param rules: The rule objects.
+    :param var: The variable of the rule, `var["result"]` is the input.
+    :param allow_str_rule: If allow_str_rule is True, then compile the rule as a string.
+    :param empty: The result if a JSoup rule matches nothing, the rules after it are skipped. None raises.
+    :return: The result of the last rule.
+    """
+    for rule in rules:
+        if isinstance(rule, StrRule) and not allow_str_rule:  # Classify the rule and compile it.
+            text = rule.compile(var)
+            rule = JsonPath(text) if classify_string(text) == "jsonpath" else JSoupRule(text)
+        if empty is not None and isinstance(rule, JSoupRule):
+            if not (results := rule.select(var)):
+                var["result"] = empty
+                break
+            var["result"] = rule.finish(results, var)
+        else:
+            var["result"] = rule.compile(var)  # Compile the rule in the normal way.
+    return var["result"]
+
+
+@metrics.instrument("rule_compile")
+def rule_compile(rules_str: str, var: dict, *, allow_str_rule=True, default=None, empty=None,
                  callback: Callable | None = None) -> str:
     """
     To process the rule.
@@ -40,31 +79,19 @@ def rule_compile(rules_str: str, var: dict, *, allow_str_rule=True, default=None
     :param var: The variable of the rule.
     :param allow_str_rule: If allow_str_rule is True, then compile the rule as a string.
     :param default: The default value.
+    :param empty: The result if a JSoup rule matches nothing, see `apply_rules`.
     :return: The result of the rule.
     """
     # Something on first:
     #   The widely known rule of legado is consist of several rules. So this "rule" should name as "rules".
-    logger = logging.getLogger("rule_compile")
-    logger.debug(f"compiling rule: {rules_str}")
+    tracer("compiling rule", rule=rules_str)
     if not rules_str:  # If the rules_str is None, then return the default value.
         if callback is not None:
             return callback(default)
         return default
 
-    rules = split_rule(rules_str)
-    for rule in rules:
-        if isinstance(rule, StrRule):
-            if allow_str_rule:  # If allow_str_rule is True, then compile the rule as a string.
-                var["result"] = rule.compile(var)
-            else:  # Otherwise, classify the rule and compile it.
-                _type = classify_string(rule.compile(var))
-                if _type == "jsonpath":
-                    var["result"] = JsonPath(rule.compile(var)).compile(var)
-                else:
-                    var["result"] = JSoupRule(rule.compile(var)).compile(var)
-        else:
-            var["result"] = rule.compile(var)  # Compile the rule in the normal way.
-    logger.debug(f"compiled rule: {var['result']}")
+    apply_rules(compile_rules(rules_str), var, allow_str_rule=allow_str_rule, empty=empty)
+    tracer("compiled rule", rule=rules_str, result=var["result"])
     if callback is not None:
         return callback(var["result"])
     return var["result"]  # Return the result.
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#  Copyright (C) 2024. Suto-Commune
+#  _
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#  _
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#  _
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+@File       : plan.py
+
+@Author     : hsn
+
+@Date       : 2024/10/19 下午4:10
+"""
+from __future__ import annotations
+
+from typing import Any, Callable
+
+from pydantic import BaseModel
+
+from .compile import apply_rules, compile_rules
+from .rules import JSoupRule, Rule, parse_html
+from ..utils import metrics
+
+
+class FieldSpec(BaseModel):
+    name: str
+    rule: str | None = None
+    allow_str_rule: bool = True
+    default: Any = None
+    callback: Callable | None = None
+
+
+class _PrefixNode:
+    """
+    A node of the selector prefix tree, the path from the root is a list of `@` separated JSoup steps.
+    """
+
+    def __init__(self, rule: JSoupRule | None = None):
+        self.rule = rule  # A rule which the step into this node is taken from.
+        self.children: dict[str, _PrefixNode] = {}
+        # The fields whose leading JSoup rule ends at this node, with the rules which follow it.
+        self.fields: list[tuple[str, JSoupRule, tuple[Rule, ...]]] = []
+
+
+class ExtractionPlan:
+    """
+    Extract several fields from one item.
+    The rules of all fields are compiled once. Fields which start with a JSoup rule share one parsed
+    document, and the common selector prefixes of them are only evaluated once.
+    example:
+        `class.item@tag.a@text` and `class.item@tag.a@href` select `class.item@tag.a` once.
+    """
+
+    def __init__(self, fields: list[FieldSpec]):
+        self.fields = fields
+        self.specs: dict[str, FieldSpec] = {field.name: field for field in fields}
+        self.root = _PrefixNode()
+        self.rules: dict[str, tuple[Rule, ...]] = {}  # The fields which can't be fused.
+
+        for field in fields:
+            if not field.rule:
+                continue
+            rules = compile_rules(field.rule)
+            if isinstance(rules[0], JSoupRule):
+                node = self.root
+                for step in rules[0].steps:
+                    node = node.children.setdefault(step, _PrefixNode(rules[0]))
+                node.fields.append((field.name, rules[0], rules[1:]))
+            else:
+                self.rules[field.name] = rules
+
+    def extract(self, item: Any, var: dict | None = None) -> dict[str, Any]:
+        """
+        Extract all fields from the item.
+        :param item: The input of the rules, usually the html or the json of one book.
+        :param var: The variable of the rules, each field gets its own copy.
+        :return: The record of the fields, in the order of the field specs.
+        """
+        var = var or {}
+        raw: dict[str, Any] = {}
+        errors: dict[str, Exception] = {}
+
+        if self.root.children or self.root.fields:
+            if isinstance(item, str):
+                soup = parse_html(item)
+                self._extract_node(self.root, [soup], item, var, raw, errors)
+            else:  # Not a document, so fall back to compiling the rules one by one.
+                for name, rule, rest in self._iter_fused(self.root):
+                    self._extract_field(name, (rule, *rest), item, var, raw, errors)
+
+        for name, rules in self.rules.items():
+            self._extract_field(name, rules, item, var, raw, errors)
+
+        record = {}
+        for field in self.fields:
+            if field.name in errors:
+                raise errors[field.name]
+            value = raw[field.name] if field.rule else field.default
+            record[field.name] = field.callback(value) if field.callback is not None else value
+        return record
+
+    def _extract_field(self, name: str, rules: tuple[Rule, ...], item: Any, var: dict,
+                       raw: dict, errors: dict):
+        try:
+            with metrics.labels(field=name):
+                raw[name] = apply_rules(rules, {**var, "result": item},
+                                        allow_str_rule=self.specs[name].allow_str_rule)
+        except Exception as e:
+            errors[name] = e
+
+    def _extract_node(self, node: _PrefixNode, results: list, item: Any, var: dict, raw: dict, errors: dict):
+        for name, rule, rest in node.fields:
+            try:
+                with metrics.labels(field=name):
+                    field_var = {**var, "result": item}
+                    field_var["result"] = rule.finish(results, field_var)
+                    raw[name] = apply_rules(rest, field_var, allow_str_rule=self.specs[name].allow_str_rule)
+            except Exception as e:
+                errors[name] = e
+
+        for step, child in node.children.items():
+            try:
+                child_results = child.rule.apply_step(results, step)
+            except Exception as e:
+                for name, _, _ in self._iter_fused(child):
+                    errors[name] = e
+                continue
+            self._extract_node(child, child_results, item, var, raw, errors)
+
+    @classmethod
+    def _iter_fused(cls, node: _PrefixNode):
+        yield from node.fields
+        for child in node.children.values():
+            yield from cls._iter_fused(child)
@@ -23,22 +23,51 @@
 
 @Date       : 2024/9/5 下午7:12
 """
+from __future__ import annotations
+
 import copy
 import json
-import logging
 import re
 from abc import ABCMeta, abstractmethod
-from typing import Any, Generator
+from itertools import groupby
+from operator import itemgetter
+from time import perf_counter
+from typing import Any, Generator, TYPE_CHECKING
+
+from . import adaptive, watchdog
+from ..utils import metrics
+from ..utils.lazy import lazy_import
+from ..utils.regex import compile_java, fuse_deletions, is_single_char, translate_replacement
+from ..utils.trace import Tracer
+
+if TYPE_CHECKING:
+    from bs4 import BeautifulSoup, element
+
+# The backends are heavy (STPyV8 boots V8), so they are only imported by the first rule which needs them.
+bs4 = lazy_import("bs4")
+etree = lazy_import("lxml.etree")
+jsonpath_ng = lazy_import("jsonpath_ng")
 
-import STPyV8
-import jsonpath_ng
-from bs4 import BeautifulSoup, element
-from lxml import etree
+_js_tracer = Tracer("JsRule")
+_or_tracer = Tracer("OrRule")
 
-from ..utils.js import JsUtil
+
+@metrics.instrument("html.parse")
+def parse_html(markup: str) -> BeautifulSoup:
+    return bs4.BeautifulSoup(markup, "html.parser")
+
+
+def _rule_labels(rule: Rule, *args, **kwargs) -> dict:
+    return {"rule": rule.__class__.__name__}
 
 
 class Rule(metaclass=ABCMeta):
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Every rule reports the duration and the result size of `compile` when a metrics sink is set.
+        if "compile" in cls.__dict__:
+            cls.compile = metrics.instrument("rule", _rule_labels)(cls.compile)
+
     @abstractmethod
     def __init__(self, text: str):
         ...
@@ -110,6 +139,55 @@ class Rule(metaclass=ABCMeta):
 #             rt: str = str(rt)
 #
 #         return rt
+# Only texts up to this length are indexed, the `text.xxx` selectors are short.
+TEXT_INDEX_MAX_LEN = 256
+
+
+def _iter_texts(root: BeautifulSoup | element.Tag) -> Generator[tuple[element.Tag, str], None, None]:
+    """
+    Walk the tags under `root` (including itself) in post-order and yield them with their `get_text()`.
+    The text of a tag is joined from the strings of its children, so `get_text()` is never called repeatedly.
+    Like `get_text()`, a tag only keeps the strings of its own `interesting_string_types`: the text of a
+    `<script>` is its own, not the one of its parent.
+    """
+    tag_class = bs4.element.Tag
+    string_class = bs4.element.NavigableString
+    # The strings under each visited tag, as runs of (type, joined strings of that type).
+    runs: dict[int, list[tuple[type, str]]] = {}
+    stack: list[tuple[element.Tag, bool]] = [(root, False)]
+    while stack:
+        tag, visited = stack.pop()
+        if not visited:
+            stack.append((tag, True))
+            stack.extend((child, False) for child in reversed(tag.contents) if isinstance(child, tag_class))
+            continue
+
+        strings: list[tuple[type, str]] = []
+        for child in tag.contents:
+            if isinstance(child, tag_class):
+                strings += runs.pop(id(child))
+            elif isinstance(child, string_class):
+                strings.append((type(child), child))
+        runs[id(tag)] = [(type_, "".join(s for _, s in group)) for type_, group in groupby(strings, itemgetter(0))]
+        types = tag.interesting_string_types
+        yield tag, "".join(s for type_, s in runs[id(tag)] if type_ in types)
+
+
+def _get_text_index(soup: BeautifulSoup) -> dict[str, list[element.Tag]]:
+    """
+    Get the text index of a parsed document, it is built on first use and kept on the document.
+    The index maps the text to the tags with that text, deepest first.
+    """
+    index = soup.__dict__.get("_legado_text_index")  # `getattr` on a tag falls back to `find()`.
+    if index is None:
+        index = {}
+        for tag, text in _iter_texts(soup):
+            if tag is not soup and len(text) <= TEXT_INDEX_MAX_LEN:
+                index.setdefault(text, []).append(tag)
+        soup._legado_text_index = index
+    return index
+
+
 def flatten(list_: list):
     for el in list_:
         if isinstance(el, list):
@@ -122,28 +200,48 @@ class JSoupRule(Rule):
     def __init__(self, text: str):
         self.text: str = text
 
+        # Check RegEx
+        # The rule is split here rather than in `compile`, so a rule object can be compiled many times.
+        selector = text
+        self.regex_rule: RegexRule | None = None
+        if "##" in text:
+            selector, regex = text.split("##", 1)
+            self.regex_rule = RegexRule(regex)
+        self.steps: list[str] = [i for i in selector.split("@") if i]
+
     def get_text(self):
         return self.text
 
     def compile(self, var: dict) -> str:
-        # Check RegEx
-        regex_rule: RegexRule | None = None
-        if "##" in self.text:
-            self.text, regex = self.text.split("##", 1)
-            regex_rule = RegexRule(regex)
+        return self.finish(self.select(var), var)
 
-        soup: BeautifulSoup = BeautifulSoup(var["result"], "html.parser")
+    def select(self, var: dict) -> list[BeautifulSoup | element.Tag | str]:
+        """
+        The results of the last step, empty if the selector matched nothing.
+        """
+        soup: BeautifulSoup = parse_html(var["result"])
         results: list[BeautifulSoup | element.Tag | str] = [soup]
 
-        split_rule: Generator[str, None, None] = filter(lambda x: x, self.text.split("@"))
-        for rule in split_rule:
-            results = list(self._apply_rule_multi(results, rule))
-
+        for rule in self.steps:
+            results = self.apply_step(results, rule)
+        return results
+
+    @metrics.instrument("selector")
+    def apply_step(self, results: list[BeautifulSoup | element.Tag | str], rule: str) -> list:
+        """
+        Apply one `@` separated step of the rule to the results of the previous step.
+        """
+        return list(self._apply_rule_multi(results, rule))
+
+    def finish(self, results: list[BeautifulSoup | element.Tag | str], var: dict) -> str:
+        """
+        Turn the results of the last step into the result of the rule.
+        """
         assert isinstance(results, list)
         result = self._process_result_list(results)
 
-        if regex_rule is not None:
-            result = regex_rule.compile({**var, "result": result})
+        if self.regex_rule is not None:
+            result = self.regex_rule.compile({**var, "result": result})
 
         return result
 
@@ -151,21 +249,28 @@ class JSoupRule(Rule):
         for i in rt:
             yield from self._apply_rule(i, rule)
 
-    def _get_tag_from_text(self, rt: BeautifulSoup | element.Tag, text: str) -> element.Tag | None:
-        for i in rt.find_all():
-            i: element.Tag
-            for child in i.childGenerator():
-                if isinstance(child, element.Tag):
-                    if res := self._get_tag_from_text(child, text):
-                        return res
-
-            if i.get_text() == text:
-                return i
-        else:
+    @staticmethod
+    def _get_tag_from_text(rt: BeautifulSoup | element.Tag, text: str) -> element.Tag | None:
+        """
+        Find the deepest tag under `rt` whose text is `text`.
+        Short texts are looked up in the text index of the document, longer ones are searched directly.
+        """
+        if len(text) > TEXT_INDEX_MAX_LEN:
+            for tag, tag_text in _iter_texts(rt):
+                if tag is not rt and tag_text == text:
+                    return tag
             return None
 
+        root = rt
+        while root.parent is not None:
+            root = root.parent
+        for tag in _get_text_index(root).get(text, ()):
+            if root is rt or any(parent is rt for parent in tag.parents):
+                return tag
+        return None
+
     def _apply_rule(self, rt: BeautifulSoup | element.Tag, rule: str) -> list[BeautifulSoup | element.Tag | str]:
-        assert isinstance(rt, (BeautifulSoup, element.Tag))
+        assert isinstance(rt, (bs4.BeautifulSoup, bs4.element.Tag))
         no: int | None = None
         if rule.startswith("[") and rule.endswith("]"):
             _type, selector = "css", rule
@@ -188,12 +293,16 @@ class JSoupRule(Rule):
                         raise ValueError("No result found.")
                 else:
                     rt = rt.get_text()
+            case "html" if not selector:
+                rt = str(rt)
             case "children":
                 raise NotImplementedError("The children selector is not implemented.")
             case "css":
                 rt = rt.select(selector.strip())
             case _:
-                rt = rt.get(_type) or rt.select(_type)
+                # An item which was parsed on its own, e.g. a chapter `<a>`, has its attributes on the first tag.
+                target = rt.find() if isinstance(rt, bs4.BeautifulSoup) else rt
+                rt = (target.get(_type) if target is not None else None) or rt.select(_type)
 
         if rt is None:
             raise ValueError("No result found.")
@@ -237,7 +346,7 @@ class JSoupRule(Rule):
         assert len(rt) > 0
         match len(rt):
             case 1:
-                if isinstance(rt[0], element.Tag):
+                if isinstance(rt[0], bs4.element.Tag):
                     return str(rt[0])
                 return rt[0]
             case _:
@@ -366,7 +475,7 @@ class CssRule(Rule):
         return self.text
 
     def compile(self, var: dict):
-        soup = BeautifulSoup(var["result"], "html.parser")
+        soup = parse_html(var["result"])
         rt: element.ResultSet = soup.select(self.text)
         rt_list = [str(i) for i in rt]
         if len(rt_list) == 0:
@@ -396,16 +505,19 @@ class XPathRule(Rule):
     def __init__(self, text: str):
         self.text = text
 
+        self.xpath = text
+        self.regex_rule: RegexRule | None = None
+        if text.find("##") != -1:
+            self.xpath, regex = text.split("##", 1)
+            self.regex_rule = RegexRule(regex)
+
     def get_text(self):
         return self.text
 
     def compile(self, var: dict):
-        regex_rule = None
-        if self.text.find("##") != -1:
-            self.text, regex = self.text.split("##", 1)
-            regex_rule = RegexRule(regex)
+        regex_rule = self.regex_rule
         html = etree.HTML(var["result"])
-        rt = html.xpath("//" + self.text)
+        rt = html.xpath("//" + self.xpath)
 
         rt_list = [str(i) for i in rt]
         if len(rt_list) == 0:
@@ -427,63 +539,87 @@ class JsRule(Rule):
         return self.text
 
     def compile(self, var: dict):
+        from ..utils.js import JsUtil  # Importing it boots STPyV8.
+
         jsu = JsUtil(var)
         for k, v in var.items():
             setattr(jsu, k, v)
 
-        with STPyV8.JSContext(jsu) as ctxt:
-            for k in var:
-                if not k.startswith("_"):
-                    ctxt.eval(f"let {k} = this.{k};")
-            ctxt.eval("let source = this.source;")
-            ctxt.eval("let java = this;")
-            if True:
-                logger = logging.getLogger("JsRule")
-                for i, line in enumerate(self.text.splitlines()):
-                    logger.debug(f"{i + 1}\t| {line}")
-                logger.debug(var)
-            return ctxt.eval(self.text.strip())
+        # On the first line of the script, so the lines of its errors are its own.
+        prelude = "".join(f"let {k} = this.{k}; " for k in var if not k.startswith("_"))
+        prelude += "let source = this.source; let java = this; "
+        if _js_tracer.enabled:
+            source = "\n".join(f"{i + 1}\t| {line}" for i, line in enumerate(self.text.splitlines()))
+            _js_tracer("eval", source=source, var=var)
+        # A script past its limits is terminated and raises `JsLimitExceeded`, so an `OrRule` tries the next one.
+        with watchdog.watch() as evaluation:
+            return evaluation.run(jsu, prelude + self.text.strip())
 
 
 class RegexRule(Rule):
+    """
+    `pattern##repl`, or a chain of them `p1##r1##p2##r2...`, applied one after another.
+    A trailing `###` only replaces the first match, as Legado does.
+    The java patterns are translated and compiled once, with the consecutive deletions of single characters
+    fused into one pass, see `utils.regex`.
+    """
+
     def __init__(self, *args):
         match len(args):
             case 1:
-                if args[0].find("##") != -1:
-                    self.pattern, self.repl = args[0].split("##", 1)
-                else:
-                    self.pattern = args[0]
-                    self.repl = ""
+                text, first_only = args[0], args[0].endswith("###")
+                if first_only:
+                    text = text[:-3]
+                parts = text.split("##")
+                if len(parts) % 2:
+                    parts.append("")
             case 2:
-                self.pattern = args[0]
-                self.repl = args[1]
+                parts, first_only = list(args), False
             case _:
                 raise ValueError("Invalid RegexRule")
+        self.pairs: list[tuple[str, str]] = list(zip(parts[::2], parts[1::2]))
+        self.pattern, self.repl = self.pairs[0]
+        self.first_only = first_only
+        self.steps: list[tuple[re.Pattern, str]] = []
+        # A bad pattern fails the rule when it is used, as before, not when the rule string is split.
+        self.error: re.error | None = None
+        try:
+            self.steps = self._build_steps()
+        except re.error as e:
+            self.error = e
+
+    def _build_steps(self) -> list[tuple[re.Pattern, str]]:
+        steps = []
+        deletions: list[str] = []
+        for pattern, repl in self.pairs:
+            if not repl and is_single_char(pattern) and not self.first_only:
+                deletions.append(pattern)
+                continue
+            if deletions:
+                steps.append((compile_java(fuse_deletions(deletions)), ""))
+                deletions = []
+            steps.append((compile_java(pattern), translate_replacement(repl)))
+        if deletions:
+            steps.append((compile_java(fuse_deletions(deletions)), ""))
+        return steps
 
     def get_text(self):
-        return f"##{self.pattern}##{self.repl}"
+        return "##" + "##".join(f"{p}##{r}" for p, r in self.pairs) + ("###" if self.first_only else "")
 
     def compile(self, var: dict):
-        return re.sub(self.pattern, self.repl, var["result"])
+        if self.error is not None:
+            raise self.error
+        result = var["result"]
+        count = 1 if self.first_only else 0
+        for pattern, repl in self.steps:
+            result = pattern.sub(repl, result, count)
+        return result
 
 
 class JsonPath(Rule):
     def __init__(self, text: str):
-        self.json_path: str = ""
-        self.rule: list[Rule] = []
-
-        tl = text.split("##")
-        match len(tl):
-            case 1:
-                self.json_path = text
-            case 2:
-                self.json_path = tl[0]
-                self.rule = [RegexRule(tl[1], "")]
-            case 3:
-                self.json_path = tl[0]
-                self.rule = [RegexRule(tl[1], tl[2])]
-            case _:
-                raise ValueError("Invalid JsonPath")
+        self.json_path, _, regex = text.partition("##")
+        self.rule: list[Rule] = [RegexRule(regex)] if regex else []
         if not self.json_path.startswith("$."):
             self.json_path = "$." + self.json_path
 
@@ -547,18 +683,40 @@ class AndRule(Rule):
 class OrRule(Rule):
     def __init__(self, *rules: Rule):
         self.rules = rules
+        self.text = '||'.join([i.get_text() for i in self.rules])
 
     def get_text(self):
-        return '||'.join([i.get_text() for i in self.rules])
+        return self.text
 
     def compile(self, var: dict):
-        logger = logging.getLogger("OrRule")
+        if (stats := adaptive.get_stats()) is not None:
+            return self._compile_adaptive(var, stats)
         for rule in self.rules:
             try:
-                logger.debug(f"Trying rule: {rule}")
+                _or_tracer("trying rule", rule=rule)
                 if rt := rule.compile(var):
                     return rt
             except Exception as e:
-                logger.debug(e)
+                _or_tracer("rule failed", rule=rule, error=e)
                 pass
         raise ValueError("No rule matched.")
+
+    def _compile_adaptive(self, var: dict, stats: adaptive.OrStats):
+        """
+        Try the alternatives in the order of the statistics, and record how each one did.
+        """
+        n = len(self.rules)
+        key = stats.key(self.text)
+        for i in stats.order(key, n):
+            rule = self.rules[i]
+            start = perf_counter()
+            try:
+                _or_tracer("trying rule", rule=rule)
+                rt = rule.compile(var)
+            except Exception as e:
+                _or_tracer("rule failed", rule=rule, error=e)
+                rt = None
+            stats.record(key, i, n, bool(rt), perf_counter() - start)
+            if rt:
+                return rt
+        raise ValueError("No rule matched.")
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#  Copyright (C) 2024. Suto-Commune
+#  _
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#  _
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#  _
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+@File       : template.py
+
+@Author     : hsn
+
+@Date       : 2024/10/24 下午2:05
+"""
+import ast
+import json
+import operator
+import re
+from functools import lru_cache
+from typing import Any, Callable
+
+from .compile import rule_compile
+from .rules import InnerRule
+
+_PLACEHOLDER = re.compile(r"\{\{(.*?)}}", re.DOTALL)
+_JS_MARKS = ("@js:", "<js>")
+# The nodes of the expressions which are rendered without the JS runtime, e.g. `key`, `(page-1)*20`.
+# Only the operators which mean the same in JS and python, on the operands where they do, see `_operation`.
+_SAFE_NODES = (ast.Expression, ast.Name, ast.Load, ast.Constant, ast.BinOp, ast.UnaryOp, ast.Add, ast.Sub,
+               ast.Mult, ast.USub, ast.UAdd)
+_LITERALS = {"true": True, "false": False, "null": None}
+_OPERATORS = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul,
+              ast.USub: operator.neg, ast.UAdd: operator.pos}
+
+
+def _operation(op: ast.operator | ast.unaryop) -> Callable[..., Any]:
+    """
+    The operator on the operands where it means the same in JS, it raises TypeError on the other ones:
+    numbers, and strings for `+`. So `'x' * 99999999999` is left to JS, where it is NaN.
+    """
+    func = _OPERATORS[type(op)]
+    strings = isinstance(op, ast.Add)
+
+    def apply(*operands):
+        if not all(type(v) in (int, float) for v in operands) and not (
+                strings and all(type(v) is str for v in operands)):
+            raise TypeError(f"{type(op).__name__} of {', '.join(type(v).__name__ for v in operands)}")
+        return func(*operands)
+
+    return apply
+
+
+def _evaluator(node: ast.AST) -> Callable[[dict], Any]:
+    match node:
+        case ast.Constant(value=value):
+            return lambda var: value
+        case ast.Name(id=name):
+            return lambda var: var[name]
+        case ast.UnaryOp(op=op, operand=operand):
+            apply, operand = _operation(op), _evaluator(operand)
+            return lambda var: apply(operand(var))
+        case ast.BinOp(left=left, op=op, right=right):
+            apply, left, right = _operation(op), _evaluator(left), _evaluator(right)
+            return lambda var: apply(left(var), right(var))
+    raise ValueError(f"Not an arithmetic expression: {ast.dump(node)}")
+
+
+def _compile_expression(expr: str) -> Callable[[dict], str] | None:
+    """
+    Compile an arithmetic expression of the variables into a function.
+    :return: None if the expression needs the JS runtime.
+    """
+    try:
+        tree = ast.parse(expr.strip(), mode="eval")
+    except SyntaxError:
+        return None
+    if not all(isinstance(node, _SAFE_NODES) for node in ast.walk(tree)):
+        return None
+    if isinstance(tree.body, ast.Name):  # The common case.
+        name = tree.body.id
+        return lambda var: str(var[name])
+    evaluate = _evaluator(tree.body)
+    return lambda var: str(evaluate(var))
+
+
+class UrlTemplate:
+    """
+    A url rule compiled once, e.g. the search url of a source.
+    The `{{}}` placeholders which are plain variables or arithmetic of them, e.g. `{{key}}` and `{{page}}`,
+    are substituted directly; the other ones are compiled by `InnerRule`, and a template with `@js:` or `<js>`
+    falls back to `rule_compile`.
+    """
+
+    def __init__(self, template: str):
+        self.template = template
+        self.parts: list[str | Callable[[dict], str]] | None = None
+        if any(mark in template for mark in _JS_MARKS):
+            return
+        parts: list[str | Callable[[dict], str]] = []
+        last = 0
+        for m in _PLACEHOLDER.finditer(template):
+            if m.start() > last:
+                parts.append(template[last:m.start()])
+            expr = m.group(1)
+            if (func := _compile_expression(expr)) is None:
+                func = InnerRule(expr).compile
+            parts.append(func)
+            last = m.end()
+        if last < len(template):
+            parts.append(template[last:])
+        self.parts = parts
+
+    @property
+    def simple(self) -> bool:
+        """
+        Whether the template is rendered without `rule_compile`.
+        """
+        return self.parts is not None
+
+    def render(self, var: dict) -> str:
+        if self.parts is None:
+            return rule_compile(self.template, var)
+        try:
+            return "".join(part if isinstance(part, str) else part(var) for part in self.parts)
+        except (KeyError, TypeError):  # e.g. a missing variable, "a" + 1 or "a" * 2, let the JS runtime decide.
+            return rule_compile(self.template, var)
+
+
+def _to_literal(node: ast.AST) -> Any:
+    match node:
+        case ast.Constant(value=value):
+            return value
+        case ast.Name(id=name) if name in _LITERALS:
+            return _LITERALS[name]
+        case ast.Dict(keys=keys, values=values) if None not in keys:
+            return {_to_literal(k): _to_literal(v) for k, v in zip(keys, values)}
+        case ast.List(elts=elts) | ast.Tuple(elts=elts):
+            return [_to_literal(e) for e in elts]
+        case ast.UnaryOp(op=ast.USub(), operand=ast.Constant(value=int() | float() as value)):
+            return -value
+    raise ValueError(f"Not a literal: {ast.dump(node)}")
+
+
+@lru_cache(maxsize=4096)
+def parse_url_options(text: str) -> dict:
+    """
+    Parse the options after the url, e.g. `{"method": "POST", "body": "key=1"}`, without eval.
+    The result is cached and shared, don't modify it.
+    :raise ValueError: The options are not an object of literals.
+    """
+    try:
+        options = json.loads(text)
+    except ValueError:
+        # Some sources write it like a python dict, e.g. {'method': 'POST', 'webView': true}.
+        try:
+            options = _to_literal(ast.parse(text.strip(), mode="eval").body)
+        except SyntaxError:
+            raise ValueError(f"Invalid url options: {text}") from None
+    if not isinstance(options, dict):
+        raise ValueError(f"The url options are not an object: {text}")
+    return options
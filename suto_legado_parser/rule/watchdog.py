@@ -0,0 +1,452 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#  Copyright (C) 2024. Suto-Commune
+#  _
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#  _
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#  _
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+@File       : watchdog.py
+
+@Author     : hsn
+
+@Date       : 2024/11/2 上午10:30
+
+Run the JS of the sources in the isolate of the process, and limit the CPU time and the heap of each script:
+a runaway script is terminated through V8.
+"""
+import contextvars
+import ctypes
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Generator
+
+from ..utils import metrics
+from ..utils.lazy import lazy_import
+
+STPyV8 = lazy_import("STPyV8")
+
+logger = logging.getLogger("suto_legado_parser.watchdog")
+
+
+@dataclass(frozen=True, slots=True)
+class JsLimits:
+    """
+    :param seconds: The CPU time of one evaluation, 0 disables it. The time spent waiting for the isolate or in a
+                    request of `java.ajax` isn't counted.
+    :param memory: How many bytes the V8 heap may grow while the evaluation runs, 0 disables it. Keep it below
+                   the heap limit of V8, which aborts the process.
+    """
+    seconds: float = 10.0
+    memory: int = 512 << 20
+
+
+_default: JsLimits | None = JsLimits()
+# The limits of the running parser, see `Parser(js_limits=...)`.
+_limits: contextvars.ContextVar[JsLimits | None] = contextvars.ContextVar("js_limits", default=None)
+
+
+class JsLimitExceeded(RuntimeError):
+    def __init__(self, reason: str, limits: JsLimits):
+        self.reason = reason
+        self.limits = limits
+        limit = f"{limits.seconds:g}s" if reason == "time" else f"{limits.memory >> 20}MiB"
+        super().__init__(f"The script was terminated, it exceeded its {reason} limit of {limit}")
+
+
+def set_default_limits(limits: JsLimits | None):
+    """
+    Set the limits of the scripts run outside of `limits`, None disables the watchdog for them.
+    """
+    global _default
+    _default = limits
+
+
+def get_default_limits() -> JsLimits | None:
+    return _default
+
+
+class limits:
+    """
+    Run the scripts inside the with block with these limits, None keeps the default ones.
+    """
+    __slots__ = ("value", "token")
+
+    def __init__(self, value: JsLimits | None):
+        self.value = value
+        self.token = None
+
+    def __enter__(self):
+        if self.value is not None:
+            self.token = _limits.set(self.value)
+        return self
+
+    def __exit__(self, *exc):
+        if self.token is not None:
+            _limits.reset(self.token)
+            self.token = None
+
+
+class _V8:
+    """
+    The functions of the V8 API which STPyV8 doesn't expose, called through ctypes.
+    `request_interrupt` may be called from any thread, the other ones only by the thread which holds the isolate.
+    """
+    _Interrupt = ctypes.CFUNCTYPE(None, ctypes.c_void_p, ctypes.c_void_p)
+
+    def __init__(self, path: str):
+        lib = ctypes.CDLL(path)
+        self._current = self._function(lib, "_ZN2v87Isolate13TryGetCurrentEv", ctypes.c_void_p)
+        self._terminate = self._function(lib, "_ZN2v87Isolate18TerminateExecutionEv", None, ctypes.c_void_p)
+        self._cancel = self._function(lib, "_ZN2v87Isolate24CancelTerminateExecutionEv", None, ctypes.c_void_p)
+        self._interrupt = self._function(lib, "_ZN2v87Isolate16RequestInterruptEPFvPS0_PvES2_", None,
+                                         ctypes.c_void_p, self._Interrupt, ctypes.c_void_p)
+        self._statistics = self._function(lib, "_ZN2v87Isolate17GetHeapStatisticsEPNS_14HeapStatisticsE", None,
+                                          ctypes.c_void_p, ctypes.c_void_p)
+        self.isolate: int | None = None
+        self._callback = None
+
+    @staticmethod
+    def _function(lib: ctypes.CDLL, name: str, restype, *argtypes):
+        function = getattr(lib, name)
+        function.restype = restype
+        function.argtypes = argtypes
+        return function
+
+    def bind(self):
+        """
+        Remember the isolate entered by the thread, there is one in the process.
+        """
+        if self.isolate is None:
+            self.isolate = self._current()
+
+    def terminate(self):
+        self._terminate(self.isolate)
+
+    def cancel(self):
+        self._cancel(self.isolate)
+
+    def used_heap(self) -> int:
+        # The fields of `v8::HeapStatistics` are size_t, used_heap_size is the fifth one.
+        statistics = (ctypes.c_size_t * 32)()
+        self._statistics(self.isolate, statistics)
+        return statistics[4]
+
+    def request_interrupt(self, callback):
+        """
+        Run the callback on the thread which runs JS in the isolate, as soon as it does.
+        """
+        if self._callback is None:
+            self._callback = self._Interrupt(lambda isolate, data: callback())
+        self._interrupt(self.isolate, self._callback, None)
+
+
+@lru_cache(maxsize=1)
+def _v8() -> _V8 | None:
+    try:
+        import _STPyV8
+        return _V8(_STPyV8.__file__)
+    except (ImportError, OSError, AttributeError) as e:
+        logger.warning("The V8 API isn't reachable through ctypes, the limits of the scripts aren't enforced: %s", e)
+        return None
+
+
+# The scripts run in a block, so their let and const are dropped with it; and at the top level, so their var
+# are as fast as in a context of their own. `_legado_reset` removes the globals left by the previous script.
+_SETUP = """
+const _legado_builtins = new Set(Object.getOwnPropertyNames(globalThis));
+const _legado_reset = () => {
+    for (const name of Object.getOwnPropertyNames(globalThis)) {
+        if (!_legado_builtins.has(name) && !delete globalThis[name]) globalThis[name] = undefined;
+    }
+    Object.setPrototypeOf(globalThis, Object.prototype);
+};
+"""
+_BIND = "{ const _this = globalThis._legado_this; _legado_reset(); Object.setPrototypeOf(globalThis, _this); }"
+
+
+class _Thread:
+    """
+    The state of a thread in the isolate. The evaluations of a thread are nested, a script may run a rule which
+    runs a script.
+    """
+    __slots__ = ("stack", "locker", "paused_cpu", "outside_heap", "_paused_at")
+
+    def __init__(self):
+        self.stack: list[_Evaluation] = []
+        self.locker = None
+        # The CPU time of the thread, and the growth of the heap, while the isolate was released by `unlocked`.
+        self.paused_cpu = 0.0
+        self.outside_heap = 0
+        self._paused_at = (0.0, 0)
+
+    def lock(self):
+        boot()
+        # The locker waits for the isolate without the GIL.
+        self.locker = STPyV8.JSLocker(STPyV8.v8_default_isolate)
+        self.locker.enter()
+        STPyV8.v8_default_isolate.enter()
+
+    def unlock(self):
+        STPyV8.v8_default_isolate.leave()
+        self.locker.leave()
+        self.locker = None
+
+    def pause(self, v8: _V8 | None):
+        self._paused_at = (time.thread_time(), v8.used_heap() if v8 is not None else 0)
+
+    def resume(self, v8: _V8 | None):
+        cpu, heap = self._paused_at
+        self.paused_cpu += time.thread_time() - cpu
+        if v8 is not None:
+            self.outside_heap += v8.used_heap() - heap
+
+
+# The contexts which no evaluation uses. They are kept for the next scripts, since STPyV8 crashes at a later GC
+# when a context which held python objects is freed.
+_idle: list = []
+
+
+def _evaluate(this, source: str):
+    """
+    Evaluate the source with `this` as this, in an idle context. The caller holds the isolate.
+    """
+    if _idle:
+        context = _idle.pop()
+    else:
+        context = STPyV8._STPyV8.JSContext()
+        with _entered(context):
+            context.eval(_SETUP)
+    try:
+        with _entered(context):
+            context.locals._legado_this = this
+            context.eval(_BIND)
+            try:
+                # On the first line of the script, so the lines of its errors are its own.
+                return context.eval("{ " + source + "\n}")
+            finally:
+                context.eval("_legado_reset()")  # Skipped by V8 if the script was terminated, then done by the next.
+    finally:
+        _idle.append(context)
+
+
+@lru_cache(maxsize=1)
+def boot():
+    """
+    Import STPyV8, the first script does it otherwise. Call it from the main thread before the scripts run in
+    other threads: V8 crashes at a later GC when it was booted in another thread.
+    """
+    if threading.current_thread() is not threading.main_thread():
+        logger.warning("STPyV8 is booted outside of the main thread, V8 may crash. Call watchdog.boot() first.")
+    # The threads enter the isolate while they hold it, not the importing one for good.
+    STPyV8.v8_default_isolate.leave()
+
+
+@contextmanager
+def _entered(context):
+    context.enter()
+    try:
+        yield context
+    finally:
+        context.leave()
+
+
+_local = threading.local()
+
+
+def _thread() -> _Thread:
+    if (state := getattr(_local, "state", None)) is None:
+        state = _local.state = _Thread()
+    return state
+
+
+class _Evaluation:
+    __slots__ = ("thread", "limits", "cpu", "heap", "reason")
+
+    def __init__(self, thread: _Thread, js_limits: JsLimits | None, v8: _V8 | None):
+        self.thread = thread
+        self.limits = js_limits
+        # Where the clocks of the thread were when it started, without the time it released the isolate.
+        self.cpu = time.thread_time() - thread.paused_cpu
+        self.heap = (v8.used_heap() if v8 is not None else 0) - thread.outside_heap
+        self.reason = ""
+
+    def run(self, this, source: str):
+        """
+        Evaluate the source in the isolate, see `_evaluate`.
+        """
+        return _evaluate(this, source)
+
+    def exceeded(self, cpu: float, heap: int) -> str:
+        """
+        :return: The limit which the evaluation exceeded at these clocks of the thread, "" if none.
+        """
+        if self.limits is None:
+            return ""
+        if self.limits.seconds and cpu - self.thread.paused_cpu - self.cpu > self.limits.seconds:
+            return "time"
+        if self.limits.memory and heap - self.thread.outside_heap - self.heap > self.limits.memory:
+            return "memory"
+        return ""
+
+
+class Watchdog:
+    """
+    The scripts of all the threads run in the one isolate of STPyV8, which wraps the python objects with
+    a template of that isolate. A thread holds the isolate while it runs a script, and releases it while it waits
+    for a request, see `unlocked`.
+    A thread interrupts the thread which holds the isolate every `interval`, which measures its CPU time and
+    the heap and terminates its own script past their limits; a termination never hits another thread.
+    """
+
+    def __init__(self, interval: float = 0.05):
+        # How often the running script is checked.
+        self.interval = interval
+        # The threads which hold the isolate with an evaluation, one at most.
+        self._running = 0
+        self._requested = False
+        self._condition = threading.Condition()
+        self._thread: threading.Thread | None = None
+
+    @contextmanager
+    def watch(self, js_limits: JsLimits | None = None) -> Generator[_Evaluation, None, None]:
+        """
+        Hold the isolate inside the with block, and watch the evaluation.
+        :raise JsLimitExceeded: If it was terminated, whatever V8 raised or returned.
+        """
+        js_limits = js_limits or _limits.get() or _default
+        thread = _thread()
+        outermost = not thread.stack
+        if outermost:
+            thread.lock()
+        v8 = _v8()
+        if v8 is not None:
+            v8.bind()
+        start = time.perf_counter()
+        evaluation = _Evaluation(thread, js_limits, v8)
+        try:
+            with self._condition:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="js-watchdog", daemon=True)
+                    self._thread.start()
+                thread.stack.append(evaluation)
+                if outermost:
+                    self._running += 1
+                    self._condition.notify()
+            try:
+                yield evaluation
+            except Exception as e:
+                if evaluation.reason:
+                    raise JsLimitExceeded(evaluation.reason, js_limits) from e
+                raise
+            finally:
+                with self._condition:
+                    thread.stack.pop()
+                    if outermost:
+                        self._running -= 1
+                    if evaluation.reason and v8 is not None and not any(e.reason for e in thread.stack):
+                        v8.cancel()  # The outer scripts go on, and a termination past the end hits nothing.
+                metrics.observe("js.seconds", time.perf_counter() - start)
+                if evaluation.reason:
+                    metrics.observe("js.terminated", 1, reason=evaluation.reason)
+            if evaluation.reason:
+                raise JsLimitExceeded(evaluation.reason, js_limits)
+        finally:
+            if outermost:
+                thread.unlock()
+
+    @contextmanager
+    def unlocked(self):
+        """
+        Release the isolate inside the with block, e.g. while a request of the script is sent, so the scripts of
+        the other threads run meanwhile.
+        """
+        thread = _thread()
+        if not thread.stack:
+            yield
+            return
+        v8 = _v8()
+        terminated = any(e.reason for e in thread.stack)
+        with self._condition:
+            self._running -= 1
+            if terminated and v8 is not None:
+                v8.cancel()  # Terminated again when the isolate is back, not the scripts of the other threads.
+        thread.pause(v8)
+        unlocker = STPyV8.JSUnlocker()
+        unlocker.enter()
+        try:
+            yield
+        finally:
+            unlocker.leave()
+            thread.resume(v8)
+            with self._condition:
+                self._running += 1
+                self._condition.notify()
+                if terminated and v8 is not None:
+                    v8.terminate()
+
+    def _check(self):
+        """
+        Run by V8 on the thread which holds the isolate: terminate its script if it is past its limits.
+        """
+        try:
+            with self._condition:
+                self._requested = False
+                if not (stack := getattr(_local, "state", _Thread()).stack):
+                    return
+                v8 = _v8()
+                cpu, heap = time.thread_time(), v8.used_heap()
+                terminate = False
+                for evaluation in stack:
+                    if not evaluation.reason and (reason := evaluation.exceeded(cpu, heap)):
+                        evaluation.reason = reason
+                        terminate = True
+                if terminate:
+                    v8.terminate()
+        except Exception:  # Raised in a callback of V8, nothing would catch it.
+            logger.exception("Failed to check the limits of the running script")
+
+    def _run(self):
+        with self._condition:
+            while True:
+                if (v8 := _v8()) is None:
+                    return
+                if not self._running:
+                    self._condition.wait()
+                    continue
+                if not self._requested:
+                    self._requested = True
+                    v8.request_interrupt(self._check)
+                self._condition.wait(self.interval)
+
+
+_watchdog = Watchdog()
+
+
+def watch(js_limits: JsLimits | None = None):
+    """
+    Watch the evaluation inside the with block with the process-wide watchdog, see `Watchdog.watch`.
+    """
+    return _watchdog.watch(js_limits)
+
+
+def unlocked():
+    """
+    Release the isolate inside the with block, see `Watchdog.unlocked`.
+    """
+    return _watchdog.unlocked()
@@ -0,0 +1,377 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#  Copyright (C) 2024. Suto-Commune
+#  _
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#  _
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#  _
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+@File       : service.py
+
+@Author     : hsn
+
+@Date       : 2024/10/22 下午3:40
+"""
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Callable
+from urllib.parse import parse_qs, urlsplit
+
+from suto_legado_parser.book_soure_parser import BookDetail, BookInfo, Chapter, Parser
+from suto_legado_parser.health import SelectionPolicy
+from suto_legado_parser.index import StaleWhileRevalidate
+from suto_legado_parser.merge import BookMerger
+from suto_legado_parser.registry import SourceRegistry
+
+logger = logging.getLogger("suto_legado_parser.service")
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 502: "Bad Gateway",
+           503: "Service Unavailable"}
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+@dataclass
+class ServiceConfig:
+    host: str = "127.0.0.1"
+    port: int = 8080
+    # How many parser calls run at the same time, each of them holds a thread.
+    workers: int = 32
+    # How many requests may wait for a worker before the service answers 503.
+    max_queue: int = 256
+    # How long a detail, toc or content response is cached, in seconds, 0 to disable the cache.
+    cache_ttl: float = 300
+    cache_size: int = 4096
+    # Create the parsers of every source when the service starts, instead of at their first request.
+    warm: bool = False
+    # How many sources of one search wait for a worker at the same time, the other ones wait their turn.
+    search_concurrency: int = 8
+
+
+class _Request:
+    """
+    The calls of one request waiting for a worker, the request counts once in `Service.waiting` while any waits.
+    """
+    __slots__ = ("waiting",)
+
+    def __init__(self):
+        self.waiting = 0
+
+
+class ResponseCache:
+    """
+    A LRU cache whose entries expire after `ttl` seconds.
+    """
+
+    def __init__(self, ttl: float, size: int):
+        self.ttl = ttl
+        self.size = size
+        self.entries: OrderedDict[tuple, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: tuple) -> Any | None:
+        if (entry := self.entries.get(key)) is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key: tuple, value: Any):
+        if self.ttl <= 0:
+            return
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+class Service:
+    """
+    Serve the parsers of a book source collection over HTTP.
+    The parsers are kept across the requests, so their compiled rules and their connections stay warm.
+
+    GET /search?q=<title>[&source=<url>][&group=<group>][&mode=cached][&merge=1]
+        NDJSON, one line per book, streamed as the sources complete.
+        With mode=cached, the books of the local index, which is refreshed in the background.
+        With merge=1, the books found by several sources merged into one line, ranked, once all the sources completed.
+    GET /detail?source=<url>&url=<book url>
+    GET /toc?source=<url>&url=<toc url>
+    GET /content?source=<url>&url=<chapter url>
+    GET /health
+    """
+
+    def __init__(self, registry: SourceRegistry, config: ServiceConfig | None = None,
+                 policy: SelectionPolicy | None = None, cached_search: StaleWhileRevalidate | None = None):
+        """
+        :param policy: Skip or deprioritize the unhealthy sources of a search, and give them tighter deadlines.
+        :param cached_search: Answer `/search?mode=cached` from the local index, and refresh it in the background.
+        """
+        self.config = config or ServiceConfig()
+        self.registry = registry
+        self.policy = policy
+        self.cached_search = cached_search
+        self.cache = ResponseCache(self.config.cache_ttl, self.config.cache_size)
+        self.executor = ThreadPoolExecutor(self.config.workers, thread_name_prefix="service")
+        self.slots = asyncio.Semaphore(self.config.workers)
+        self.waiting = 0
+        self.routes: dict[str, Callable] = {
+            "/search": self.search,
+            "/detail": self.detail,
+            "/toc": self.toc,
+            "/content": self.content,
+            "/health": self.health,
+        }
+        if self.config.warm:
+            for key in self.registry.urls(enabled=True):
+                self.registry.get_parser(key)
+
+    def get_parser(self, key: str) -> Parser:
+        try:
+            return self.registry.get_parser(key)
+        except KeyError:
+            raise HTTPError(404, f"unknown source: {key}")
+
+    def admit(self):
+        """
+        When every worker is busy and `max_queue` requests already wait, the request is refused at once,
+        so a saturated service answers 503 instead of queueing requests it would never answer in time.
+        """
+        if self.slots.locked() and self.waiting >= self.config.max_queue:
+            raise HTTPError(503, "busy")
+
+    async def call(self, func: Callable, *args, request: _Request | None = None, deadline: float | None = None):
+        """
+        Run a parser call in a worker thread.
+        :param request: The request the call belongs to, it was admitted already. Without it, the call is
+                        a request of its own and is admitted here.
+        :param deadline: The seconds to wait for the call once it got a worker, the wait for the worker excluded.
+        :raise asyncio.TimeoutError: Past the deadline. The thread keeps its worker until it ends,
+                                     only the caller stops waiting for it.
+        """
+        if request is None:
+            self.admit()
+            request = _Request()
+        if request.waiting == 0:
+            self.waiting += 1
+        request.waiting += 1
+        try:
+            await self.slots.acquire()
+        finally:
+            request.waiting -= 1
+            if request.waiting == 0:
+                self.waiting -= 1
+        future = asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        # The worker is freed when the thread ends, not when the caller gives up, so `workers` stays the bound
+        # of the running threads.
+        future.add_done_callback(self._release)
+        return await asyncio.wait_for(asyncio.shield(future), deadline)
+
+    def _release(self, future: asyncio.Future):
+        self.slots.release()
+        if not future.cancelled():
+            future.exception()  # Retrieved, nobody awaits the future of a call which timed out.
+
+    async def cached(self, key: tuple, func: Callable, *args):
+        if (value := self.cache.get(key)) is not None:
+            return value
+        try:
+            value = await self.call(func, *args)
+        except HTTPError:
+            raise
+        except Exception as e:
+            raise HTTPError(502, f"{type(e).__name__}: {e}")
+        self.cache.put(key, value)
+        return value
+
+    @staticmethod
+    def _param(query: dict, name: str) -> str:
+        if not (value := query.get(name)):
+            raise HTTPError(400, f"missing parameter: {name}")
+        return value
+
+    async def search(self, query: dict) -> AsyncIterator[dict]:
+        title = self._param(query, "q")
+        if key := query.get("source"):
+            if key not in self.registry:
+                raise HTTPError(404, f"unknown source: {key}")
+            keys = [key]
+        else:
+            keys = self.registry.urls(group=query.get("group"), enabled=True)
+
+        if query.get("mode") == "cached" and self.cached_search is not None:
+            try:
+                books = await self.call(self.cached_search.search, title, keys, self.registry.get_parser)
+            except HTTPError:
+                raise
+            except Exception as e:  # e.g. the index is locked, answered before the lines start.
+                raise HTTPError(502, f"{type(e).__name__}: {e}")
+            for book in books:
+                yield {"source": book.pop("source"), "book": book, "cached": True}
+            return
+
+        def search_one(key: str) -> list[dict]:
+            # The parser is got in the worker too, creating the ones not loaded yet is slow.
+            try:
+                return [{"source": key, "book": book.dict()} for book in self.registry.get_parser(key).search(title)]
+            except Exception as e:
+                return [{"source": key, "error": f"{type(e).__name__}: {e}"}]
+
+        if self.policy is None:
+            selections = [(key, None) for key in keys]
+        else:
+            selections = [(selection.source, selection.deadline) for selection in self.policy.select(keys)]
+        # The search is admitted once, its sources don't each compete for a place in the queue.
+        self.admit()
+        request = _Request()
+        pending = iter(selections)
+        results: asyncio.Queue[list[dict]] = asyncio.Queue()
+
+        async def run(key: str, deadline: float | None) -> list[dict]:
+            try:
+                return await self.call(search_one, key, request=request, deadline=deadline)
+            except HTTPError as e:
+                return [{"source": key, "error": e.message}]
+            except asyncio.TimeoutError:
+                # The parser records its outcome when it ends, if ever, so a source which hangs is demoted too.
+                self.policy.registry.record(key, "search", False, deadline)
+                return [{"source": key, "error": f"timeout after {deadline:g}s"}]
+
+        async def worker():
+            # The tasks share the iterator, each takes the next source when it is done with one.
+            for key, deadline in pending:
+                await results.put(await run(key, deadline))
+
+        tasks = [asyncio.create_task(worker()) for _ in range(min(len(selections), self.config.search_concurrency))]
+        try:
+            merger = BookMerger(title) if query.get("merge") in ("1", "true") else None
+            for _ in range(len(selections)):
+                for line in await results.get():
+                    if merger is not None and "book" in line:
+                        merger.add(line["book"], line["source"])
+                    else:
+                        yield line
+        finally:
+            for task in tasks:
+                task.cancel()
+        if merger is not None:  # The books found by several sources are merged into one line, the best match first.
+            for entry in merger.ranked():
+                yield {"book": entry.to_dict()}
+
+    async def detail(self, query: dict) -> dict:
+        key, url = self._param(query, "source"), self._param(query, "url")
+        parser = self.get_parser(key)
+        return await self.cached(("detail", key, url), lambda: parser.get_detail(BookInfo(book_url=url)).dict())
+
+    async def toc(self, query: dict) -> list[dict]:
+        key, url = self._param(query, "source"), self._param(query, "url")
+        parser = self.get_parser(key)
+        return await self.cached(("toc", key, url),
+                                 lambda: [chapter.dict() for chapter in parser.get_toc(BookDetail(toc_url=url))])
+
+    async def content(self, query: dict) -> dict:
+        key, url = self._param(query, "source"), self._param(query, "url")
+        parser = self.get_parser(key)
+        return await self.cached(("content", key, url),
+                                 lambda: {"url": url, "content": parser.get_content(Chapter(name="", url=url))})
+
+    async def health(self, query: dict) -> dict:
+        rt = {"sources": len(self.registry), "parsers": self.registry.loaded, "waiting": self.waiting,
+              "cached": len(self.cache.entries)}
+        if self.policy is not None:
+            rt["source_health"] = self.policy.registry.report()
+        return rt
+
+    @staticmethod
+    def _head(status: int, content_type: str, keep_alive: bool, length: int | None = None) -> bytes:
+        head = f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\nContent-Type: {content_type}\r\n"
+        if length is None:
+            head += "Transfer-Encoding: chunked\r\n"
+        else:
+            head += f"Content-Length: {length}\r\n"
+        if status == 503:
+            head += "Retry-After: 1\r\n"
+        return (head + f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n").encode()
+
+    async def _respond(self, writer: asyncio.StreamWriter, method: str, target: str, keep_alive: bool):
+        url = urlsplit(target)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        try:
+            if method != "GET":
+                raise HTTPError(405, "only GET is supported")
+            if (handler := self.routes.get(url.path)) is None:
+                raise HTTPError(404, "not found")
+            result = handler(query)
+            if isinstance(result, AsyncIterator):
+                # Stream the lines, the first ones are sent while the slower sources still run.
+                first = await anext(result, None)
+                writer.write(self._head(200, "application/x-ndjson", keep_alive))
+                while first is not None:
+                    data = json.dumps(first, ensure_ascii=False).encode() + b"\n"
+                    writer.write(b"%x\r\n%s\r\n" % (len(data), data))
+                    await writer.drain()
+                    first = await anext(result, None)
+                writer.write(b"0\r\n\r\n")
+                return
+            status, body = 200, await result
+        except HTTPError as e:
+            status, body = e.status, {"error": e.message}
+        data = json.dumps(body, ensure_ascii=False).encode()
+        writer.write(self._head(status, "application/json", keep_alive, len(data)) + data)
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                head = await reader.readuntil(b"\r\n\r\n")
+                lines = head.decode("latin-1").split("\r\n")
+                method, target, _ = lines[0].split(" ", 2)
+                headers = {k.strip().lower(): v.strip() for k, v in (line.split(":", 1) for line in lines[1:] if line)}
+                if length := int(headers.get("content-length", 0)):
+                    await reader.readexactly(length)
+
+                keep_alive = headers.get("connection", "").lower() != "close"
+                await self._respond(writer, method, target, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError):
+            pass
+        except Exception:
+            logger.exception("Failed to handle a request")
+        finally:
+            writer.close()
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle, self.config.host, self.config.port, backlog=4096)
+        logger.info("Serving %d sources on %s", len(self.registry), server.sockets[0].getsockname())
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def serve(registry: SourceRegistry, config: ServiceConfig | None = None, policy: SelectionPolicy | None = None,
+          cached_search: StaleWhileRevalidate | None = None):
+    asyncio.run(Service(registry, config, policy, cached_search).serve())
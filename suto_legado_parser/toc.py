@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#  Copyright (C) 2024. Suto-Commune
+#  _
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#  _
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#  _
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+@File       : toc.py
+
+@Author     : hsn
+
+@Date       : 2024/11/1 下午2:40
+
+Refresh the toc of the followed books incrementally: nothing when the last chapter is the same,
+otherwise only the last known page of the toc and the pages after it.
+"""
+import json
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any
+
+from suto_legado_parser.book_soure_parser import BookInfo, Chapter, Parser
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tocs (
+    source TEXT NOT NULL,
+    book_url TEXT NOT NULL,
+    toc_url TEXT NOT NULL,
+    last_chapter TEXT NOT NULL,
+    pages TEXT NOT NULL,
+    chapters TEXT NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (source, book_url)
+);
+"""
+_UNKNOWN = BookInfo.model_fields["last_chapter"].default
+
+
+@dataclass(slots=True)
+class StoredToc:
+    toc_url: str
+    last_chapter: str
+    # (url, number of chapters) of every page.
+    pages: list[tuple[str, int]]
+    chapters: list[Chapter]
+    updated_at: float = 0.0
+
+
+@dataclass(slots=True)
+class TocDiff:
+    changed: bool
+    chapters: list[Chapter]
+    added: list[Chapter] = field(default_factory=list)
+    removed: list[Chapter] = field(default_factory=list)
+    pages_fetched: int = 0
+
+    def to_dict(self) -> dict:
+        return {"changed": self.changed, "chapters": len(self.chapters), "pages_fetched": self.pages_fetched,
+                "added": [c.dict() for c in self.added], "removed": [c.dict() for c in self.removed]}
+
+
+class TocStore:
+    """
+    The last known toc of every followed book, in SQLite.
+    :param path: The database file, ":memory:" keeps it in memory.
+    """
+
+    def __init__(self, path: str | Path = ":memory:"):
+        self.connection = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+
+    def get(self, source: str, book_url: str) -> StoredToc | None:
+        with self._lock:
+            row = self.connection.execute(
+                "SELECT toc_url, last_chapter, pages, chapters, updated_at FROM tocs WHERE source = ? AND book_url = ?",
+                (source, book_url)).fetchone()
+        if row is None:
+            return None
+        toc_url, last_chapter, pages, chapters, updated_at = row
+        return StoredToc(toc_url, last_chapter, [tuple(p) for p in json.loads(pages)],
+                         [Chapter(name=name, url=url) for name, url in json.loads(chapters)], updated_at)
+
+    def put(self, source: str, book_url: str, toc: StoredToc):
+        pages = json.dumps(toc.pages, ensure_ascii=False)
+        chapters = json.dumps([(c.name, c.url) for c in toc.chapters], ensure_ascii=False)
+        with self._lock:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO tocs (source, book_url, toc_url, last_chapter, pages, chapters, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (source, book_url, toc.toc_url, toc.last_chapter, pages, chapters, toc.updated_at))
+
+    def __len__(self):
+        with self._lock:
+            return self.connection.execute("SELECT count(*) FROM tocs").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
+
+
+def refresh_toc(parser: Parser, book: Any, store: TocStore, *, force: bool = False) -> TocDiff:
+    """
+    Refresh the toc of the book against the one in the store, and store the new one.
+    :param book: A `BookInfo` of a search or a `BookDetail`, or their records. A detail is only got
+                 when the toc url of the book isn't known yet.
+    :param force: Refresh even if the last chapter of the book is the stored one.
+    :return: The chapters added and removed since the stored toc, all of them the first time.
+    """
+    source = parser.j.get("bookSourceUrl", "")
+    stored = store.get(source, book.book_url)
+    last_chapter = book.last_chapter if book.last_chapter != _UNKNOWN else ""
+    if stored is not None and not force and last_chapter and last_chapter == stored.last_chapter:
+        return TocDiff(False, stored.chapters)
+
+    if not (toc_url := getattr(book, "toc_url", "")):
+        toc_url = stored.toc_url if stored is not None else parser.get_detail(book).toc_url
+
+    pages, fetched = None, 0
+    if stored is not None and stored.pages and stored.toc_url == toc_url:
+        # The pages before the last one are full, the new chapters are on the last one or after it.
+        kept = stored.pages[:-1]
+        tail = list(parser.iter_toc_pages(stored.pages[-1][0]))
+        fetched = len(tail)
+        if tail and tail[0][1]:
+            pages = kept + [(url, len(chapters)) for url, chapters in tail]
+            chapters = stored.chapters[:sum(n for _, n in kept)] + [c for _, page in tail for c in page]
+    if pages is None:  # Never fetched, or the pages of the toc changed.
+        full = list(parser.iter_toc_pages(toc_url))
+        fetched += len(full)
+        pages = [(url, len(chapters)) for url, chapters in full]
+        chapters = [c for _, page in full for c in page]
+
+    old = stored.chapters if stored is not None else []
+    old_urls = {c.url for c in old}
+    new_urls = {c.url for c in chapters}
+    diff = TocDiff(True, chapters, [c for c in chapters if c.url not in old_urls],
+                   [c for c in old if c.url not in new_urls], fetched)
+    diff.changed = bool(diff.added or diff.removed) or stored is None
+    last_chapter = last_chapter or (chapters[-1].name if chapters else "")
+    store.put(source, book.book_url, StoredToc(toc_url, last_chapter, pages, chapters, time.time()))
+    return diff
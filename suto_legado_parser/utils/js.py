@@ -28,7 +28,9 @@ import hashlib
 from datetime import datetime
 
 import STPyV8
-from httpx import Client
+
+from .network import SourceClient
+from ..rule import watchdog
 
 
 class Source(STPyV8.JSClass):
@@ -54,14 +56,18 @@ class JsUtil(STPyV8.JSClass):
             raise NotImplementedError
     @staticmethod
     def ajax(urlStr: str):
-        client = Client()
-        rt = client.get(urlStr.strip()).text
+        url = str(urlStr).strip()
+        # The scripts of the other threads run while the request is sent.
+        with watchdog.unlocked():
+            rt = SourceClient().get(url).text
         return rt
 
     @staticmethod
     def ajaxAll(urlList: list):
-        client = Client()
-        return [client.get(url).text for url in urlList]
+        urls = [str(url) for url in urlList]  # The JS array can't be read without the isolate.
+        client = SourceClient()
+        with watchdog.unlocked():
+            return [client.get(url).text for url in urls]
 
     @staticmethod
     def base64Decode(_str: str):
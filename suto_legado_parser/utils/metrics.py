@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#  Copyright (C) 2024. Suto-Commune
+#  _
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#  _
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#  _
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+@File       : metrics.py
+
+@Author     : hsn
+
+@Date       : 2024/10/19 下午6:15
+"""
+import bisect
+import contextvars
+import threading
+from abc import ABCMeta, abstractmethod
+from functools import wraps
+from time import perf_counter
+from typing import Callable, Generator, NamedTuple
+
+# The labels of the current operation, e.g. {"source": ..., "field": ...}.
+_labels: contextvars.ContextVar[dict] = contextvars.ContextVar("metric_labels", default={})
+_sink: "MetricsSink | None" = None
+
+
+class MetricsSink(metaclass=ABCMeta):
+    """
+    Receive the observations. Implement it to export them somewhere else.
+    """
+
+    @abstractmethod
+    def observe(self, name: str, value: float, labels: dict):
+        ...
+
+
+def set_sink(sink: MetricsSink | None):
+    """
+    Set the process-wide sink, None disables the instrumentation.
+    """
+    global _sink
+    _sink = sink
+
+
+def get_sink() -> MetricsSink | None:
+    return _sink
+
+
+def enabled() -> bool:
+    return _sink is not None
+
+
+def observe(name: str, value: float, **labels):
+    """
+    Record a value, the labels of the current operation are added. It does nothing without a sink.
+    """
+    if (sink := _sink) is None:
+        return
+    sink.observe(name, value, {**_labels.get(), **labels})
+
+
+class _Labels:
+    __slots__ = ("labels", "token")
+
+    def __init__(self, labels: dict):
+        self.labels = labels
+        self.token = None
+
+    def __enter__(self):
+        if _sink is not None:
+            self.token = _labels.set({**_labels.get(), **self.labels})
+        return self
+
+    def __exit__(self, *exc):
+        if self.token is not None:
+            _labels.reset(self.token)
+            self.token = None
+
+
+def labels(**kwargs) -> _Labels:
+    """
+    Add the labels to every observation inside the with block.
+    example:
+        with labels(source="https://example.com"):
+            parser.search(...)
+    """
+    return _Labels(kwargs)
+
+
+def size_of(value) -> int:
+    if isinstance(value, (str, bytes, list, tuple, dict)):
+        return len(value)
+    return 0
+
+
+def instrument(name: str, label_func: Callable[..., dict] | None = None):
+    """
+    Decorate a function to record its duration as `{name}.seconds`, the size of the result as `{name}.size`
+    and the failures as `{name}.errors`. Without a sink the only cost is one global lookup.
+    :param name: The name of the metric.
+    :param label_func: Get the extra labels from the arguments of the function.
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if _sink is None:
+                return func(*args, **kwargs)
+
+            extra = label_func(*args, **kwargs) if label_func is not None else {}
+            start = perf_counter()
+            try:
+                rt = func(*args, **kwargs)
+            except Exception:
+                observe(f"{name}.errors", 1, **extra)
+                raise
+            observe(f"{name}.seconds", perf_counter() - start, **extra)
+            observe(f"{name}.size", size_of(rt), **extra)
+            return rt
+
+        return wrapper
+
+    return decorator
+
+
+# The upper bounds of the histogram buckets, they cover both seconds and sizes in a log scale.
+DEFAULT_BOUNDS: tuple[float, ...] = tuple(
+    [base * 10 ** exp for exp in range(-5, 8) for base in (1, 2.5, 5)]
+)
+
+
+class Histogram:
+    __slots__ = ("bounds", "buckets", "count", "sum", "min", "max")
+
+    def __init__(self, bounds: tuple[float, ...] = DEFAULT_BOUNDS):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)  # The last one is +Inf.
+        self.count = 0
+        self.sum = 0.0
+        self.min = float("inf")
+        self.max = float("-inf")
+
+    def add(self, value: float):
+        self.buckets[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        """
+        The approximate quantile, it is the upper bound of the bucket which contains it.
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return min(self.bounds[i], self.max) if i < len(self.bounds) else self.max
+        return self.max
+
+
+class Sample(NamedTuple):
+    name: str
+    labels: dict
+    histogram: Histogram
+
+
+class HistogramSink(MetricsSink):
+    """
+    Keep a histogram per metric name and label set in memory.
+    `collect()` yields the samples in a shape which is easy to export, e.g. to Prometheus.
+    """
+
+    def __init__(self, bounds: tuple[float, ...] = DEFAULT_BOUNDS):
+        self.bounds = bounds
+        self.histograms: dict[tuple[str, tuple], Histogram] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name: str, value: float, labels: dict):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if (histogram := self.histograms.get(key)) is None:
+                histogram = self.histograms[key] = Histogram(self.bounds)
+            histogram.add(value)
+
+    def collect(self) -> Generator[Sample, None, None]:
+        with self.lock:
+            items = list(self.histograms.items())
+        for (name, labels), histogram in items:
+            yield Sample(name, dict(labels), histogram)
+
+    def get(self, name: str, **labels) -> Histogram | None:
+        return self.histograms.get((name, tuple(sorted(labels.items()))))
+
+    def report(self, name_prefix: str = "", top: int = 20) -> str:
+        """
+        A text table of the samples, the slowest (largest sum) first.
+        """
+        samples = sorted((s for s in self.collect() if s.name.startswith(name_prefix)),
+                         key=lambda s: s.histogram.sum, reverse=True)[:top]
+        lines = [f"{'metric':<28} {'count':>8} {'sum':>12} {'p50':>10} {'p99':>10}  labels"]
+        for s in samples:
+            h = s.histogram
+            labels_text = ",".join(f"{k}={v}" for k, v in s.labels.items())
+            lines.append(f"{s.name:<28} {h.count:>8} {h.sum:>12.4f} {h.quantile(0.5):>10.4g} "
+                         f"{h.quantile(0.99):>10.4g}  {labels_text}")
+        return "\n".join(lines)
+
+    def clear(self):
+        with self.lock:
+            self.histograms.clear()
@@ -23,24 +23,291 @@
 
 @Date       : 2024/9/5 下午6:48
 """
+import codecs
+import contextvars
+import threading
+from contextlib import contextmanager
+from dataclasses import dataclass
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from time import monotonic, perf_counter
+from typing import Iterator
+
 import httpx
 
+from . import metrics
+
+DEFAULT_MAX_BODY_SIZE = 32 << 20
+MAX_REDIRECTS = 10
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+# The transport of the running parser, the clients created outside of it (e.g. by `java.ajax`) use it too.
+_transport: contextvars.ContextVar[httpx.BaseTransport | None] = contextvars.ContextVar("transport", default=None)
+
+
+class use_transport:
+    """
+    Make `make_client` use the transport inside the with block. None keeps the current one.
+    """
+    __slots__ = ("transport", "token")
+
+    def __init__(self, transport: httpx.BaseTransport | None):
+        self.transport = transport
+        self.token = None
+
+    def __enter__(self):
+        if self.transport is not None:
+            self.token = _transport.set(self.transport)
+        return self
+
+    def __exit__(self, *exc):
+        if self.token is not None:
+            _transport.reset(self.token)
+            self.token = None
+
+
+# The time.monotonic() by which the requests of the running operation must be done, None is no deadline.
+_deadline: contextvars.ContextVar[float | None] = contextvars.ContextVar("deadline", default=None)
+
+
+class deadline:
+    """
+    The requests inside the with block must be done in `seconds`: each one gets the remaining time as its
+    timeout, and one started or read past it raises `httpx.TimeoutException`. A nested deadline can't extend
+    the outer one.
+    """
+    __slots__ = ("seconds", "token")
+
+    def __init__(self, seconds: float | None):
+        self.seconds = seconds
+        self.token = None
+
+    def __enter__(self):
+        if self.seconds is not None:
+            at = monotonic() + self.seconds
+            if (outer := _deadline.get()) is not None:
+                at = min(at, outer)
+            self.token = _deadline.set(at)
+        return self
+
+    def __exit__(self, *exc):
+        if self.token is not None:
+            _deadline.reset(self.token)
+            self.token = None
+
+
+def _remaining(url: httpx.URL | str) -> float | None:
+    if (at := _deadline.get()) is None:
+        return None
+    if (remaining := at - monotonic()) <= 0:
+        raise httpx.TimeoutException(f"The deadline passed before the request of {url}")
+    return remaining
+
+
+def _no_cookies() -> CookieJar:
+    # A jar which keeps nothing: the cookies are kept by each `SourceClient`, not by the clients it shares.
+    return CookieJar(DefaultCookiePolicy(allowed_domains=[]))
+
+
+def make_client(**kwargs) -> httpx.Client:
+    """
+    Create a client with the current transport, see `use_transport`.
+    """
+    if (transport := _transport.get()) is not None:
+        kwargs.setdefault("transport", transport)
+    return httpx.Client(**kwargs)
+
+
+@dataclass(frozen=True)
+class PoolConfig:
+    # The connections of all hosts together.
+    max_connections: int = 256
+    max_connections_per_host: int = 16
+    max_keepalive_per_host: int = 8
+    keepalive_expiry: float = 30.0
+    timeout: float = 5.0
+    # Multiplex the requests to a host over one connection, needs the `h2` package.
+    http2: bool = False
+
 
-# Add redirects support
-def request(client: httpx.Client, url: str, method: str, body: str, decode: str,
+class ClientPool:
+    """
+    The clients of the process, one per scheme, host and proxy, shared by all the parsers.
+    So the sources hosted on the same domain reuse their connections and TLS sessions.
+    """
+
+    def __init__(self, config: PoolConfig | None = None):
+        self.config = config or PoolConfig()
+        if self.config.http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                raise ImportError("http2 needs the h2 package, install httpx[http2]") from None
+        self.clients: dict[tuple, httpx.Client] = {}
+        self.slots = threading.BoundedSemaphore(self.config.max_connections)
+        self._lock = threading.Lock()
+
+    def client_for(self, url: httpx.URL, proxy: str | None = None) -> httpx.Client:
+        key = (url.scheme, url.host, url.port, proxy)
+        if (client := self.clients.get(key)) is None:
+            with self._lock:
+                if (client := self.clients.get(key)) is None:
+                    config = self.config
+                    limits = httpx.Limits(max_connections=config.max_connections_per_host,
+                                          max_keepalive_connections=config.max_keepalive_per_host,
+                                          keepalive_expiry=config.keepalive_expiry)
+                    client = self.clients[key] = httpx.Client(limits=limits, timeout=config.timeout,
+                                                              http2=config.http2, proxy=proxy,
+                                                              cookies=_no_cookies())
+        return client
+
+    def close(self):
+        with self._lock:
+            clients, self.clients = self.clients, {}
+        for client in clients.values():
+            client.close()
+
+
+_pool = ClientPool()
+
+
+def get_pool() -> ClientPool:
+    return _pool
+
+
+def set_pool(config: PoolConfig) -> ClientPool:
+    """
+    Replace the pool of the process, the clients of the old one are closed.
+    """
+    global _pool
+    old, _pool = _pool, ClientPool(config)
+    old.close()
+    return _pool
+
+
+class SourceClient:
+    """
+    The client of a source: it applies the base url, the headers and the cookies of the source to every request,
+    and sends it with the pooled client of the host. The cookies are the source's own, not the ones of the
+    other sources of the host.
+    With a transport, given or set by `use_transport`, it sends it with its own client instead.
+    """
+
+    def __init__(self, base_url: str = "", headers: dict | None = None, *,
+                 transport: httpx.BaseTransport | None = None, proxy: str | None = None,
+                 max_body_size: int = DEFAULT_MAX_BODY_SIZE):
+        self.base_url = httpx.URL(base_url)
+        self.headers = httpx.Headers(headers)
+        self.transport = transport
+        self.proxy = proxy
+        self.max_body_size = max_body_size
+        self.cookies = httpx.Cookies()
+        # The client of the transport and the transport, swapped together so a thread never gets a mixed pair.
+        self._own: tuple[httpx.Client, httpx.BaseTransport] | None = None
+        self._lock = threading.Lock()
+
+    def _client(self, url: httpx.URL) -> httpx.Client:
+        if (transport := self.transport or _transport.get()) is None:
+            return _pool.client_for(url, self.proxy)
+        if (own := self._own) is None or own[1] is not transport:
+            with self._lock:  # The first requests of several threads must not each create a client.
+                if (own := self._own) is None or own[1] is not transport:
+                    own = self._own = (httpx.Client(transport=transport, cookies=_no_cookies()), transport)
+        return own[0]
+
+    def request(self, method: str, url: str, *, content: str | bytes | None = None,
+                headers: dict | None = None) -> httpx.Response:
+        with self.stream(method, url, content=content, headers=headers) as resp:
+            resp.read()
+        return resp
+
+    @contextmanager
+    def stream(self, method: str, url: str, *, content: str | bytes | None = None,
+               headers: dict | None = None) -> Iterator[httpx.Response]:
+        """
+        :raise httpx.PoolTimeout: No connection of the pool was free before the deadline, see `deadline`.
+        """
+        url = self.base_url.join(url)
+        headers = {**self.headers, **headers} if headers else self.headers
+        client = self._client(url)
+        slots = _pool.slots
+        if not slots.acquire(timeout=_remaining(url)):
+            raise httpx.PoolTimeout(f"No connection was free before the deadline of {url}")
+        try:
+            # The time left once a connection is free.
+            options = {} if (timeout := _remaining(url)) is None else {
+                "timeout": min(timeout, client.timeout.read or timeout)}
+            req = client.build_request(method, url, content=content, headers=headers, **options)
+            self.cookies.set_cookie_header(req)
+            resp = client.send(req, stream=True)
+            try:
+                self.cookies.extract_cookies(resp)
+                yield resp
+            finally:
+                resp.close()
+        finally:
+            slots.release()
+
+    def get(self, url: str, **kwargs) -> httpx.Response:
+        return self.request("GET", url, **kwargs)
+
+    def close(self):
+        if self._own is not None:
+            self._own[0].close()
+
+
+class ResponseTooLarge(httpx.HTTPError):
+    pass
+
+
+def _read_text(resp: httpx.Response, decode: str, max_size: int) -> str:
+    """
+    Decode the body while it is downloaded, so the whole body is never held both as bytes and as text.
+    """
+    if (length := resp.headers.get("content-length", "")).isdigit() and int(length) > max_size:
+        raise ResponseTooLarge(f"The body of {resp.url} is {length} bytes, more than {max_size}")
+    decoder = codecs.getincrementaldecoder(decode)()
+    parts: list[str] = []
+    size, decode_time = 0, 0.0
+    at = _deadline.get()
+    for chunk in resp.iter_bytes():
+        if at is not None and monotonic() > at:  # The read timeout is per chunk, a slow body could go on.
+            raise httpx.TimeoutException(f"The deadline passed while reading {resp.url}")
+        # The size after the content encoding is removed, a small gzip body may inflate a lot.
+        size += len(chunk)
+        if size > max_size:
+            raise ResponseTooLarge(f"The body of {resp.url} is more than {max_size} bytes")
+        start = perf_counter()
+        parts.append(decoder.decode(chunk))
+        decode_time += perf_counter() - start
+    parts.append(decoder.decode(b"", final=True))
+    if metrics.enabled():
+        metrics.observe("network.bytes", size)
+        metrics.observe("network.decode.seconds", decode_time)
+    return "".join(parts)
+
+
+@metrics.instrument("network.request", lambda client, url, method, *args, **kwargs: {"method": method})
+def request(client: SourceClient | httpx.Client, url: str, method: str, body: str, decode: str,
             headers: dict | None = None, *,
-            allow_redirects: bool = False) -> str:
-    if headers is None:
-        headers = {}
-
-    resp = client.request(method, url, content=body, headers=headers)
-    match resp.status_code:
-        case 200:
-            return resp.content.decode(decode)
-        case 301 | 302 | 303 | 307 | 308:
-            if allow_redirects:
-                return request(client, resp.headers['location'], method, body, decode, allow_redirects=True)
-            else:
-                return resp.content.decode(decode)
-        case _:
-            return resp.content.decode(decode)
+            allow_redirects: bool = False, max_size: int | None = None) -> str:
+    """
+    :param max_size: The maximum size of the body, defaults to the one of the client.
+    :raise ResponseTooLarge: The body is larger than `max_size`.
+    """
+    if max_size is None:
+        max_size = getattr(client, "max_body_size", DEFAULT_MAX_BODY_SIZE)
+    headers = headers or {}
+    for _ in range(MAX_REDIRECTS + 1):
+        with client.stream(method, url, content=body, headers=headers) as resp:
+            if not allow_redirects or resp.status_code not in REDIRECT_CODES or "location" not in resp.headers:
+                return _read_text(resp, decode, max_size)
+            location = resp.url.join(resp.headers["location"])
+        if location.scheme not in ("http", "https"):
+            raise httpx.UnsupportedProtocol(f"Redirected to {location}")
+        if resp.status_code == 303 or (resp.status_code in (301, 302) and method.upper() not in ("GET", "HEAD")):
+            method, body = "GET", ""
+        if location.host != resp.url.host:
+            headers = {}  # Don't send the headers of the request, e.g. a token, to another host.
+        url = str(location)
+    raise httpx.TooManyRedirects(f"More than {MAX_REDIRECTS} redirects from {url}")
+
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#  Copyright (C) 2024. Suto-Commune
+#  _
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#  _
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#  _
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+@File       : regex.py
+
+@Author     : hsn
+
+@Date       : 2024/10/25 上午10:30
+
+The regexes of Legado sources are written for java.util.regex, translate them to the ones of `re`.
+"""
+import re
+from functools import lru_cache
+
+_HORIZONTAL_SPACE = r" \t\xa0\u1680\u180e\u2000-\u200a\u202f\u205f\u3000"
+# The \p{...} classes which sources use, as the content of a character class.
+_PROPERTIES = {
+    "Punct": re.escape("!\"#$%&'()*+,-./:;<=>?@[\\]^_`{|}~"),
+    "P": re.escape("!\"#%&'()*,-./:;?@[\\]_{}") + r"\xa1\xa7\xab\xb6\xb7\xbb\xbf\u2010-\u2027\u2030-\u205e"
+                                                   r"\u3001-\u3003\u3008-\u3011\u3014-\u301f\uff01-\uff0f"
+                                                   r"\uff1a\uff1b\uff1f\uff20\uff3b-\uff3d\uff3f\uff5b\uff5d",
+    "Alpha": "a-zA-Z",
+    "Digit": "0-9",
+    "Alnum": "a-zA-Z0-9",
+    "Upper": "A-Z",
+    "Lower": "a-z",
+    "Space": r" \t\n\x0b\f\r",
+    "Han": r"\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff",
+}
+_PROPERTIES["IsPunctuation"] = _PROPERTIES["P"]
+_PROPERTIES["IsHan"] = _PROPERTIES["Han"]
+# A pattern which matches exactly one character, so it can be fused with the other ones, see `fuse_deletions`.
+_SINGLE_CHAR = re.compile(r"\\[sSdDwWtnrfvh]|\\u[0-9a-fA-F]{4}|\\x[0-9a-fA-F]{2}|\\[pP]\{\w+}|\\[^a-zA-Z0-9]"
+                          r"|\[(?:\\.|[^\\\]\[])+]|[^\\\[\]().*+?^$|{}]")
+
+
+def _property(name: str) -> str:
+    if (chars := _PROPERTIES.get(name)) is None:
+        raise re.error(f"Unsupported property: \\p{{{name}}}")
+    return chars
+
+
+@lru_cache(maxsize=4096)
+def translate_pattern(pattern: str) -> str:
+    """
+    Translate the java only syntax of a pattern: named groups, \\k<name>, \\Q...\\E, \\h, \\z and \\p{...}.
+    """
+    out = []
+    i, n, in_class = 0, len(pattern), False
+    while i < n:
+        c = pattern[i]
+        if c == "\\" and i + 1 < n:
+            e = pattern[i + 1]
+            if e == "Q":
+                end = pattern.find("\\E", i + 2)
+                end = n if end == -1 else end
+                out.append(re.escape(pattern[i + 2:end]))
+                i = end + 2
+                continue
+            if e in "pP" and i + 2 < n and pattern[i + 2] == "{":
+                if (end := pattern.find("}", i + 3)) == -1:
+                    raise re.error(f"missing }}, unterminated \\{e}{{", pattern, i)
+                chars = _property(pattern[i + 3:end])
+                if in_class and e == "p":
+                    out.append(chars)
+                else:
+                    out.append(f"[{'^' if e == 'P' else ''}{chars}]")
+                i = end + 1
+                continue
+            if e == "h":
+                out.append(_HORIZONTAL_SPACE if in_class else f"[{_HORIZONTAL_SPACE}]")
+            elif e == "z" and not in_class:
+                out.append(r"\Z")
+            elif e == "Z" and not in_class:
+                out.append(r"(?=\n?\Z)")
+            elif e == "k" and pattern.startswith("<", i + 2):
+                if (end := pattern.find(">", i + 3)) == -1:
+                    raise re.error("missing >, unterminated \\k<", pattern, i)
+                out.append(f"(?P={pattern[i + 3:end]})")
+                i = end + 1
+                continue
+            else:
+                out.append(pattern[i:i + 2])
+            i += 2
+            continue
+        if in_class:
+            if c == "]":
+                in_class = False
+        elif c == "[":
+            in_class = True
+            # A "]" right after "[" or "[^" is a literal.
+            if pattern.startswith("]", i + 1):
+                out.append("[]")
+                i += 2
+                continue
+            if pattern.startswith("^]", i + 1):
+                out.append("[^]")
+                i += 3
+                continue
+        elif c == "(" and pattern.startswith("?<", i + 1) and not pattern.startswith(("?<=", "?<!"), i + 1):
+            out.append("(?P<")
+            i += 3
+            continue
+        out.append(c)
+        i += 1
+    return "".join(out)
+
+
+@lru_cache(maxsize=4096)
+def translate_replacement(repl: str) -> str:
+    """
+    Translate a java replacement, `$1` and `${name}` refer to the groups and a backslash escapes the next character,
+    into a template of `re.sub`.
+    """
+    out = []
+    i, n = 0, len(repl)
+    while i < n:
+        c = repl[i]
+        if c == "\\" and i + 1 < n:
+            out.append("\\\\" if repl[i + 1] == "\\" else repl[i + 1])
+            i += 2
+        elif c == "$" and i + 1 < n and repl[i + 1] == "{" and (end := repl.find("}", i + 2)) != -1:
+            out.append(f"\\g<{repl[i + 2:end]}>")
+            i = end + 1
+        elif c == "$" and i + 1 < n and repl[i + 1].isdigit():
+            j = i + 1
+            while j < n and repl[j].isdigit():
+                j += 1
+            out.append(f"\\g<{repl[i + 1:j]}>")
+            i = j
+        else:
+            out.append("\\\\" if c == "\\" else c)
+            i += 1
+    return "".join(out)
+
+
+@lru_cache(maxsize=4096)
+def compile_java(pattern: str) -> re.Pattern:
+    """
+    Compile a java pattern once, the `re` cache is too small for thousands of sources.
+    """
+    return re.compile(translate_pattern(pattern))
+
+
+def is_single_char(pattern: str) -> bool:
+    return _SINGLE_CHAR.fullmatch(pattern) is not None
+
+
+def fuse_deletions(patterns: list[str]) -> str:
+    """
+    Fuse the patterns of consecutive deletions into one.
+    Only valid when every pattern matches exactly one character: deleting a character never makes or breaks
+    a match of another one, so one pass deletes the same characters as one pass per pattern.
+    """
+    return "|".join(f"(?:{p})" for p in patterns)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#  Copyright (C) 2024. Suto-Commune
+#  _
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#  _
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#  _
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+@File       : replay.py
+
+@Author     : hsn
+
+@Date       : 2024/10/19 下午8:20
+
+Record the http exchanges of the parsers into an archive and serve them again without network.
+The archive is a directory or a zip file:
+    manifest.json           {"exchanges": [{"method", "url", "body_sha1", "status", "headers", "file"}, ...]}
+    responses/<sha1>        The bodies, an identical body is only stored once.
+`benchmarks/corpus` is an archive too.
+example:
+    recorder = RecordingTransport("session.zip")
+    list(Parser(source, transport=recorder).search("title"))
+    recorder.save()
+
+    replayer = ReplayTransport("session.zip", latency=0.05, bandwidth=1_000_000)
+    list(Parser(source, transport=replayer).search("title"))
+"""
+import asyncio
+import hashlib
+import json
+import random
+import threading
+import time
+import zipfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Generator
+
+import httpx
+
+# The stored bodies are decoded, so these headers are not true anymore.
+_DROPPED_HEADERS = {"content-encoding", "content-length", "transfer-encoding"}
+
+
+def _body_sha1(body: bytes) -> str:
+    return hashlib.sha1(body).hexdigest() if body else ""
+
+
+def _key(method: str, url: str, body_sha1: str) -> tuple[str, str, str]:
+    return method.upper(), url, body_sha1
+
+
+class RecordingTransport(httpx.BaseTransport, httpx.AsyncBaseTransport):
+    """
+    Pass the requests to the real transport and record the exchanges, `save()` writes the archive.
+    """
+
+    def __init__(self, path: str | Path, transport: httpx.BaseTransport | None = None,
+                 async_transport: httpx.AsyncBaseTransport | None = None):
+        self.path = Path(path)
+        self.transport = transport or httpx.HTTPTransport()
+        self.async_transport = async_transport or httpx.AsyncHTTPTransport()
+        self.exchanges: list[dict] = []
+        self.bodies: dict[str, bytes] = {}
+        self.lock = threading.Lock()
+
+    def _record(self, request: httpx.Request, response: httpx.Response):
+        body = response.content
+        sha1 = hashlib.sha1(body).hexdigest()
+        headers = [(k, v) for k, v in response.headers.multi_items() if k.lower() not in _DROPPED_HEADERS]
+        with self.lock:
+            self.bodies[sha1] = body
+            self.exchanges.append({"method": request.method, "url": str(request.url),
+                                   "body_sha1": _body_sha1(request.content), "status": response.status_code,
+                                   "headers": headers, "file": f"responses/{sha1}"})
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        request.read()
+        response = self.transport.handle_request(request)
+        response.read()
+        self._record(request, response)
+        return response
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await request.aread()
+        response = await self.async_transport.handle_async_request(request)
+        await response.aread()
+        self._record(request, response)
+        return response
+
+    def save(self):
+        """
+        Write the archive, a path ending with `.zip` is written as a zip file, otherwise as a directory.
+        """
+        with self.lock:
+            manifest = json.dumps({"exchanges": self.exchanges}, ensure_ascii=False, indent=2)
+            bodies = dict(self.bodies)
+        if self.path.suffix == ".zip":
+            with zipfile.ZipFile(self.path, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+                zf.writestr("manifest.json", manifest)
+                for sha1, body in bodies.items():
+                    zf.writestr(f"responses/{sha1}", body)
+        else:
+            (self.path / "responses").mkdir(parents=True, exist_ok=True)
+            (self.path / "manifest.json").write_text(manifest, encoding="utf-8")
+            for sha1, body in bodies.items():
+                (self.path / "responses" / sha1).write_bytes(body)
+
+    def close(self):
+        self.transport.close()
+
+    async def aclose(self):
+        await self.async_transport.aclose()
+
+
+@contextmanager
+def load_archive(path: str | Path) -> Generator[tuple[dict, Callable[[str], bytes]], None, None]:
+    """
+    Read the manifest of an archive, the zip file is closed at the end of the with block.
+    :return: The manifest and a function to read a file of the archive.
+    """
+    path = Path(path)
+    if path.is_dir():
+        manifest = json.loads((path / "manifest.json").read_text(encoding="utf-8"))
+        yield manifest, lambda name: (path / name).read_bytes()
+        return
+    with zipfile.ZipFile(path) as zf:
+        yield json.loads(zf.read("manifest.json").decode("utf-8")), zf.read
+
+
+class ReplayTransport(httpx.BaseTransport, httpx.AsyncBaseTransport):
+    """
+    Serve the exchanges of an archive, with a synthetic latency and bandwidth.
+    A request which was not recorded gets `missing_status`.
+    """
+
+    def __init__(self, path: str | Path, *, latency: float | Callable[[], float] = 0.0,
+                 bandwidth: float | None = None, missing_status: int = 404):
+        """
+        :param path: The archive.
+        :param latency: The seconds before the response, or a function returning them, e.g.
+                        `lambda: random.expovariate(1 / 0.2)`.
+        :param bandwidth: The bytes per second of the body, None is unlimited.
+        :param missing_status: The status of the requests which are not in the archive.
+        """
+        self.responses: dict[tuple[str, str, str], tuple[int, list, bytes]] = {}
+        with load_archive(path) as (manifest, read):
+            for exchange in manifest["exchanges"]:
+                headers = exchange.get("headers", [])
+                key = _key(exchange["method"], exchange["url"], exchange.get("body_sha1", ""))
+                # The first recorded exchange wins, like the first response a real site gave.
+                self.responses.setdefault(key, (exchange["status"], headers, read(exchange["file"])))
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.missing_status = missing_status
+
+    def _lookup(self, request: httpx.Request) -> tuple[httpx.Response, float]:
+        found = self.responses.get(_key(request.method, str(request.url), _body_sha1(request.content)))
+        status, headers, body = found or (self.missing_status, [("content-type", "text/plain")], b"")
+        delay = self.latency() if callable(self.latency) else self.latency
+        if self.bandwidth:
+            delay += len(body) / self.bandwidth
+        return httpx.Response(status, headers=headers, content=body), delay
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        request.read()
+        response, delay = self._lookup(request)
+        if delay > 0:
+            time.sleep(delay)
+        return response
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await request.aread()
+        response, delay = self._lookup(request)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return response
+
+
+def jitter(mean: float, spread: float = 0.5) -> Callable[[], float]:
+    """
+    A latency function which is uniform in `mean * (1 ± spread)`.
+    """
+    return lambda: mean * (1 + random.uniform(-spread, spread))
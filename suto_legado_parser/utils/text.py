@@ -23,8 +23,12 @@
 
 @Date       : 2024/9/5 下午7:11
 """
+import html
 import re
 
+_BLOCK_END = re.compile(r"<br\s*/?>|</p\s*>|</div\s*>", re.IGNORECASE)
+_TAG = re.compile(r"<[^>]+>")
+
 
 def classify_string(input_string):
     # Define regex patterns
@@ -47,3 +51,14 @@ def classify_string(input_string):
     # Otherwise, classify as a regular string
     else:
         return 'string'
+
+
+def html_to_text(content: str) -> str:
+    """
+    Turn the html of a chapter into plain text, one paragraph per line.
+    """
+    if "<" not in content:
+        return content.strip()
+    content = _TAG.sub("", _BLOCK_END.sub("\n", content))
+    lines = (line.strip() for line in html.unescape(content).replace("\xa0", " ").splitlines())
+    return "\n".join(line for line in lines if line)
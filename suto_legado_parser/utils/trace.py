@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+#  Copyright (C) 2024. Suto-Commune
+#  _
+#  This program is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU Affero General Public License as
+#  published by the Free Software Foundation, either version 3 of the
+#  License, or (at your option) any later version.
+#  _
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Affero General Public License for more details.
+#  _
+#  You should have received a copy of the GNU Affero General Public License
+#  along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+@File       : trace.py
+
+@Author     : hsn
+
+@Date       : 2024/10/19 下午5:40
+"""
+import logging
+import random
+from typing import Any
+
+# Values longer than this are cut in the messages, a whole page is useless in a log line.
+MAX_VALUE_LEN = 200
+
+_sample_rate: float = 1.0
+
+
+def set_sample_rate(rate: float):
+    """
+    Only emit this fraction of the trace events, e.g. 0.01 for one in a hundred.
+    """
+    global _sample_rate
+    if not 0 <= rate <= 1:
+        raise ValueError("The sample rate should be between 0 and 1.")
+    _sample_rate = rate
+
+
+def shorten(value: Any, max_len: int = MAX_VALUE_LEN) -> str:
+    text = str(value)
+    if len(text) > max_len:
+        return f"{text[:max_len]}...({len(text)} chars)"
+    return text
+
+
+class _Fields:
+    """
+    The fields of an event, they are only formatted if the record is really emitted.
+    """
+    __slots__ = ("fields",)
+
+    def __init__(self, fields: dict):
+        self.fields = fields
+
+    def __str__(self):
+        return " ".join(f"{k}={shorten(v)}" for k, v in self.fields.items())
+
+
+class Tracer:
+    """
+    A structured trace events emitter on top of `logging`, at the DEBUG level.
+    Nothing is formatted unless the event is emitted, and hot paths should check `enabled` first,
+    so no work is done at all when tracing is off.
+    example:
+        tracer = Tracer("Parser")
+        if tracer.enabled:
+            tracer("book", name=name, url=url)  # DEBUG:Parser:book name=... url=...
+    """
+    __slots__ = ("logger",)
+
+    def __init__(self, name: str):
+        self.logger = logging.getLogger(name)
+
+    @property
+    def enabled(self) -> bool:
+        # `isEnabledFor` is cached by `logging`, so this is a dict lookup.
+        return self.logger.isEnabledFor(logging.DEBUG)
+
+    def __call__(self, event: str, **fields):
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        if _sample_rate < 1 and random.random() >= _sample_rate:
+            return
+        self.logger.debug("%s %s", event, _Fields(fields), extra={"trace_event": event, "trace_fields": fields})
@@ -0,0 +1,91 @@
+import random
+import threading
+
+import pytest
+
+from suto_legado_parser import chapters
+from suto_legado_parser.chapters import ChapterStore, compress, decompress, normalize
+
+TEXT = "　　第一段\n\n　　第二段"
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = ChapterStore(tmp_path)
+    yield store
+    store.close()
+
+
+def test_mirrors_share_the_text(store):
+    hash_ = store.put("a", "/1", TEXT)
+    assert store.put("b", "/9", "第一段\n第二段\n") == hash_
+    # The text of the first one is kept as it is.
+    assert store.get("a", "/1") == store.get("b", "/9") == TEXT
+    assert store.get("a", "/2") is None
+    assert store.stats()["texts"] == 1 and store.stats()["chapters"] == 2
+
+
+def test_unreadable_text_is_forgotten(store):
+    hash_ = store.put("a", "/1", TEXT)
+    store.put("b", "/1", TEXT)
+    store._blob_path(hash_).write_bytes(b"?broken")
+    assert store.get("a", "/1") is None
+    assert store.get("b", "/1") is None
+    assert store.stats() == {"chapters": 0, "texts": 0, "bytes": 0, "max_bytes": store.max_bytes}
+    store.put("a", "/1", TEXT)
+    assert store.get("a", "/1") == TEXT
+
+
+def test_evict_least_recently_used(tmp_path):
+    store = ChapterStore(tmp_path, max_bytes=2000)
+    rng = random.Random(0)
+    # Random, so each one takes about 500 bytes once compressed.
+    texts = [f"第{i}章 " + "".join(rng.choice("天地玄黄宇宙洪荒") for _ in range(500)) for i in range(20)]
+    for i, text in enumerate(texts):
+        store.put("a", f"/{i}", text)
+        assert store.get("a", "/0") == texts[0]  # Kept by being read.
+    assert store.bytes <= store.max_bytes
+    assert store.get("a", "/1") is None
+    assert store.get("a", "/19") == texts[19]
+    assert len(list(store.objects.rglob("*.tmp"))) == 0
+    bytes_ = store.bytes
+    store.close()
+    assert ChapterStore(tmp_path).bytes == bytes_
+
+
+def test_concurrent_puts(store):
+    barrier = threading.Barrier(8)
+
+    def put(i):
+        barrier.wait()
+        store.put("a", f"/{i}", TEXT + "\n" * i)
+
+    threads = [threading.Thread(target=put, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert store.stats()["texts"] == 1 and store.stats()["chapters"] == 8
+    assert all(store.get("a", f"/{i}") is not None for i in range(8))
+    assert len([p for p in store.objects.rglob("*") if p.is_file()]) == 1
+
+
+def test_codec():
+    data = "正文".encode() * 100
+    assert decompress(compress(data)) == data
+    with pytest.raises(ValueError):
+        decompress(b"?")
+
+
+def test_normalize():
+    assert normalize(" a \r\n\n\tb\n") == "a\nb"
+
+
+def test_record_and_load(store):
+    chapters.set_store(store)
+    try:
+        chapters.record("a", "/1", TEXT)
+        assert chapters.load("a", "/1") == TEXT
+    finally:
+        chapters.set_store(None)
+    assert chapters.load("a", "/1") is None
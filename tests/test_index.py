@@ -0,0 +1,72 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from suto_legado_parser.index import BookIndex, StaleWhileRevalidate
+
+BOOKS = [
+    {"book_url": "/1", "name": "斗破苍穹", "author": "天蚕土豆", "intro": "三十年河东"},
+    {"book_url": "/2", "name": "武动乾坤", "author": "天蚕土豆"},
+    {"book_url": "/3", "name": "苍穹之下", "author": "某人"},
+]
+
+
+@pytest.fixture(params=[True, False], ids=["fts", "like"])
+def index(request):
+    index = BookIndex()
+    index.fts = index.fts and request.param
+    index.add("a", BOOKS)
+    index.add("b", BOOKS[:1])
+    yield index
+    index.close()
+
+
+def test_search(index):
+    assert [(b["source"], b["name"]) for b in index.search("武动乾坤")] == [("a", "武动乾坤")]
+    assert {b["name"] for b in index.search("天蚕土豆")} == {"斗破苍穹", "武动乾坤"}
+    assert {b["source"] for b in index.search("斗破苍穹")} == {"a", "b"}
+    assert index.search("  ") == []
+
+
+def test_search_sources(index):
+    assert [b["source"] for b in index.search("斗破苍穹", sources=["b"])] == ["b"]
+    assert index.search("斗破苍穹", sources=[]) == []
+
+
+def test_placeholder_keeps_known_fields(index):
+    index.add("a", [{"book_url": "/2", "name": "武动乾坤", "last_chapter": "第一章"}])
+    book, = index.search("武动乾坤")
+    assert (book["author"], book["last_chapter"]) == ("天蚕土豆", "第一章")
+    assert len(index) == 4
+
+
+class Parser:
+    def __init__(self, index: BookIndex, source: str, release: threading.Event):
+        self.index, self.source, self.release = index, source, release
+
+    def search(self, query: str):
+        self.release.wait(5)
+        self.index.add(self.source, [{"book_url": "/new", "name": query}])
+        yield from ()
+
+
+def test_stale_while_revalidate():
+    index = BookIndex()
+    index.add("a", BOOKS)
+    release = threading.Event()
+    created = []
+
+    def get_parser(source):
+        created.append((source, threading.current_thread() is threading.main_thread()))
+        return Parser(index, source, release)
+
+    executor = ThreadPoolExecutor(2)
+    cached = StaleWhileRevalidate(index, executor, max_pending=2)
+    # The hits are answered before any source is refreshed, and the parsers are created in the executor.
+    assert [b["name"] for b in cached.search("武动乾坤", ["a", "b", "c"], get_parser)] == ["武动乾坤"]
+    assert cached.search("武动乾坤", ["a", "b", "c"], get_parser) != []  # Not refreshed again.
+    release.set()
+    executor.shutdown(wait=True)
+    assert sorted(created) == [("a", False), ("b", False)]  # At most max_pending refreshes.
+    assert {b["source"] for b in index.search("武动乾坤", sources=["b"])} == {"b"}
@@ -0,0 +1,46 @@
+from suto_legado_parser.merge import BookMerger, normalize
+
+
+def test_normalize():
+    assert normalize("鬥羅大陸（全本）") == "斗罗大陆"
+    assert normalize("ＡＢＣ 【精校版】·书") == "abc书"
+
+
+def test_same_book_of_many_sources():
+    merger = BookMerger("斗罗大陆")
+    merger.add({"name": "斗罗大陆", "author": "唐家三少", "book_url": "/a"}, "a")
+    merger.add({"name": "鬥羅大陸(全本)", "author": "唐家三少", "book_url": "/b"}, "b")
+    merger.add({"name": "斗罗大陆", "author": "未知", "book_url": "/c", "intro": "唐门"}, "c")
+    entry, = merger.entries
+    assert entry.sources == ["a", "b", "c"]
+    assert entry.best()["book_url"] == "/c"
+    assert [s["book_url"] for s in entry.to_dict()["sources"]] == ["/a", "/b", "/c"]
+
+
+def test_unknown_author_learns_it():
+    merger = BookMerger()
+    entry = merger.add({"name": "斗罗大陆", "author": "佚名"}, "a")
+    assert merger.add({"name": "斗罗大陆", "author": "唐家三少"}, "b") is entry
+    assert entry.author == "唐家三少"
+
+
+def test_similar_names():
+    merger = BookMerger(min_similarity=0.8)
+    entry = merger.add({"name": "斗罗大陆之绝世唐门", "author": "唐家三少"}, "a")
+    assert merger.add({"name": "斗罗大陆之绝世唐门!", "author": "唐家三少"}, "b") is entry
+    assert merger.add({"name": "斗罗大陆之绝世唐门外传", "author": "唐家三少"}, "c") is entry
+    assert merger.add({"name": "斗罗大陆之绝世唐门", "author": "别人"}, "d") is not entry
+    assert merger.add({"name": "斗罗大陆", "author": "唐家三少"}, "e") is not entry
+    assert len(merger.entries) == 3
+
+
+def test_ranked():
+    merger = BookMerger("斗罗大陆")
+    merger.extend([{"name": "斗罗大陆外传", "author": "x", "source": "a"},
+                   {"name": "新斗罗大陆", "author": "y", "source": "a"},
+                   {"name": "斗罗大陆", "author": "z", "source": "a"},
+                   {"name": "斗罗大陆外传", "author": "x", "source": "b"},
+                   {"name": "完美世界", "author": "w", "source": "a"}])
+    ranked = ["斗罗大陆", "斗罗大陆外传", "新斗罗大陆", "完美世界"]
+    assert [e.name for e in merger.ranked()] == ranked
+    assert len(merger.ranked(2)) == 2
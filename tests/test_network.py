@@ -0,0 +1,68 @@
+import threading
+
+import httpx
+import pytest
+
+from suto_legado_parser.utils import network
+from suto_legado_parser.utils.network import (PoolConfig, ResponseTooLarge, SourceClient, deadline, request,
+                                              set_pool)
+
+
+def handler(req: httpx.Request) -> httpx.Response:
+    match req.url.path:
+        case "/login":
+            return httpx.Response(200, headers={"set-cookie": f"user={req.url.params['user']}; Path=/"}, text="ok")
+        case "/whoami":
+            return httpx.Response(200, text=req.headers.get("cookie", ""))
+        case "/redirect":
+            return httpx.Response(302, headers={"location": "/whoami"})
+        case "/big":
+            return httpx.Response(200, content=b"x" * 1000)
+    return httpx.Response(404)
+
+
+@pytest.fixture
+def transport():
+    return httpx.MockTransport(handler)
+
+
+def test_cookies_per_source(transport):
+    a = SourceClient("http://books.example", transport=transport)
+    b = SourceClient("http://books.example", transport=transport)
+    a.get("/login?user=a")
+    b.get("/login?user=b")
+    assert a.get("/whoami").text == "user=a"
+    assert b.get("/whoami").text == "user=b"
+    assert SourceClient("http://books.example", transport=transport).get("/whoami").text == ""
+
+
+def test_request(transport):
+    client = SourceClient("http://books.example", transport=transport)
+    client.get("/login?user=a")
+    assert request(client, "/redirect", "get", "", "utf-8", allow_redirects=True) == "user=a"
+    with pytest.raises(ResponseTooLarge):
+        request(client, "/big", "get", "", "utf-8", max_size=100)
+
+
+def test_slots_wait_for_the_deadline(transport):
+    pool = set_pool(PoolConfig(max_connections=1))
+    try:
+        client = SourceClient("http://books.example", transport=transport)
+        taken, release = threading.Event(), threading.Event()
+
+        def hold():
+            with client.stream("GET", "/whoami"):
+                taken.set()
+                release.wait(5)
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        taken.wait(5)
+        with deadline(0.1), pytest.raises(httpx.PoolTimeout):
+            client.get("/whoami")
+        release.set()
+        thread.join()
+        assert client.get("/whoami").status_code == 200
+    finally:
+        set_pool(PoolConfig())
+        assert network.get_pool() is not pool
@@ -0,0 +1,59 @@
+import json
+
+import pytest
+
+from suto_legado_parser.rule.compile import rule_compile
+from suto_legado_parser.rule.plan import ExtractionPlan, FieldSpec
+from suto_legado_parser.rule.rules import JSoupRule
+
+HTML = ('<div class="item"><a href="/b/1">斗破苍穹</a><span>作者：天蚕土豆</span></div>'
+        '<div class="item"><a href="/b/2">武动乾坤</a></div>')
+RULES = {
+    "name": "class.item.0@tag.a@text",
+    "book_url": "class.item.0@tag.a@href",
+    "author": "class.item.0@tag.span@text##作者\\W*",
+    "names": "class.item@tag.a@text",
+}
+
+
+def test_fused_as_compiled_one_by_one():
+    plan = ExtractionPlan([FieldSpec(name=name, rule=rule) for name, rule in RULES.items()])
+    assert plan.rules == {}
+    assert list(plan.root.children) == ["class.item.0", "class.item"]
+    expected = {name: rule_compile(rule, {"result": HTML}) for name, rule in RULES.items()}
+    assert plan.extract(HTML) == expected
+    assert expected["author"] == "天蚕土豆"
+
+
+def test_common_prefix_selected_once(monkeypatch):
+    steps = []
+    apply_step = JSoupRule.apply_step
+    monkeypatch.setattr(JSoupRule, "apply_step", lambda self, results, step: (
+        steps.append(step), apply_step(self, results, step))[1])
+    plan = ExtractionPlan([FieldSpec(name=name, rule=RULES[name]) for name in ("name", "book_url", "author")])
+    plan.extract(HTML)
+    assert steps.count("class.item.0") == 1
+    assert steps.count("tag.a") == 1
+
+
+def test_default_and_callback():
+    plan = ExtractionPlan([FieldSpec(name="name", rule=RULES["name"], callback=len),
+                           FieldSpec(name="page", default=1, callback=lambda v: v + 1)])
+    assert plan.extract(HTML) == {"name": 4, "page": 2}
+
+
+def test_not_a_document():
+    plan = ExtractionPlan([FieldSpec(name="a", rule="$.a"), FieldSpec(name="b", rule="$.b##x")])
+    item = {"a": "1", "b": "xy"}
+    assert plan.extract(item) == plan.extract(json.dumps(item)) == {"a": "1", "b": "y"}
+
+
+def test_failed_step_fails_its_fields(monkeypatch):
+    def apply_step(self, results, step):
+        raise ValueError(step)
+
+    monkeypatch.setattr(JSoupRule, "apply_step", apply_step)
+    plan = ExtractionPlan([FieldSpec(name="name", rule=RULES["name"]), FieldSpec(name="book_url", rule="$.url")])
+    assert list(plan.rules) == ["book_url"]
+    with pytest.raises(ValueError, match="class.item.0"):
+        plan.extract(HTML)
@@ -0,0 +1,62 @@
+import re
+
+import pytest
+
+from suto_legado_parser.rule.rules import RegexRule
+from suto_legado_parser.utils.regex import (compile_java, fuse_deletions, is_single_char, translate_pattern,
+                                            translate_replacement)
+
+
+@pytest.mark.parametrize("pattern, text, expected", [
+    (r"(?<n>\d+)-\k<n>", "12-12 12-13", ["12-12"]),
+    (r"\Q1+1\E=\d", "1+1=2 11=2", ["1+1=2"]),
+    (r"a\hb", "a b a　b a\nb", ["a b", "a　b"]),
+    (r"\p{Han}+", "abc中文def", ["中文"]),
+    (r"[\p{Han}\d]+", "ab中1文c", ["中1文"]),
+    (r"\P{Alpha}+", "ab12cd", ["12"]),
+    (r"[]a]+", "]a]b", ["]a]"]),
+    (r"(?<=x)y", "xy", ["y"]),
+    (r"end\z", "the end", ["end"]),
+])
+def test_translate_pattern(pattern, text, expected):
+    assert [m.group() for m in compile_java(pattern).finditer(text)] == expected
+
+
+@pytest.mark.parametrize("pattern", [r"\p{Han", r"(?<n>a)\k<n", r"\p{Unknown}"])
+def test_malformed_pattern(pattern):
+    with pytest.raises(re.error):
+        translate_pattern(pattern)
+
+
+@pytest.mark.parametrize("repl, expected", [
+    ("$1", r"\g<1>"),
+    ("${name}-$12", r"\g<name>-\g<12>"),
+    (r"\$1", "$1"),
+    ("a\\\\b", r"a\\b"),
+    ("$", "$"),
+])
+def test_translate_replacement(repl, expected):
+    assert translate_replacement(repl) == expected
+
+
+def test_fuse_deletions():
+    patterns = [r"\s", "a", r"[xyz]", r"　", r"\p{Punct}"]
+    assert all(is_single_char(p) for p in patterns)
+    assert not any(is_single_char(p) for p in ["ab", r"\s+", "(a)", "a|b"])
+    text = "a b　x,y!c"
+    one_by_one = text
+    for p in patterns:
+        one_by_one = compile_java(p).sub("", one_by_one)
+    assert compile_java(fuse_deletions(patterns)).sub("", text) == one_by_one == "bc"
+
+
+def test_regex_rule():
+    assert RegexRule(r"\s####a##b").compile({"result": "a b a"}) == "bbb"
+    assert RegexRule(r"(\d+)##<$1>###").compile({"result": "1 2"}) == "<1> 2"
+
+
+@pytest.mark.parametrize("rule", [r"\p{Han##", r"(##", r"(?<n>a)\k<n##"])
+def test_bad_regex_rule_fails_when_used(rule):
+    regex_rule = RegexRule(rule)
+    with pytest.raises(re.error):
+        regex_rule.compile({"result": "x"})
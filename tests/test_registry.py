@@ -0,0 +1,89 @@
+import io
+import json
+import threading
+import http.server
+
+import pytest
+
+from suto_legado_parser import cli
+from suto_legado_parser.registry import SourceRegistry, iter_source_spans
+
+SOURCES = [
+    {"bookSourceUrl": "http://a.example", "bookSourceName": "a", "bookSourceGroup": "x, y"},
+    {"bookSourceUrl": "http://b.example", "bookSourceName": "b {\"}", "bookSourceGroup": "y；z", "enabled": False},
+    {"bookSourceUrl": "http://c.example", "bookSourceName": "c\\", "ruleSearch": {"bookList": "[{]"}},
+]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1 << 16])
+def test_iter_source_spans(chunk_size):
+    data = json.dumps(SOURCES, ensure_ascii=False, indent=1).encode()
+    spans = list(iter_source_spans(io.BytesIO(data), chunk_size))
+    assert [json.loads(span) for _, span in spans] == SOURCES
+    assert all(data[offset:offset + len(span)] == span for offset, span in spans)
+
+
+def test_iter_single_source():
+    data = json.dumps(SOURCES[0]).encode()
+    assert [json.loads(span) for _, span in iter_source_spans(io.BytesIO(data), 3)] == [SOURCES[0]]
+
+
+def test_registry(tmp_path):
+    path = tmp_path / "sources.json"
+    path.write_text(json.dumps(SOURCES, ensure_ascii=False), encoding="utf-8")
+    registry = SourceRegistry.from_file(path, max_parsers=2)
+    assert len(registry) == 3 and "http://b.example" in registry
+    assert registry.urls(group="y") == ["http://a.example", "http://b.example"]
+    assert registry.urls(group="y", enabled=True) == ["http://a.example"]
+    assert registry.groups() == {"x": 1, "y": 2, "z": 1}
+    assert registry.get_source("http://c.example") == SOURCES[2]
+    parser = registry.get_parser("http://a.example")
+    assert registry.get_parser("http://a.example") is parser
+    registry.get_parser("http://b.example")
+    registry.get_parser("http://c.example")
+    assert registry.loaded == 2
+    assert registry.get_parser("http://a.example") is not parser  # The least recently used was dropped.
+    with pytest.raises(KeyError):
+        registry.get_parser("http://d.example")
+
+
+def test_idle_timeout():
+    registry = SourceRegistry.from_sources(SOURCES, idle_timeout=0)
+    registry.get_parser("http://a.example")
+    registry.evict_idle()
+    assert registry.loaded == 0
+
+
+class Site(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = "<ul>" + "".join(f'<li class="item"><a href="/book/{i}">{name}</a></li>'
+                                for i, name in enumerate(["书一", "书二"])) + "</ul>"
+        self.send_response(200)
+        self.send_header("content-type", "text/html; charset=utf-8")
+        self.end_headers()
+        self.wfile.write(body.encode())
+
+    def log_message(self, *args):
+        pass
+
+
+def test_cli_search(tmp_path, capsys):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Site)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+        sources = [{"bookSourceUrl": f"{url}/{i}", "searchUrl": f"{url}/search?q={{{{key}}}}",
+                    "ruleSearch": {"bookList": "class.item", "name": "tag.a@text", "bookUrl": "tag.a@href"}}
+                   for i in range(2)]
+        path = tmp_path / "sources.json"
+        path.write_text(json.dumps(sources), encoding="utf-8")
+        checkpoint = tmp_path / "checkpoint"
+        cli.main(["search", str(path), "-q", "书", "--limit", "1", "--checkpoint", str(checkpoint)])
+        lines = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+        assert sorted((line["source"], line["book"]["name"]) for line in lines) == [
+            (f"{url}/0", "书一"), (f"{url}/1", "书一")]
+        # The jobs of the checkpoint are skipped.
+        cli.main(["search", str(path), "-q", "书", "--checkpoint", str(checkpoint)])
+        assert capsys.readouterr().out == ""
+    finally:
+        server.shutdown()
@@ -0,0 +1,57 @@
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from suto_legado_parser.index import BookIndex, StaleWhileRevalidate
+from suto_legado_parser.registry import SourceRegistry
+from suto_legado_parser.service import Service
+
+SOURCES = [{"bookSourceUrl": f"http://127.0.0.1:9/{i}", "searchUrl": "/s?q={{key}}",
+            "ruleSearch": {"bookList": "class.item", "name": "tag.a@text", "bookUrl": "tag.a@href"}}
+           for i in range(2)]
+
+
+class Writer:
+    def __init__(self):
+        self.data = b""
+
+    def write(self, data: bytes):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+
+def respond(service: Service, target: str) -> tuple[int, bytes]:
+    writer = Writer()
+    asyncio.run(service._respond(writer, "GET", target, False))
+    head, _, body = writer.data.partition(b"\r\n\r\n")
+    return int(head.split()[1]), body
+
+
+def service(cached_search=None) -> Service:
+    return Service(SourceRegistry.from_sources(SOURCES), cached_search=cached_search)
+
+
+def test_errors():
+    assert respond(service(), "/nothing") == (404, json.dumps({"error": "not found"}).encode())
+    assert respond(service(), "/detail?source=x")[0] == 400
+    assert respond(service(), "/search?q=a&source=http://other.example")[0] == 404
+
+
+def test_cached_search():
+    index = BookIndex()
+    index.add(SOURCES[0]["bookSourceUrl"], [{"book_url": "/b", "name": "测试书名"}])
+    cached_search = StaleWhileRevalidate(index, ThreadPoolExecutor(1))
+    status, body = respond(service(cached_search), "/search?q=测试书名&mode=cached")
+    assert status == 200
+    line = json.loads(body.split(b"\r\n")[1])
+    assert (line["source"], line["book"]["name"], line["cached"]) == (SOURCES[0]["bookSourceUrl"], "测试书名", True)
+
+
+def test_cached_search_error():
+    index = BookIndex()
+    index.close()  # Every query fails.
+    status, body = respond(service(StaleWhileRevalidate(index, ThreadPoolExecutor(1))), "/search?q=书名&mode=cached")
+    assert status == 502
+    assert json.loads(body)["error"].startswith("ProgrammingError")
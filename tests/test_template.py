@@ -0,0 +1,58 @@
+import pytest
+
+from suto_legado_parser.rule.template import UrlTemplate, _compile_expression, parse_url_options
+
+
+@pytest.mark.parametrize("expr, var, expected", [
+    ("key", {"key": "书"}, "书"),
+    ("(page-1)*20", {"page": 3}, "40"),
+    ("-page + 1.5", {"page": 1}, "0.5"),
+    ("key + '_' + key", {"key": "a"}, "a_a"),
+])
+def test_expression(expr, var, expected):
+    assert _compile_expression(expr)(var) == expected
+
+
+@pytest.mark.parametrize("expr", ["java.encode(key)", "key[0]", "page / 2", "page ** 99", "a if b else c"])
+def test_expression_needs_js(expr):
+    assert _compile_expression(expr) is None
+
+
+@pytest.mark.parametrize("expr, var", [
+    ("'x' * 99999999999", {}),
+    ("key * 2", {"key": "a"}),
+    ("key + 1", {"key": "a"}),
+    ("-key", {"key": "a"}),
+    ("missing + 1", {}),
+])
+def test_expression_left_to_js(expr, var):
+    with pytest.raises((TypeError, KeyError)):
+        _compile_expression(expr)(var)
+
+
+def test_url_template():
+    template = UrlTemplate("/search?q={{key}}&offset={{(page-1)*20}}")
+    assert template.simple
+    assert template.render({"key": "书", "page": 2}) == "/search?q=书&offset=20"
+    assert not UrlTemplate("@js:'/search?q=' + key").simple
+
+
+def test_url_template_falls_back_to_js():
+    pytest.importorskip("STPyV8")
+    assert UrlTemplate("/s?{{'x' * 99999999999}}").render({}) == "/s?nan"
+    assert UrlTemplate("/s?{{key + 1}}").render({"key": "a"}) == "/s?a1"
+
+
+@pytest.mark.parametrize("text, expected", [
+    ('{"method": "POST", "body": "key=1"}', {"method": "POST", "body": "key=1"}),
+    ("{'method': 'POST', 'webView': true, 'retry': -1, 'headers': {'a': null}}",
+     {"method": "POST", "webView": True, "retry": -1, "headers": {"a": None}}),
+])
+def test_parse_url_options(text, expected):
+    assert parse_url_options(text) == expected
+
+
+@pytest.mark.parametrize("text", ["[1, 2]", "{'a': __import__('os')}", "{'a': "])
+def test_parse_url_options_invalid(text):
+    with pytest.raises(ValueError):
+        parse_url_options(text)
@@ -0,0 +1,47 @@
+import pytest
+
+from suto_legado_parser.rule.rules import JSoupRule, TEXT_INDEX_MAX_LEN, _iter_texts, parse_html
+
+HTML = """
+<html><head><title>书名</title><style>p { color: red }</style></head>
+<body>
+<div id="nav"><p>下一页<script>var a = 1;</script></p><!-- 下一页 --></div>
+<div class="list"><a href="/1"> 第一章 </a><a href="/2">第二章</a><template><b>模板</b></template></div>
+<div><span>下一</span><span>页</span></div>
+</body></html>
+"""
+
+
+def test_texts_are_get_text():
+    soup = parse_html(HTML)
+    for tag, text in _iter_texts(soup):
+        assert text == tag.get_text()
+
+
+@pytest.mark.parametrize("rule, expected", [
+    ("text.下一页@tag.script@text", "var a = 1;"),
+    ("text.第二章@href", "/2"),
+    # The whitespace of the text is kept, as `get_text()` does.
+    ("text. 第一章 @href", "/1"),
+])
+def test_text_selector(rule, expected):
+    assert JSoupRule(rule).compile({"result": HTML}) == expected
+
+
+def test_deepest_tag():
+    assert [tag.name for tag in JSoupRule("text.深").select({"result": "<div><p><b>深</b></p></div>"})] == ["b"]
+    # The string of a <template> is only in its own text.
+    assert [tag.name for tag in JSoupRule("text.模板").select({"result": HTML})] == ["template"]
+
+
+@pytest.mark.parametrize("rule", ["text.第一章", "text.下一页 "])
+def test_text_not_found(rule):
+    with pytest.raises(ValueError):
+        JSoupRule(rule).select({"result": HTML})
+
+
+def test_long_text():
+    text = "长" * (TEXT_INDEX_MAX_LEN + 1)
+    html = f"<div><p><i>{text}</i></p><p><b>{text}</b></p></div>"
+    assert [tag.name for tag in JSoupRule(f"text.{text}").select({"result": html})] == ["i"]
+    assert [tag.name for tag in JSoupRule(f"tag.p.1@text.{text}").select({"result": html})] == ["b"]
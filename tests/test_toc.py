@@ -0,0 +1,85 @@
+import pytest
+
+from suto_legado_parser.book_soure_parser import BookDetail, BookInfo, Chapter
+from suto_legado_parser.toc import TocStore, refresh_toc
+
+
+class FakeParser:
+    """
+    A toc of pages of 2 chapters, `iter_toc_pages` follows them from the given page.
+    """
+    j = {"bookSourceUrl": "https://a.example"}
+
+    def __init__(self, chapters: int):
+        self.chapters = chapters
+        self.fetched: list[str] = []
+        self.details = 0
+
+    def get_detail(self, book):
+        self.details += 1
+        return BookDetail(book_url=book.book_url, toc_url="/toc/0")
+
+    def iter_toc_pages(self, url):
+        page = int(url.rsplit("/", 1)[1])
+        while page * 2 < self.chapters or page == 0:
+            self.fetched.append(f"/toc/{page}")
+            yield f"/toc/{page}", [Chapter(name=f"第{i}章", url=f"/c/{i}")
+                                   for i in range(page * 2, min(page * 2 + 2, self.chapters))]
+            page += 1
+
+
+@pytest.fixture
+def store():
+    store = TocStore()
+    yield store
+    store.close()
+
+
+def book(last_chapter: str) -> BookInfo:
+    return BookInfo(book_url="/book", last_chapter=last_chapter)
+
+
+def test_first_refresh(store):
+    parser = FakeParser(5)
+    diff = refresh_toc(parser, book("第4章"), store)
+    assert diff.changed and parser.details == 1
+    assert [c.url for c in diff.added] == [f"/c/{i}" for i in range(5)]
+    assert diff.pages_fetched == 3
+    assert store.get("https://a.example", "/book").pages == [("/toc/0", 2), ("/toc/1", 2), ("/toc/2", 1)]
+
+
+def test_same_last_chapter(store):
+    parser = FakeParser(5)
+    refresh_toc(parser, book("第4章"), store)
+    parser.fetched.clear()
+    diff = refresh_toc(parser, book("第4章"), store)
+    assert not diff.changed and len(diff.chapters) == 5
+    assert parser.fetched == []
+
+
+def test_only_the_last_page(store):
+    parser = FakeParser(5)
+    refresh_toc(parser, book("第4章"), store)
+    parser.chapters, parser.fetched = 8, []
+    diff = refresh_toc(parser, book("第7章"), store)
+    assert parser.fetched == ["/toc/2", "/toc/3"]
+    assert [c.url for c in diff.added] == ["/c/5", "/c/6", "/c/7"]
+    assert diff.removed == [] and len(diff.chapters) == 8
+    assert parser.details == 1  # The toc url is the stored one.
+
+
+def test_removed_chapters(store):
+    parser = FakeParser(5)
+    refresh_toc(parser, book("第4章"), store)
+    parser.chapters = 4
+    diff = refresh_toc(parser, book("第3章"), store)
+    assert [c.url for c in diff.removed] == ["/c/4"]
+    assert diff.changed and diff.added == []
+
+
+def test_unknown_last_chapter_refreshes(store):
+    parser = FakeParser(3)
+    refresh_toc(parser, book("Unknown"), store)
+    assert store.get("https://a.example", "/book").last_chapter == "第2章"
+    diff = refresh_toc(parser, book("Unknown"), store)
+    assert not diff.changed and diff.pages_fetched == 1
@@ -0,0 +1,122 @@
+import http.server
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("STPyV8")
+
+from suto_legado_parser.rule import watchdog
+from suto_legado_parser.rule.rules import JsRule
+
+
+def run(script: str, **var):
+    return JsRule(script).compile({"result": "", **var})
+
+
+@pytest.fixture(autouse=True)
+def default_limits():
+    watchdog.boot()
+    limits = watchdog.get_default_limits()
+    yield
+    watchdog.set_default_limits(limits)
+
+
+def test_top_level_var():
+    assert run("var s = 0; for (var k = 0; k < 1e6; k++) s += k; s") == 499999500000
+    started = time.perf_counter()
+    run("var s = 0; for (var k = 0; k < 1e6; k++) s += k; s")
+    # In a function through eval the var are looked up by name, about 50 times slower.
+    assert time.perf_counter() - started < 0.5
+
+
+def test_globals_are_reset():
+    run("var a = 1; b = 2; let c = 3; globalThis.d = 4")
+    assert run("typeof a + typeof b + typeof c + typeof d") == "undefinedundefinedundefinedundefined"
+    assert run("result + source.getKey()", result="x", _book_source={"bookSourceUrl": "y"}) == "xy"
+
+
+def test_time_limit():
+    watchdog.set_default_limits(watchdog.JsLimits(seconds=0.2))
+    with pytest.raises(watchdog.JsLimitExceeded) as e:
+        run("while (true) {}")
+    assert e.value.reason == "time"
+    assert run("1 + 1") == 2
+
+
+def test_memory_limit():
+    watchdog.set_default_limits(watchdog.JsLimits(seconds=30, memory=32 << 20))
+    with pytest.raises(watchdog.JsLimitExceeded) as e:
+        run("let a = []; while (true) a.push('x'.repeat(100) + a.length)")
+    assert e.value.reason == "memory"
+    assert run("1 + 1") == 2
+
+
+def test_cpu_time_of_concurrent_scripts():
+    script = "let s = 0; for (let i = 0; i < 2e7; i++) s += i % 7; s"
+    started = time.perf_counter()
+    expected = run(script)
+    alone = time.perf_counter() - started
+    # The scripts wait for each other, only the time they run counts.
+    watchdog.set_default_limits(watchdog.JsLimits(seconds=alone * 3))
+    results = []
+
+    def work():
+        try:
+            results.append(run(script))
+        except watchdog.JsLimitExceeded as e:
+            results.append(e)
+
+    threads = [threading.Thread(target=work) for _ in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [expected] * 6
+
+
+def test_nested_termination():
+    from suto_legado_parser.utils import js
+
+    class Nested(js.JsUtil):
+        def inner(self, script):
+            with watchdog.limits(watchdog.JsLimits(seconds=0.2)):
+                try:
+                    return run(script)
+                except watchdog.JsLimitExceeded:
+                    return "terminated"
+
+    original, js.JsUtil = js.JsUtil, Nested
+    try:
+        assert run("java.inner('40 + 2') + 1") == 43
+        assert run("java.inner('while (true) {}') + '|' + (1 + 1)") == "terminated|2"
+    finally:
+        js.JsUtil = original
+
+
+def test_ajax_releases_the_isolate():
+    class Slow(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            time.sleep(0.5)
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(b"slow")
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Slow)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        result = []
+        thread = threading.Thread(target=lambda: result.append(
+            run(f"java.ajax('http://127.0.0.1:{server.server_address[1]}/')")))
+        thread.start()
+        time.sleep(0.1)
+        started = time.perf_counter()
+        assert run("1 + 1") == 2
+        assert time.perf_counter() - started < 0.3
+        thread.join()
+        assert result == ["slow"]
+    finally:
+        server.shutdown()